@@ -29,6 +29,9 @@ from charmhelpers.fetch import (
 from charmhelpers.core.hookenv import (
     Hooks,
     config,
+    enable_log_buffering,
+    enable_relation_set_buffering,
+    enable_relation_snapshot,
     log as juju_log,
     relation_ids,
     relation_set,
@@ -43,11 +46,15 @@ from astara_utils import (
     create_networks,
     create_astara_nova_flavor,
     determine_packages,
+    flavor_task,
     get_network,
     git_install,
+    image_task,
     is_glance_api_ready,
     is_neutron_api_ready,
     is_nova_api_ready,
+    networks_task,
+    provision,
     publish_astara_appliance_image,
     register_configs,
     validate_config,
@@ -83,13 +90,17 @@ def keystone_joined(relation_id=None):
 
 @hooks.hook('identity-service-relation-changed')
 def keystone_changed():
-    # once we have sufficent keystone creds and the neutron ap is ready, we
-    # can create networks in neutron and images in glance, then advertise
-    # those to the orchestrator.
+    # once we have sufficent keystone creds and the APIs are ready, we can
+    # create networks in neutron, images in glance and the flavor in nova,
+    # then advertise those to the orchestrator.
+    tasks = {}
     if is_neutron_api_ready():
-        create_networks()
+        tasks['networks'] = networks_task()
     if is_glance_api_ready():
-        publish_astara_appliance_image()
+        tasks['image'] = image_task()
+    if is_nova_api_ready():
+        tasks['flavor'] = flavor_task()
+    provision(tasks)
     for rid in relation_ids('astara-orchestrator'):
         astara_orchestrator_relation_joined(rid)
 
@@ -101,6 +112,11 @@ def config_changed():
             git_install(config('openstack-origin-git'))
     validate_config()
     CONFIGS.write_all()
+    if (config_value_changed('astara-router-appliance-raw') and
+            is_glance_api_ready()):
+        publish_astara_appliance_image()
+        for rid in relation_ids('astara-orchestrator'):
+            astara_orchestrator_relation_joined(rid)
 
 
 @hooks.hook('neutron-plugin-api-subordinate-relation-changed')
@@ -219,6 +235,9 @@ def install():
 
 
 def main():
+    enable_log_buffering()
+    enable_relation_snapshot()
+    enable_relation_set_buffering()
     try:
         hooks.execute(sys.argv)
     except UnregisteredHookError as e:
@@ -12,19 +12,32 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import hashlib
 import json
 import netaddr
 import os
+import random
 import subprocess
+import threading
 import time
+import traceback
 
 from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+from six.moves import http_client
+from six.moves.urllib.error import HTTPError
+from six.moves.urllib.request import Request, urlopen
 
 from charmhelpers.contrib.openstack import context, templating
+from charmhelpers.contrib.openstack.neutron import find_neutron_resource
+from charmhelpers.core import unitdata
 
 from charmhelpers.core.hookenv import (
+    ERROR,
+    atexit,
     config,
-    log as juju_log,
+    log,
     relation_ids,
     relation_get,
     related_units,
@@ -37,11 +50,31 @@ from charmhelpers.contrib.openstack.utils import (
 )
 
 
-CLIENT_RETRY_MAX = 20
+# Seconds a hook may spend in total waiting for remote APIs to come up
+CLIENT_READY_TIMEOUT = 60
+# Bounds of the exponential backoff between readiness probes, in seconds
+CLIENT_BACKOFF_BASE = 0.5
+CLIENT_BACKOFF_MAX = 8
 TEMPLATES = 'templates/'
-ASTARA_NETWORK_CACHE = '/var/lib/juju/astara-network-cache.json'
-GLANCE_IMG_ID_CACHE = '/var/lib/juju/astara-applinace-image-cache'
-NOVA_FLAVOR_ID_CACHE = '/var/lib/juju/astara-applinace-flavor-cache'
+# unitdata key of each kind of entry in the ResourceCache
+RESOURCE_CACHE_KEY = 'astara.resources.%s'
+RESOURCE_CACHE_TTL = 3600
+# unitdata key of the keystone token shared by the API clients, per auth
+# URL, user and project
+TOKEN_KEY = 'astara.keystone-token.%s'
+# Saved tokens are not reused within this many seconds of expiring
+TOKEN_EXPIRY_MARGIN = 300
+# unitdata key of the outcome of each provisioning task
+PROVISION_KEY = 'astara.provision.%s'
+
+# Appliance images are spooled here while they are streamed into glance, so
+# an interrupted transfer can be resumed instead of restarted.
+APPLIANCE_DOWNLOAD_DIR = '/var/lib/juju/astara-appliance'
+# unitdata key holding what we know about the image at a given URL
+APPLIANCE_KEY = 'astara.appliance.%s'
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_RETRY_MAX = 5
+DOWNLOAD_TIMEOUT = 60
 
 ASTARA_FLAVOR_NAME = 'astara'
 
@@ -60,6 +93,7 @@ BASE_GIT_PACKAGES = [
     'python-keystoneclient',
     'python-glanceclient',
     'python-novaclient',
+    'qemu-utils',
 ]
 
 
@@ -109,6 +143,22 @@ def git_install(projects_yaml):
         git_clone_and_install(projects_yaml, core_project='astara-neutron')
 
 
+_task_log = threading.local()
+
+
+def juju_log(message, level=None):
+    """Write a message to the juju log.
+
+    Messages logged by a provisioning task are queued instead, and written
+    out by the main thread once the task has ended.
+    """
+    messages = getattr(_task_log, 'messages', None)
+    if messages is None:
+        log(message, level)
+    else:
+        messages.append((message, level))
+
+
 def _auth_args():
     """Get current service credentials from the identity-service relation"""
     rel_ctxt = context.IdentityServiceContext()
@@ -133,12 +183,128 @@ def _auth_args():
     return auth_args
 
 
+class ResourceCache(object):
+    """Ids of the networks, images and flavor the charm created or found.
+
+    Entries are kept in unitdata along with the config values they were
+    derived from (the inputs), and are discarded once those values change.
+    An entry is trusted for ``ttl`` seconds (resource-cache-ttl), after
+    which the validate callable given to :meth:`get` looks the resource up
+    by id to make sure it still exists. Validators return True if it does,
+    False if it is gone and None if they could not tell, in which case the
+    entry is used and checked again next time.
+    """
+
+    def __init__(self, db=None, ttl=None):
+        self.db = db or unitdata.kv()
+        if ttl is None:
+            ttl = config('resource-cache-ttl')
+        self.ttl = RESOURCE_CACHE_TTL if ttl is None else int(ttl)
+
+    def _save(self, kind, entry):
+        self.db.set(RESOURCE_CACHE_KEY % kind, entry)
+        self.db.flush()
+
+    def get(self, kind, inputs, validate=None):
+        entry = self.db.get(RESOURCE_CACHE_KEY % kind)
+        # Compare as stored, eg. tuples come back as lists
+        if not entry or entry['inputs'] != json.loads(json.dumps(inputs)):
+            return None
+        if validate and time.time() - entry['validated'] >= self.ttl:
+            try:
+                valid = validate(entry['value'])
+            except Exception as e:
+                juju_log('Unable to validate cached %s: %s' % (kind, e))
+                valid = None
+            if valid is False:
+                juju_log('Cached %s no longer exists, discarding it' % kind)
+                self.invalidate(kind)
+                return None
+            if valid:
+                entry['validated'] = time.time()
+                self._save(kind, entry)
+        return entry['value']
+
+    def set(self, kind, inputs, value):
+        self._save(kind, {'inputs': inputs,
+                          'value': value,
+                          'validated': time.time()})
+        return value
+
+    def invalidate(self, kind):
+        self.db.unset(RESOURCE_CACHE_KEY % kind)
+        self.db.flush()
+
+
+def _network_inputs():
+    return dict(
+        (net_type, [config('%s-network-cidr' % net_type),
+                    config('%s-network-name' % net_type)])
+        for net_type in ('management', 'external'))
+
+
+def _image_inputs():
+    return {
+        'url': config('astara-router-appliance-url'),
+        'checksum': config('astara-router-appliance-checksum'),
+    }
+
+
+def _flavor_inputs():
+    return {
+        'ram': config('astara-appliance-flavor-ram'),
+        'disk': config('astara-appliance-flavor-disk'),
+        'vcpus': config('astara-appliance-flavor-cpu'),
+    }
+
+
+def _networks_exist(net_data):
+    from neutronclient.common.exceptions import NotFound
+    auth_args = _auth_args()
+    if not auth_args:
+        return None
+    client = get_neutronclient(auth_args)
+    try:
+        for net in net_data['networks']:
+            client.show_network(net['id'], fields='id')
+        for snet in net_data['subnets']:
+            client.show_subnet(snet['id'], fields='id')
+    except NotFound:
+        return False
+    return True
+
+
+def _image_exists(img_id):
+    from glanceclient.exc import HTTPNotFound
+    auth_args = _auth_args()
+    if not auth_args:
+        return None
+    try:
+        img = get_glanceclient(auth_args).images.get(img_id)
+    except HTTPNotFound:
+        return False
+    return img.get('status') == 'active'
+
+
+def _flavor_exists(flavor_id):
+    from novaclient.exceptions import NotFound
+    auth_args = _auth_args()
+    if not auth_args:
+        return None
+    try:
+        get_novaclient(auth_args).flavors.get(flavor_id)
+    except NotFound:
+        return False
+    return True
+
+
 def get_or_create_network(client, name, external=False):
     juju_log('get_or_create_network: %s' % name)
-    for net in client.list_networks()['networks']:
-        if net['name'] == name:
-            juju_log('- found existing network: %s' % net['id'])
-            return net
+    net = find_neutron_resource(client.list_networks, 'networks',
+                                fields=['id', 'name'], name=name)
+    if net:
+        juju_log('- found existing network: %s' % net['id'])
+        return net
     juju_log('- creating new network: %s' % name)
     net_dict = {
         'network': {
@@ -157,10 +323,12 @@ def get_or_create_network(client, name, external=False):
 
 def get_or_create_subnet(client, cidr, network_id):
     juju_log('get_or_create_subnet: %s (net: %s)' % (cidr, network_id))
-    for sn in client.list_subnets(network_id=network_id)['subnets']:
-        if sn['cidr'] == cidr:
-            juju_log('- found existing subnet: %s' % sn['id'])
-            return sn
+    sn = find_neutron_resource(client.list_subnets, 'subnets',
+                               fields=['id', 'cidr', 'network_id'],
+                               network_id=network_id, cidr=cidr)
+    if sn:
+        juju_log('- found existing subnet: %s' % sn['id'])
+        return sn
 
     subnet = netaddr.IPNetwork(cidr)
     if subnet.version == 6:
@@ -210,127 +378,444 @@ def is_nova_api_ready():
     return _api_ready('nova-api', 'nova-api-ready')
 
 
-def ensure_client_connectivity(f):
+_ready_deadline = []
+_ready_endpoints = set()
+
+
+def _client_ready_deadline():
+    """When this hook stops waiting for remote APIs.
+
+    The budget is shared by every wait in the hook and starts with the
+    first of them.
+    """
+    if not _ready_deadline:
+        _ready_deadline.append(time.time() + CLIENT_READY_TIMEOUT)
+    return _ready_deadline[0]
+
+
+def _backoff_delays():
+    """Exponentially growing delays with full jitter, so units waiting on
+    the same service do not probe it in lockstep"""
+    attempt = 0
+    while True:
+        yield random.uniform(
+            0, min(CLIENT_BACKOFF_MAX, CLIENT_BACKOFF_BASE * 2 ** attempt))
+        attempt += 1
+
+
+def ensure_client_connectivity(f, desc=None):
     """Ensure a client can successfully call the server's API
     This is needed because remote service restarts are async. This could
     be removed if we can make restart_on_change() take an optional post-restart
     action it executes to ensure API is up before considering it restarted.
 
+    Failed calls are retried with exponential backoff until the hook's
+    CLIENT_READY_TIMEOUT budget is spent.
+
     :param f: A callable from a fully instantiated/configured client
               lib.
+    :param desc: str naming f in log messages, f itself if not given.
     """
+    desc = desc or f
+    deadline = _client_ready_deadline()
+    delays = _backoff_delays()
     i = 0
-    while i <= CLIENT_RETRY_MAX:
+    while True:
         try:
             f()
             juju_log(
                 'Confirmed remote API connectivity /w %s after %s attempts' %
-                (f, i))
+                (desc, i))
             return
         except Exception as e:
-            juju_log(
-                'Failed to connect to remote API /w %s, retrying (%s/%s): %s' %
-                (f, i, CLIENT_RETRY_MAX, e))
             i += 1
-            time.sleep(1)
+            delay = next(delays)
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise Exception(
+                    'Failed to connect to remote API /w %s after %s '
+                    'attempts: %s' % (desc, i, e))
+            juju_log(
+                'Failed to connect to remote API /w %s, retrying in %.1fs '
+                '(attempt %s): %s' % (desc, min(delay, remaining), i, e))
+            time.sleep(min(delay, remaining))
+
 
-    raise Exception(
-        'Failed to connect to remote API /w %s after %s retries.' %
-        (f, CLIENT_RETRY_MAX))
+def ensure_api_ready(auth_args, service_type):
+    """Wait until the service_type API in the keystone catalog answers.
+
+    Rather than making an API call, this fetches the unauthenticated
+    version document at the root of the endpoint, and any response short of
+    a server error counts as ready. Endpoints found ready are remembered
+    for the rest of the hook, so later callers do not probe again.
+
+    :param auth_args: dict of credentials as returned by _auth_args()
+    :param service_type: str catalog service type, eg 'network' or 'image'
+    """
+    session = get_keystone_session(auth_args)
+
+    def probe():
+        endpoint = session.get_endpoint(service_type=service_type,
+                                        region_name=auth_args['region'])
+        if endpoint in _ready_endpoints:
+            return
+        resp = session.get(endpoint, authenticated=False, raise_exc=False)
+        if resp.status_code >= 500:
+            raise Exception('%s returned %s' % (endpoint, resp.status_code))
+        _ready_endpoints.add(endpoint)
+
+    ensure_client_connectivity(probe, '%s API' % service_type)
 
 
 def create_networks():
     """Gets or Creates a management network in Neutron to be used for
     orchestrator->appliance communication.
 
-    The data about the network and subnet is cached locally to avoid future
-    neutron calls.
+    The data about the network and subnet is cached in the ResourceCache to
+    avoid future neutron calls.
 
     If we do not yet have a populated identity-service relation, this does
     nothing.
 
     :returns: A dict containing the network and subnet.
     """
-    from neutronclient.v2_0 import client as NeutronClient
     auth_args = _auth_args()
     if not auth_args:
         return
-    client = NeutronClient.Client(**auth_args)
-    ensure_client_connectivity(client.list_networks)
-
-    mgt_net = (
-        config('management-network-cidr'), config('management-network-name'))
-    ext_net = (
-        config('external-network-cidr'), config('external-network-name'))
-
-    networks = []
-    subnets = []
-    for net in [mgt_net, ext_net]:
-        if net == ext_net:
-            external = True
-        else:
-            external = False
-
-        net_cidr, net_name = net
-        network = get_or_create_network(client, net_name, external)
-        networks.append(network)
-        subnets.append(get_or_create_subnet(client, net_cidr, network['id']))
-
-    # since this data is not available in any relation and to avoid a call
-    # to neutron API for every config write out, save this data locally
-    # for access from config context.
-    net_data = {
-        'networks': networks,
-        'subnets': subnets,
-    }
-    with open(ASTARA_NETWORK_CACHE, 'w') as out:
-        out.write(json.dumps(net_data))
+    return _run_task(_networks_task(auth_args))
+
+
+def _networks_task(auth_args):
+    """The (run, save) pair creating the networks, see provision()"""
+    client = get_neutronclient(auth_args)
+    inputs = _network_inputs()
+
+    def run():
+        ensure_api_ready(auth_args, 'network')
+        networks = []
+        subnets = []
+        for net_type in ('management', 'external'):
+            net_cidr, net_name = inputs[net_type]
+            network = get_or_create_network(client, net_name,
+                                            net_type == 'external')
+            networks.append(network)
+            subnets.append(
+                get_or_create_subnet(client, net_cidr, network['id']))
+        return {
+            'networks': networks,
+            'subnets': subnets,
+        }
 
-    return net_data
+    def save(net_data):
+        # since this data is not available in any relation and to avoid a
+        # call to neutron API for every config write out, save this data
+        # locally for access from config context.
+        if net_data is not None:
+            ResourceCache().set('networks', inputs, net_data)
 
+    return run, save
 
-def get_keystone_session(auth_args):
-    from keystoneclient import auth as ksauth
-    from keystoneclient import session as kssession
 
-    auth_plugin = ksauth.get_plugin_class('password')
-    auth = auth_plugin(
-        auth_url=auth_args['auth_url'],
-        username=auth_args['username'],
-        password=auth_args['password'],
-        project_name=auth_args['tenant_name'],
-    )
-    return kssession.Session(auth=auth)
+class ClientFactory(object):
+    """Builds the OpenStack API clients used within a hook.
+
+    The clients share one keystone Session, and with it one token and one
+    pool of HTTP connections, so a hook authenticates at most once however
+    many clients it uses. The token is saved in unitdata when the hook
+    exits and reused by later hooks with the same credentials until it is
+    about to expire. A token that keystone rejects before then is replaced
+    by the Session itself, and the saved copy is discarded.
+
+    Use get_client_factory() rather than instantiating this directly.
+    """
+
+    def __init__(self, auth_args):
+        self.auth_args = auth_args
+        self._auth = None
+        self._session = None
+        self._clients = {}
+        # Tokens keystone answered 401 for
+        self._rejected = set()
+        # Clients may be requested by several provisioning threads at once
+        self._lock = threading.RLock()
+        # unitdata may only be used from the thread that opened it
+        self._thread = threading.current_thread()
+
+    def _token_key(self):
+        return TOKEN_KEY % json.dumps([self.auth_args['auth_url'],
+                                       self.auth_args['username'],
+                                       self.auth_args['tenant_name']])
+
+    def _restore_token(self):
+        """Hand a saved, unexpired token for these credentials to the
+        auth plugin"""
+        from keystoneclient import access
+        saved = unitdata.kv().get(self._token_key())
+        if not saved:
+            return
+        try:
+            auth_ref = access.AccessInfo.factory(body=saved['body'],
+                                                 auth_token=saved['token'])
+        except Exception as e:
+            juju_log('Unable to restore saved keystone token: %s' % e)
+            return
+        if auth_ref.will_expire_soon(stale_duration=TOKEN_EXPIRY_MARGIN):
+            return
+        self._auth.auth_ref = auth_ref
+
+    def _save_token(self):
+        """Save the current token for later hooks, or discard the saved one
+        if keystone rejected it"""
+        auth_ref = self._auth.auth_ref
+        db = unitdata.kv()
+        key = self._token_key()
+        saved = db.get(key) or {}
+        if auth_ref is None:
+            if saved.get('token') in self._rejected:
+                db.unset(key)
+                db.flush()
+            return
+        if saved.get('token') == auth_ref.auth_token:
+            return
+        body_key = 'token' if auth_ref.version == 'v3' else 'access'
+        db.set(key, {'token': auth_ref.auth_token,
+                     'body': {body_key: dict(auth_ref)}})
+        db.flush()
+
+    def _invalidate(self, auth=None):
+        """Session.invalidate, called when keystone answers 401"""
+        if self._auth.auth_ref is not None:
+            self._rejected.add(self._auth.auth_ref.auth_token)
+        invalidated = self._reauth(auth)
+        if threading.current_thread() is self._thread:
+            self._save_token()
+        return invalidated
+
+    @property
+    def session(self):
+        with self._lock:
+            if self._session is None:
+                from keystoneclient import auth as ksauth
+                from keystoneclient import session as kssession
+
+                auth_plugin = ksauth.get_plugin_class('password')
+                self._auth = auth_plugin(
+                    auth_url=self.auth_args['auth_url'],
+                    username=self.auth_args['username'],
+                    password=self.auth_args['password'],
+                    project_name=self.auth_args['tenant_name'],
+                )
+                self._restore_token()
+                self._session = kssession.Session(auth=self._auth)
+                self._reauth = self._session.invalidate
+                self._session.invalidate = self._invalidate
+                atexit(self._save_token)
+            return self._session
+
+    def _client(self, name, build):
+        with self._lock:
+            if name not in self._clients:
+                self._clients[name] = build()
+            return self._clients[name]
+
+    def neutron(self):
+        from neutronclient.v2_0 import client
+        return self._client('neutron', lambda: client.Client(
+            session=self.session,
+            region_name=self.auth_args['region'],
+        ))
+
+    def nova(self):
+        from novaclient import client
+        return self._client('nova', lambda: client.Client(
+            version='2',
+            session=self.session,
+            region_name=self.auth_args['region'],
+        ))
+
+    def glance(self):
+        from glanceclient.v2.client import Client
+        return self._client('glance', lambda: Client(session=self.session))
+
+
+_client_factories = {}
+_client_factories_lock = threading.Lock()
+
+
+def get_client_factory(auth_args):
+    """The ClientFactory for auth_args, shared for the rest of the hook"""
+    key = json.dumps(auth_args, sort_keys=True)
+    with _client_factories_lock:
+        if key not in _client_factories:
+            _client_factories[key] = ClientFactory(auth_args)
+        return _client_factories[key]
+
+
+def get_neutronclient(auth_args):
+    return get_client_factory(auth_args).neutron()
+
+
+def get_keystone_session(auth_args):
+    return get_client_factory(auth_args).session
 
 
 def get_novaclient(auth_args):
-    from novaclient import client
-    ks_session = get_keystone_session(auth_args)
-    nc = client.Client(
-        version='2',
-        session=ks_session,
-        region_name=config('region'),
-    )
-    return nc
+    return get_client_factory(auth_args).nova()
 
 
 def get_glanceclient(auth_args):
-    from glanceclient.v2.client import Client
-    ks_session = get_keystone_session(auth_args)
-    return Client(session=ks_session)
+    return get_client_factory(auth_args).glance()
+
+
+class ImageStream(object):
+    """Streams an appliance image over HTTP.
+
+    Iterating over the stream yields the image in chunks as they are
+    downloaded, so it can be handed to glance as image data directly. Each
+    chunk is hashed and appended to a spool file on the way through.
+
+    If a spool file is left over from an interrupted transfer, it is
+    replayed and only the rest of the image is requested, using an HTTP
+    Range request guarded by If-Range on the validator (ETag or
+    Last-Modified) of the earlier response. Connections dropped mid-stream
+    are resumed the same way, up to DOWNLOAD_RETRY_MAX times. Servers that
+    ignore the Range header are handled by starting over or skipping
+    ahead, respectively.
+    """
+
+    def __init__(self, url, spool, validator=None):
+        self.url = url
+        self.spool = spool
+        self.validator = validator
+        self.md5 = hashlib.md5()
+        self.size = 0
+        self.total = None
+
+    @property
+    def checksum(self):
+        return self.md5.hexdigest()
+
+    def _open(self, offset):
+        """Request the image from offset onwards.
+
+        :returns: the response, and whether it starts at offset rather than
+                  at the beginning of the image. None if the server has
+                  nothing past offset.
+        """
+        req = Request(self.url)
+        if offset:
+            req.add_header('Range', 'bytes=%d-' % offset)
+            if self.validator:
+                req.add_header('If-Range', self.validator)
+        try:
+            resp = urlopen(req, timeout=DOWNLOAD_TIMEOUT)
+        except HTTPError as e:
+            if offset and e.code == 416:
+                return None, True
+            raise
+        ranged = bool(offset) and resp.getcode() == 206
+        headers = resp.info()
+        length = headers.get('Content-Length')
+        if length is not None:
+            self.total = int(length) + (offset if ranged else 0)
+        self.validator = (headers.get('ETag') or
+                          headers.get('Last-Modified') or self.validator)
+        return resp, ranged
+
+    def _consume(self, chunk):
+        self.md5.update(chunk)
+        self.size += len(chunk)
+        return chunk
+
+    def _reopen(self, resp):
+        """Reconnect after a failed read, positioned at the current size"""
+        if resp is not None:
+            resp.close()
+        resp, ranged = self._open(self.size)
+        if resp is not None and not ranged:
+            remaining = self.size
+            while remaining:
+                skipped = resp.read(min(remaining, DOWNLOAD_CHUNK_SIZE))
+                if not skipped:
+                    raise IOError('Short read skipping to offset %s of %s' %
+                                  (self.size, self.url))
+                remaining -= len(skipped)
+        return resp
+
+    def __iter__(self):
+        offset = 0
+        if os.path.isfile(self.spool):
+            offset = os.path.getsize(self.spool)
+        resp, ranged = self._open(offset)
+        if offset and ranged:
+            juju_log('Resuming download of %s at %s bytes' %
+                     (self.url, offset))
+            with open(self.spool, 'rb') as spooled:
+                for chunk in iter(
+                        lambda: spooled.read(DOWNLOAD_CHUNK_SIZE), b''):
+                    yield self._consume(chunk)
+            mode = 'ab'
+        else:
+            juju_log('Downloading %s' % self.url)
+            mode = 'wb'
+
+        retries = 0
+        with open(self.spool, mode) as out:
+            while resp is not None:
+                try:
+                    chunk = resp.read(DOWNLOAD_CHUNK_SIZE)
+                    if not chunk and self.total and self.size < self.total:
+                        raise IOError('Connection closed at %s of %s bytes' %
+                                      (self.size, self.total))
+                except (IOError, http_client.HTTPException) as e:
+                    retries += 1
+                    if retries > DOWNLOAD_RETRY_MAX:
+                        raise
+                    juju_log('Download of %s interrupted at %s bytes, '
+                             'resuming (%s/%s): %s' %
+                             (self.url, self.size, retries,
+                              DOWNLOAD_RETRY_MAX, e))
+                    resp = self._reopen(resp)
+                    continue
+                if not chunk:
+                    resp.close()
+                    break
+                out.write(chunk)
+                yield self._consume(chunk)
+
+        juju_log('Downloaded %s bytes from %s (md5 %s)' %
+                 (self.size, self.url, self.checksum))
+
+
+def _appliance_spool(img_name):
+    if not os.path.isdir(APPLIANCE_DOWNLOAD_DIR):
+        os.makedirs(APPLIANCE_DOWNLOAD_DIR)
+    return os.path.join(APPLIANCE_DOWNLOAD_DIR, img_name)
 
 
 def get_appliance_image(img_loc):
-    juju_log('Downloading astara appliance from %s' % img_loc)
+    """Downloads the appliance image, resuming an earlier partial download.
+
+    :returns: the path of the downloaded image.
+    """
     img_name = img_loc.split('/')[-1]
-    subprocess.check_output([
-        'wget', '-O', '/tmp/%s' % img_name, img_loc
-    ])
+    stream = ImageStream(img_loc, _appliance_spool(img_name))
+    for _ in stream:
+        pass
+    return stream.spool
 
 
-def _cache_img(img):
-    with open(GLANCE_IMG_ID_CACHE, 'w') as out:
-        out.write(img['id'])
+def find_appliance_image(client, img_name, checksum=None):
+    """Finds an active glance image by name and, if given, checksum.
+
+    The name is filtered on by glance rather than listing every image.
+    """
+    for img in client.images.list(filters={'name': img_name}):
+        if img.get('status') != 'active':
+            continue
+        if checksum and img.get('checksum') != checksum:
+            continue
+        return img
 
 
 def appliance_image():
@@ -339,105 +824,296 @@ def appliance_image():
     return img_name, img_loc
 
 
+def raw_image_name(img_name):
+    return '%s.raw' % os.path.splitext(img_name)[0]
+
+
+def appliance_raw_required():
+    """Whether a raw copy of the appliance image should be published.
+
+    Nova can only clone an RBD backed image in place if it is raw, qcow2
+    images are downloaded and converted on every boot instead. A raw copy
+    is published when configured to, or when glance advertises rbd as its
+    backend on the image-service relation.
+    """
+    if config('astara-router-appliance-raw'):
+        return True
+    for rid in relation_ids('image-service'):
+        for unit in related_units(rid):
+            backend = relation_get('glance-backend', rid=rid, unit=unit)
+            if backend == 'rbd':
+                return True
+    return False
+
+
 def publish_astara_appliance_image():
     """Downloads and publishes the appliance image into Glance
 
-    If an image by the same name exists already, we do not publish.
+    If an active image by the same name exists already, we do not publish.
+    When the checksum of the image is known, either from configuration or
+    from an earlier download of the same URL, the existing image must also
+    match it.
+
+    The image is streamed into glance as it is downloaded, and the checksum
+    glance reports for the upload is verified against the downloaded data.
+
+    If a raw copy is required (see appliance_raw_required), the qcow2 image
+    is then converted and published as raw too.
 
     If we do not yet have a populated identity-service relation, this does
     nothing.
 
-    In any case, the published or found image is cached locally to avoid
+    In any case, the published or found images are cached locally to avoid
     glance calls in the future.
 
-    Note: We're currently publishing qcow2's and will need to make this
-    flexible to do a conversion and publish in raw for Ceph backed clouds.
+    :returns: the id of the raw image if one is required, otherwise that of
+              the qcow2 image.
     """
     auth_args = _auth_args()
     if not auth_args:
         return
-    client = get_glanceclient(auth_args)
-    ensure_client_connectivity(client.images.list)
-
-    img_name, img_loc = appliance_image()
+    img_ids = _run_task(_image_task(auth_args))
+    return img_ids.get('raw-image') or img_ids['image']
 
-    for img in client.images.list():
-        if img['name'] == img_name:
-            _cache_img(img)
-            juju_log(
-                'Image named %s already exists in glance, skipping publish.' %
-                img_name)
-            return
 
-    juju_log('Downloading astara appliance from %s' % img_loc)
-    subprocess.check_output([
-        'wget', '-O', '/tmp/%s' % img_name, img_loc
-    ])
+def _image_task(auth_args):
+    """The (run, save) pair publishing the appliance image, see
+    provision()
 
-    juju_log('Publishing appliance image into glance')
+    The task returns the ids of the published images, keyed on their kind
+    in the ResourceCache.
+    """
+    client = get_glanceclient(auth_args)
+    img_name, img_loc = appliance_image()
+    raw_required = appliance_raw_required()
+    checksum = config('astara-router-appliance-checksum')
+    inputs = _image_inputs()
+    db = unitdata.kv()
+    known = db.get(APPLIANCE_KEY % img_loc) or {}
+
+    def run():
+        ensure_api_ready(auth_args, 'image')
+        img_ids = {}
+        img_ids['image'] = _publish_qcow2_image(
+            client, img_name, img_loc, known, checksum,
+            keep_spool=raw_required)
+        if raw_required:
+            img_ids['raw-image'] = publish_raw_appliance_image(
+                client, img_ids['image'], img_name, known)
+        return img_ids
+
+    def save(img_ids):
+        # Saved whether or not publishing succeeded, so that the next
+        # attempt can resume the download
+        db.set(APPLIANCE_KEY % img_loc, known)
+        db.flush()
+        for kind, img_id in (img_ids or {}).items():
+            ResourceCache().set(kind, inputs, img_id)
+
+    return run, save
+
+
+def _publish_qcow2_image(client, img_name, img_loc, known, checksum=None,
+                         keep_spool=False):
+    """Publishes the qcow2 appliance image unless glance has it already.
+
+    :param known: dict of what we know about the image at img_loc, which is
+                  updated with what is learnt on the way.
+    :param checksum: str expected md5 of the image, if known from
+                     configuration.
+    :returns: the id of the glance image.
+    """
+    checksum = checksum or known.get('checksum')
+
+    img = find_appliance_image(client, img_name, checksum)
+    if img:
+        juju_log(
+            'Image named %s already exists in glance, skipping publish.' %
+            img_name)
+        return img['id']
+
+    juju_log('Publishing appliance image from %s into glance' % img_loc)
+    stream = ImageStream(img_loc, _appliance_spool(img_name),
+                         validator=known.get('validator'))
     glance_img = client.images.create(
         name=img_name,
         container_format='bare',
         disk_format='qcow2')
-    client.images.upload(
-        image_id=glance_img['id'],
-        image_data=open('/tmp/%s' % img_name))
+    try:
+        client.images.upload(image_id=glance_img['id'], image_data=stream)
+        if checksum and stream.checksum != checksum:
+            # The spooled data is bad, do not resume from it.
+            os.unlink(stream.spool)
+            raise Exception(
+                'Checksum mismatch for %s: expected %s, downloaded %s' %
+                (img_loc, checksum, stream.checksum))
+        uploaded = client.images.get(glance_img['id'])
+        if uploaded.get('checksum') != stream.checksum:
+            raise Exception(
+                'Checksum mismatch for glance image %s: expected %s, got %s' %
+                (glance_img['id'], stream.checksum, uploaded.get('checksum')))
+    except Exception:
+        juju_log('Failed to publish appliance image, removing %s' %
+                 glance_img['id'])
+        client.images.delete(glance_img['id'])
+        # Remember the validator so the next attempt can resume the download
+        known['validator'] = stream.validator
+        raise
+
+    # Anything known about an earlier image, such as the checksum of its
+    # raw copy, no longer applies.
+    known.clear()
+    known.update({'validator': stream.validator,
+                  'checksum': stream.checksum,
+                  'size': stream.size})
+    if not keep_spool:
+        os.unlink(stream.spool)
+
+    return glance_img['id']
+
+
+def _file_chunks(path, md5):
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+            md5.update(chunk)
+            yield chunk
+
+
+def publish_raw_appliance_image(client, img_id, img_name, known):
+    """Converts the qcow2 appliance image to raw and publishes it
+
+    The qcow2 image is taken from the download spool if it holds the
+    complete image, otherwise it is streamed back out of glance. The
+    converted image is named after the qcow2 one with a .raw extension, and
+    is skipped if glance already has it.
+
+    :param known: dict of what we know about the qcow2 image, which is
+                  updated with the checksum of the raw one.
+    :returns: the id of the raw glance image.
+    """
+    raw_name = raw_image_name(img_name)
+
+    img = find_appliance_image(client, raw_name, known.get('raw_checksum'))
+    if img:
+        juju_log(
+            'Image named %s already exists in glance, skipping publish.' %
+            raw_name)
+        return img['id']
+
+    spool = _appliance_spool(img_name)
+    if not (os.path.isfile(spool) and
+            os.path.getsize(spool) == known.get('size')):
+        juju_log('Fetching %s from glance for conversion' % img_name)
+        with open(spool, 'wb') as out:
+            for chunk in client.images.data(img_id):
+                out.write(chunk)
+
+    # qemu-img leaves zeroed ranges as holes in the raw file, so the
+    # conversion needs little more disk space than the qcow2 image.
+    raw = _appliance_spool(raw_name)
+    juju_log('Converting %s to raw' % img_name)
+    subprocess.check_call(['qemu-img', 'convert', '-f', 'qcow2',
+                           '-O', 'raw', spool, raw])
+
+    juju_log('Publishing raw appliance image into glance')
+    md5 = hashlib.md5()
+    glance_img = client.images.create(
+        name=raw_name,
+        container_format='bare',
+        disk_format='raw')
+    try:
+        client.images.upload(image_id=glance_img['id'],
+                             image_data=_file_chunks(raw, md5))
+        uploaded = client.images.get(glance_img['id'])
+        if uploaded.get('checksum') != md5.hexdigest():
+            raise Exception(
+                'Checksum mismatch for glance image %s: expected %s, got %s' %
+                (glance_img['id'], md5.hexdigest(), uploaded.get('checksum')))
+    except Exception:
+        juju_log('Failed to publish raw appliance image, removing %s' %
+                 glance_img['id'])
+        client.images.delete(glance_img['id'])
+        raise
+    finally:
+        os.unlink(raw)
+
+    known['raw_checksum'] = md5.hexdigest()
+    os.unlink(spool)
 
-    _cache_img(glance_img)
     return glance_img['id']
 
 
 def appliance_image_uuid():
-    """Returns the UUID of the published appliance image"""
-    if os.path.isfile(GLANCE_IMG_ID_CACHE):
-        return open(GLANCE_IMG_ID_CACHE).read().strip()
-    else:
-        return publish_astara_appliance_image()
+    """Returns the UUID of the published appliance image
+
+    This is the raw copy of the image where one is required.
+    """
+    kind = 'raw-image' if appliance_raw_required() else 'image'
+    img_id = ResourceCache().get(kind, _image_inputs(),
+                                 validate=_image_exists)
+    return img_id or publish_astara_appliance_image()
 
 
 def create_astara_nova_flavor():
     """Gets or creates the astara appliance nova flavor
 
     Get or create the nova flavor for the appliance. Cache it
-    locally and return its id.
+    in the ResourceCache and return its id.
 
     :returns: str id of the nova flavor
     """
     auth_args = _auth_args()
     if not auth_args:
         return
+    return _run_task(_flavor_task(auth_args))
+
+
+def _flavor_task(auth_args):
+    """The (run, save) pair creating the appliance flavor, see
+    provision()"""
     novaclient = get_novaclient(auth_args)
-    existing = [f for f in novaclient.flavors.list()
-                if f.name == ASTARA_FLAVOR_NAME]
-    if existing:
-        flavor = existing[0]
-    else:
-        flavor = novaclient.flavors.create(
+    inputs = _flavor_inputs()
+
+    def run():
+        # Nova cannot filter flavors by name, but the summary listing only
+        # carries ids and names.
+        existing = [f for f in novaclient.flavors.list(detailed=False)
+                    if f.name == ASTARA_FLAVOR_NAME]
+        if existing:
+            return existing[0].id
+        return novaclient.flavors.create(
             name=ASTARA_FLAVOR_NAME,
-            ram=int(config('astara-appliance-flavor-ram')),
-            disk=int(config('astara-appliance-flavor-disk')),
-            vcpus=int(config('astara-appliance-flavor-cpu')),
-        )
-    with open(NOVA_FLAVOR_ID_CACHE, 'w') as out:
-        out.write(flavor.id)
+            ram=int(inputs['ram']),
+            disk=int(inputs['disk']),
+            vcpus=int(inputs['vcpus']),
+        ).id
+
+    def save(flavor_id):
+        if flavor_id is not None:
+            ResourceCache().set('flavor', inputs, flavor_id)
 
-    return flavor.id
+    return run, save
 
 
 def appliance_flavor_id():
-    if os.path.isfile(NOVA_FLAVOR_ID_CACHE):
-        return open(NOVA_FLAVOR_ID_CACHE).read().strip()
-    else:
-        return create_astara_nova_flavor()
+    flavor_id = ResourceCache().get('flavor', _flavor_inputs(),
+                                    validate=_flavor_exists)
+    return flavor_id or create_astara_nova_flavor()
 
 
-def get_network(net_type='management'):
-    """Returns the dict of network + subnet data for the management network"""
-    if os.path.isfile(ASTARA_NETWORK_CACHE):
-        net_data = json.loads(open(ASTARA_NETWORK_CACHE).read())
-    else:
+def get_networks():
+    """Returns the cached network and subnet data, creating the networks if
+    there is none"""
+    net_data = ResourceCache().get('networks', _network_inputs(),
+                                   validate=_networks_exist)
+    if net_data is None:
         net_data = create_networks()
+    return net_data
 
+
+def get_network(net_type='management'):
+    """Returns the dict of network + subnet data for the management network"""
+    net_data = get_networks()
     if not net_data:
         return {}
 
@@ -457,6 +1133,134 @@ def get_network(net_type='management'):
     }
 
 
+def _pending_task(kind, inputs, validate, build):
+    if ResourceCache().get(kind, inputs, validate=validate) is not None:
+        return None
+    auth_args = _auth_args()
+    if not auth_args:
+        return None
+    return build(auth_args)
+
+
+def networks_task():
+    """The provision() task creating the networks, or None if they are
+    cached or the identity-service relation is not complete yet"""
+    return _pending_task('networks', _network_inputs(), _networks_exist,
+                         _networks_task)
+
+
+def image_task():
+    """The provision() task publishing the appliance image, or None if it
+    is cached or the identity-service relation is not complete yet"""
+    kind = 'raw-image' if appliance_raw_required() else 'image'
+    return _pending_task(kind, _image_inputs(), _image_exists, _image_task)
+
+
+def flavor_task():
+    """The provision() task creating the appliance flavor, or None if it
+    is cached or the identity-service relation is not complete yet"""
+    return _pending_task('flavor', _flavor_inputs(), _flavor_exists,
+                         _flavor_task)
+
+
+def _run_task(task):
+    """Runs a (run, save) task in the calling thread"""
+    run, save = task
+    value = None
+    try:
+        value = run()
+    finally:
+        save(value)
+    return value
+
+
+def _run_provision_task(run):
+    """Runs a task in a provisioning thread.
+
+    :returns: dict of the task's value or the error it raised, how long it
+              took and the messages it logged.
+    """
+    _task_log.messages = []
+    started = time.time()
+    outcome = {}
+    try:
+        outcome['value'] = run()
+    except Exception as e:
+        outcome['error'] = str(e)
+        outcome['traceback'] = traceback.format_exc()
+    finally:
+        outcome['duration'] = time.time() - started
+        outcome['messages'] = _task_log.messages
+        del _task_log.messages
+    return outcome
+
+
+def provision(tasks):
+    """Runs provisioning tasks concurrently.
+
+    Creating the networks, publishing the appliance image and creating its
+    flavor talk to different services and do not depend on one another, so
+    they run side by side in a pool of threads.
+
+    Each task is a (run, save) pair, as returned by networks_task(),
+    image_task() and flavor_task(). Everything that needs relation data,
+    config or unitdata is resolved before the pool starts, and run() only
+    talks to the remote APIs. Once every task has ended, the main thread
+    writes out what the tasks logged and calls save() with the value each
+    run() returned, or None if it failed, so that what was provisioned is
+    cached in the ResourceCache. After a failure the next hook therefore
+    only repeats the tasks that did not finish. The outcome of each task is
+    recorded in unitdata under PROVISION_KEY.
+
+    :param tasks: dict mapping task names to (run, save) pairs; tasks that
+                  are None are skipped.
+    :raises: Exception naming the failed tasks, once every task has ended
+    """
+    tasks = dict((name, task) for name, task in tasks.items() if task)
+    if not tasks:
+        return
+    # Start the shared budget for waiting on the APIs here, not in a thread
+    _client_ready_deadline()
+    pool = ThreadPool(len(tasks))
+    try:
+        pending = dict((name, pool.apply_async(_run_provision_task, (run,)))
+                       for name, (run, save) in tasks.items())
+    finally:
+        pool.close()
+        pool.join()
+
+    db = unitdata.kv()
+    failed = []
+    for name in sorted(tasks):
+        outcome = pending[name].get()
+        for message, level in outcome['messages']:
+            juju_log(message, level)
+        save = tasks[name][1]
+        if 'error' in outcome:
+            failed.append(name)
+            juju_log('Provisioning %s failed: %s' %
+                     (name, outcome['traceback']), level=ERROR)
+            db.set(PROVISION_KEY % name, {'status': 'failed',
+                                          'error': outcome['error'],
+                                          'duration': outcome['duration']})
+            save(None)
+        else:
+            juju_log('Provisioned %s in %.1fs' % (name, outcome['duration']))
+            db.set(PROVISION_KEY % name, {'status': 'done',
+                                          'duration': outcome['duration']})
+            save(outcome['value'])
+    db.flush()
+
+    # Tokens keystone rejected during the tasks could not be discarded from
+    # the provisioning threads
+    for factory in list(_client_factories.values()):
+        if factory._rejected:
+            factory._save_token()
+
+    if failed:
+        raise Exception('Failed to provision: %s' % ', '.join(failed))
+
+
 def api_extensions_path():
     """Return need the full path to the installation of neutron API extensions
     This is dependent on how the library was installed (git vs pkg)
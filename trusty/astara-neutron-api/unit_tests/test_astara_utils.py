@@ -0,0 +1,632 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+
+from keystoneclient import access
+from mock import patch, MagicMock
+from six.moves import BaseHTTPServer
+
+from charmhelpers.core import unitdata
+from test_utils import CharmTestCase
+
+import astara_utils
+
+juju_log = astara_utils.juju_log
+
+TO_PATCH = [
+    'atexit',
+    'config',
+    'juju_log',
+]
+
+IMAGE = bytes(bytearray(i % 251 for i in range(10000)))
+IMAGE_MD5 = hashlib.md5(IMAGE).hexdigest()
+
+
+class ImageHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves IMAGE, honouring Range requests unless told not to"""
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append(dict(self.headers))
+        rng = self.headers.get('Range')
+        if rng and server.ranges:
+            start = int(rng.split('=')[1].rstrip('-'))
+            if start >= len(IMAGE):
+                self.send_response(416)
+                self.end_headers()
+                return
+            self.send_response(206)
+            body = IMAGE[start:]
+        else:
+            self.send_response(200)
+            body = IMAGE
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', '"appliance"')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeImages(object):
+    """Just enough of the glance v2 images API to publish an image"""
+
+    def __init__(self, existing=None):
+        self.existing = existing or []
+        self.uploaded = {}
+        self.deleted = []
+
+    def list(self, filters=None):
+        return [img for img in self.existing
+                if img['name'] == filters['name']]
+
+    def create(self, name, container_format, disk_format):
+        return {'id': '%s-id' % name, 'name': name}
+
+    def upload(self, image_id, image_data):
+        self.uploaded[image_id] = b''.join(image_data)
+
+    def get(self, image_id):
+        data = self.uploaded.get(image_id, b'')
+        return {'id': image_id, 'checksum': hashlib.md5(data).hexdigest()}
+
+    def data(self, image_id):
+        return iter([IMAGE[:4096], IMAGE[4096:]])
+
+    def delete(self, image_id):
+        self.deleted.append(image_id)
+
+
+class AstaraUtilsTestCase(CharmTestCase):
+
+    def setUp(self):
+        super(AstaraUtilsTestCase, self).setUp(astara_utils, TO_PATCH)
+        self.config.side_effect = self.test_config.get
+        self.db = unitdata.Storage(':memory:')
+        self.patch('unitdata').kv.return_value = self.db
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        _m = patch.object(astara_utils, 'APPLIANCE_DOWNLOAD_DIR', self.tmpdir)
+        _m.start()
+        self.addCleanup(_m.stop)
+
+
+class ResourceCacheTestCase(AstaraUtilsTestCase):
+
+    def setUp(self):
+        super(ResourceCacheTestCase, self).setUp()
+        self.time = self.patch('time')
+        self.time.time.return_value = 1000
+        self.cache = astara_utils.ResourceCache()
+        self.inputs = {'url': 'http://example.com/appliance.qcow2'}
+        self.cache.set('image', self.inputs, 'img-id')
+        self.validate = MagicMock(return_value=True)
+
+    def get(self):
+        return self.cache.get('image', self.inputs, validate=self.validate)
+
+    def test_ttl_from_config(self):
+        self.test_config.set('resource-cache-ttl', 60)
+        self.assertEqual(astara_utils.ResourceCache().ttl, 60)
+
+    def test_hit_within_ttl(self):
+        self.time.time.return_value = 1000 + 3599
+        self.assertEqual(self.get(), 'img-id')
+        self.assertFalse(self.validate.called)
+
+    def test_inputs_changed(self):
+        self.inputs['url'] = 'http://example.com/other.qcow2'
+        self.assertIsNone(self.get())
+        self.assertFalse(self.validate.called)
+
+    def test_expired_revalidated(self):
+        self.time.time.return_value = 1000 + 3600
+        self.assertEqual(self.get(), 'img-id')
+        self.validate.assert_called_with('img-id')
+        # Trusted for another ttl from now on
+        self.validate.reset_mock()
+        self.time.time.return_value = 1000 + 3600 + 3599
+        self.assertEqual(self.get(), 'img-id')
+        self.assertFalse(self.validate.called)
+
+    def test_expired_not_found_evicted(self):
+        # Validators return False when the API answers 404 for the id
+        self.validate.return_value = False
+        self.time.time.return_value = 1000 + 3600
+        self.assertIsNone(self.get())
+        self.assertIsNone(
+            self.db.get(astara_utils.RESOURCE_CACHE_KEY % 'image'))
+
+    def test_expired_validation_failed(self):
+        self.validate.side_effect = Exception('API unavailable')
+        self.time.time.return_value = 1000 + 3600
+        self.assertEqual(self.get(), 'img-id')
+        # Checked again next time
+        self.validate.side_effect = None
+        self.validate.reset_mock()
+        self.get()
+        self.assertTrue(self.validate.called)
+
+
+def auth_args(**kwargs):
+    args = {
+        'username': 'astara',
+        'password': 'secret',
+        'tenant_name': 'services',
+        'auth_url': 'http://keystone:5000/v2.0',
+        'auth_strategy': 'keystone',
+        'region': 'RegionOne',
+    }
+    args.update(kwargs)
+    return args
+
+
+def auth_ref(token, expires='2099-01-01T00:00:00Z'):
+    return access.AccessInfo.factory(
+        body={'access': {'token': {'id': token, 'expires': expires}}},
+        auth_token=token)
+
+
+class ClientFactoryTestCase(AstaraUtilsTestCase):
+
+    def authenticate(self, factory, token):
+        factory.session
+        factory._auth.auth_ref = auth_ref(token)
+        factory._save_token()
+
+    def restored(self, factory):
+        factory.session
+        ref = factory._auth.auth_ref
+        return ref and ref.auth_token
+
+    def test_token_saved_and_restored(self):
+        factory = astara_utils.ClientFactory(auth_args())
+        self.authenticate(factory, 'tok')
+        self.atexit.assert_called_with(factory._save_token)
+        factory = astara_utils.ClientFactory(auth_args())
+        self.assertEqual(self.restored(factory), 'tok')
+
+    def test_expiring_token_not_restored(self):
+        factory = astara_utils.ClientFactory(auth_args())
+        factory.session
+        factory._auth.auth_ref = auth_ref('tok', '2000-01-01T00:00:00Z')
+        factory._save_token()
+        factory = astara_utils.ClientFactory(auth_args())
+        self.assertIsNone(self.restored(factory))
+
+    def test_token_per_credentials(self):
+        self.authenticate(astara_utils.ClientFactory(auth_args()), 'tok')
+        self.authenticate(astara_utils.ClientFactory(
+            auth_args(tenant_name='admin')), 'admin-tok')
+        for args in [auth_args(username='other'),
+                     auth_args(auth_url='http://other:5000/v2.0')]:
+            self.assertIsNone(
+                self.restored(astara_utils.ClientFactory(args)))
+        self.assertEqual(
+            self.restored(astara_utils.ClientFactory(auth_args())), 'tok')
+        self.assertEqual(
+            self.restored(astara_utils.ClientFactory(
+                auth_args(tenant_name='admin'))), 'admin-tok')
+
+    def test_rejected_token_discarded(self):
+        self.authenticate(astara_utils.ClientFactory(auth_args()), 'tok')
+        factory = astara_utils.ClientFactory(auth_args())
+        self.assertEqual(self.restored(factory), 'tok')
+        # What the Session does on a 401 before authenticating again
+        self.assertTrue(factory.session.invalidate())
+        self.assertIsNone(factory._auth.auth_ref)
+        factory = astara_utils.ClientFactory(auth_args())
+        self.assertIsNone(self.restored(factory))
+
+    def test_rejected_token_replaced(self):
+        self.authenticate(astara_utils.ClientFactory(auth_args()), 'tok')
+        factory = astara_utils.ClientFactory(auth_args())
+        factory.session.invalidate()
+        self.authenticate(factory, 'new-tok')
+        factory = astara_utils.ClientFactory(auth_args())
+        self.assertEqual(self.restored(factory), 'new-tok')
+
+    def test_rejected_in_thread_discarded_at_exit(self):
+        self.authenticate(astara_utils.ClientFactory(auth_args()), 'tok')
+        factory = astara_utils.ClientFactory(auth_args())
+        factory.session
+        thread = threading.Thread(target=factory.session.invalidate)
+        thread.start()
+        thread.join()
+        self.assertEqual(
+            self.restored(astara_utils.ClientFactory(auth_args())), 'tok')
+        factory._save_token()
+        self.assertIsNone(
+            self.restored(astara_utils.ClientFactory(auth_args())))
+
+
+class EnsureAPIReadyTestCase(AstaraUtilsTestCase):
+
+    def setUp(self):
+        super(EnsureAPIReadyTestCase, self).setUp()
+        for name, value in [('_ready_deadline', []),
+                            ('_ready_endpoints', set())]:
+            _m = patch.object(astara_utils, name, value)
+            _m.start()
+            self.addCleanup(_m.stop)
+        self.now = 1000.0
+        self.sleeps = []
+        self.time = self.patch('time')
+        self.time.time.side_effect = lambda: self.now
+        self.time.sleep.side_effect = self.sleep
+        # Always the longest delay the jitter allows
+        self.patch('random').uniform.side_effect = lambda low, high: high
+        self.session = self.patch('get_keystone_session').return_value
+        self.session.get_endpoint.side_effect = (
+            lambda service_type, region_name: 'http://%s:80' % service_type)
+        self.status = []
+        self.session.get.side_effect = self.get
+
+    def sleep(self, delay):
+        self.sleeps.append(delay)
+        self.now += delay
+
+    def get(self, endpoint, authenticated, raise_exc):
+        status = self.status.pop(0) if self.status else 503
+        return MagicMock(status_code=status)
+
+    def test_backoff_delays(self):
+        delays = astara_utils._backoff_delays()
+        self.assertEqual([next(delays) for _ in range(8)],
+                         [0.5, 1, 2, 4, 8, 8, 8, 8])
+
+    def test_backoff_delays_jitter(self):
+        uniform = astara_utils.random.uniform
+        uniform.side_effect = None
+        uniform.return_value = 0.1
+        delays = astara_utils._backoff_delays()
+        self.assertEqual([next(delays) for _ in range(6)], [0.1] * 6)
+        self.assertEqual([c[0] for c in uniform.call_args_list],
+                         [(0, 0.5), (0, 1), (0, 2), (0, 4), (0, 8), (0, 8)])
+
+    def test_ready(self):
+        self.status = [503, 502, 503, 404]
+        astara_utils.ensure_api_ready(auth_args(), 'image')
+        self.assertEqual(self.sleeps, [0.5, 1, 2])
+        # Not probed again for the rest of the hook
+        astara_utils.ensure_api_ready(auth_args(), 'image')
+        self.assertEqual(self.session.get.call_count, 4)
+        self.session.get.assert_called_with(
+            'http://image:80', authenticated=False, raise_exc=False)
+
+    def test_deadline_reached(self):
+        self.assertRaises(Exception, astara_utils.ensure_api_ready,
+                          auth_args(), 'network')
+        self.assertEqual(self.sleeps,
+                         [0.5, 1, 2, 4, 8, 8, 8, 8, 8, 8, 4.5])
+        self.assertEqual(self.now, 1000 + astara_utils.CLIENT_READY_TIMEOUT)
+        self.assertEqual(self.session.get.call_count, 12)
+
+    def test_deadline_shared(self):
+        self.status = [503, 503, 503, 503, 503, 200]
+        astara_utils.ensure_api_ready(auth_args(), 'network')
+        self.assertEqual(sum(self.sleeps), 15.5)
+        self.sleeps = []
+        self.assertRaises(Exception, astara_utils.ensure_api_ready,
+                          auth_args(), 'image')
+        # What is left of the budget, rather than another full timeout
+        self.assertEqual(sum(self.sleeps), 60 - 15.5)
+
+
+class ImageStreamTestCase(AstaraUtilsTestCase):
+
+    def setUp(self):
+        super(ImageStreamTestCase, self).setUp()
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0),
+                                                ImageHandler)
+        self.server.requests = []
+        self.server.ranges = True
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  args=(0.05,))
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = 'http://127.0.0.1:%s/appliance.qcow2' % (
+            self.server.server_address[1])
+        self.spool = os.path.join(self.tmpdir, 'appliance.qcow2')
+
+    def spool_with(self, data):
+        with open(self.spool, 'wb') as f:
+            f.write(data)
+
+    def stream(self, validator=None):
+        stream = astara_utils.ImageStream(self.url, self.spool, validator)
+        data = b''.join(stream)
+        with open(self.spool, 'rb') as f:
+            self.assertEqual(f.read(), IMAGE)
+        return stream, data
+
+    def test_download(self):
+        stream, data = self.stream()
+        self.assertEqual(data, IMAGE)
+        self.assertEqual(stream.checksum, IMAGE_MD5)
+        self.assertEqual(stream.validator, '"appliance"')
+        self.assertNotIn('range', self.server.requests[0])
+
+    def test_resume_partial_spool(self):
+        self.spool_with(IMAGE[:3000])
+        stream, data = self.stream(validator='"appliance"')
+        self.assertEqual(data, IMAGE)
+        self.assertEqual(stream.size, len(IMAGE))
+        self.assertEqual(stream.checksum, IMAGE_MD5)
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(self.server.requests[0]['range'], 'bytes=3000-')
+        self.assertEqual(self.server.requests[0]['if-range'], '"appliance"')
+
+    def test_range_ignored_restarts(self):
+        self.server.ranges = False
+        self.spool_with(b'stale data, not part of the image')
+        stream, data = self.stream()
+        self.assertEqual(data, IMAGE)
+        self.assertEqual(stream.checksum, IMAGE_MD5)
+        self.assertEqual(self.server.requests[0]['range'], 'bytes=33-')
+
+    def test_spool_complete(self):
+        self.spool_with(IMAGE)
+        stream, data = self.stream()
+        self.assertEqual(data, IMAGE)
+        self.assertEqual(stream.checksum, IMAGE_MD5)
+        self.assertEqual(self.server.requests[0]['range'],
+                         'bytes=%s-' % len(IMAGE))
+
+    def test_resume_after_dropped_connection(self):
+        resp = MagicMock()
+        resp.read.side_effect = [IMAGE[:1000], IOError('reset')]
+        real_open = astara_utils.ImageStream._open
+        calls = []
+
+        def _open(stream, offset):
+            calls.append(offset)
+            if not offset:
+                stream.total = len(IMAGE)
+                return resp, False
+            return real_open(stream, offset)
+
+        with patch.object(astara_utils.ImageStream, '_open', _open):
+            stream, data = self.stream()
+        self.assertEqual(data, IMAGE)
+        self.assertEqual(calls, [0, 1000])
+        self.assertTrue(resp.close.called)
+
+
+class PublishApplianceImageTestCase(ImageStreamTestCase):
+
+    def setUp(self):
+        super(PublishApplianceImageTestCase, self).setUp()
+        self.client = MagicMock()
+        self.client.images = FakeImages()
+        self.known = {}
+
+    def publish(self, checksum=None, keep_spool=False):
+        return astara_utils._publish_qcow2_image(
+            self.client, 'appliance.qcow2', self.url, self.known, checksum,
+            keep_spool=keep_spool)
+
+    def test_publish(self):
+        self.known['raw_checksum'] = 'of an older image'
+        self.assertEqual(self.publish(), 'appliance.qcow2-id')
+        self.assertEqual(self.client.images.uploaded['appliance.qcow2-id'],
+                         IMAGE)
+        self.assertFalse(os.path.exists(self.spool))
+        self.assertEqual(self.known, {'validator': '"appliance"',
+                                      'checksum': IMAGE_MD5,
+                                      'size': len(IMAGE)})
+
+    def test_publish_keep_spool(self):
+        self.publish(keep_spool=True)
+        self.assertTrue(os.path.exists(self.spool))
+
+    def test_publish_existing(self):
+        self.client.images.existing = [
+            {'id': 'old', 'name': 'appliance.qcow2', 'status': 'active',
+             'checksum': IMAGE_MD5}]
+        self.assertEqual(self.publish(), 'old')
+        self.assertEqual(self.server.requests, [])
+
+    def test_publish_existing_checksum_differs(self):
+        self.client.images.existing = [
+            {'id': 'old', 'name': 'appliance.qcow2', 'status': 'active',
+             'checksum': 'other'}]
+        self.known['checksum'] = IMAGE_MD5
+        self.assertEqual(self.publish(), 'appliance.qcow2-id')
+
+    def test_publish_checksum_mismatch(self):
+        self.assertRaises(Exception, self.publish, checksum='bogus')
+        self.assertEqual(self.client.images.deleted, ['appliance.qcow2-id'])
+        self.assertFalse(os.path.exists(self.spool))
+        self.assertEqual(self.known, {'validator': '"appliance"'})
+
+    def test_publish_upload_failed_keeps_spool(self):
+        self.client.images.get = lambda image_id: {'checksum': 'bogus'}
+        self.assertRaises(Exception, self.publish)
+        self.assertEqual(self.client.images.deleted, ['appliance.qcow2-id'])
+        with open(self.spool, 'rb') as f:
+            self.assertEqual(f.read(), IMAGE)
+
+    @patch.object(astara_utils, 'ensure_api_ready')
+    @patch.object(astara_utils, 'appliance_raw_required')
+    @patch.object(astara_utils, 'get_glanceclient')
+    @patch.object(astara_utils, '_auth_args')
+    def test_publish_astara_appliance_image(self, _auth_args,
+                                            get_glanceclient,
+                                            appliance_raw_required,
+                                            ensure_api_ready):
+        self.test_config.set('astara-router-appliance-url', self.url)
+        get_glanceclient.return_value = self.client
+        appliance_raw_required.return_value = False
+        self.assertEqual(astara_utils.publish_astara_appliance_image(),
+                         'appliance.qcow2-id')
+        self.assertEqual(self.db.get(astara_utils.APPLIANCE_KEY % self.url),
+                         {'validator': '"appliance"',
+                          'checksum': IMAGE_MD5,
+                          'size': len(IMAGE)})
+        self.assertEqual(
+            astara_utils.ResourceCache().get('image',
+                                             astara_utils._image_inputs()),
+            'appliance.qcow2-id')
+
+        # A failed attempt still remembers how to resume the download
+        self.db.unset(astara_utils.APPLIANCE_KEY % self.url)
+        self.client.images.get = lambda image_id: {'checksum': 'bogus'}
+        self.assertRaises(Exception,
+                          astara_utils.publish_astara_appliance_image)
+        self.assertEqual(self.db.get(astara_utils.APPLIANCE_KEY % self.url),
+                         {'validator': '"appliance"'})
+
+
+class PublishRawApplianceImageTestCase(AstaraUtilsTestCase):
+
+    def setUp(self):
+        super(PublishRawApplianceImageTestCase, self).setUp()
+        self.check_call = self.patch('subprocess').check_call
+        self.check_call.side_effect = self.convert
+        self.client = MagicMock()
+        self.client.images = FakeImages()
+        self.spool = os.path.join(self.tmpdir, 'appliance.qcow2')
+        self.raw = os.path.join(self.tmpdir, 'appliance.raw')
+        self.converted = []
+        self.known = {'size': len(IMAGE)}
+
+    def convert(self, cmd):
+        src, dst = cmd[-2:]
+        with open(src, 'rb') as f:
+            self.converted.append(f.read())
+        with open(dst, 'wb') as f:
+            f.write(b'raw:' + IMAGE)
+
+    def publish(self):
+        return astara_utils.publish_raw_appliance_image(
+            self.client, 'qcow2-id', 'appliance.qcow2', self.known)
+
+    def test_publish_from_spool(self):
+        with open(self.spool, 'wb') as f:
+            f.write(IMAGE)
+        self.client.images.data = MagicMock()
+        self.assertEqual(self.publish(), 'appliance.raw-id')
+        self.assertFalse(self.client.images.data.called)
+        self.assertEqual(self.converted, [IMAGE])
+        self.assertEqual(self.client.images.uploaded['appliance.raw-id'],
+                         b'raw:' + IMAGE)
+        self.assertFalse(os.path.exists(self.spool))
+        self.assertFalse(os.path.exists(self.raw))
+        self.assertEqual(
+            self.known,
+            {'size': len(IMAGE),
+             'raw_checksum': hashlib.md5(b'raw:' + IMAGE).hexdigest()})
+
+    def test_publish_from_glance(self):
+        # A partial spool is not converted, glance has the whole image
+        with open(self.spool, 'wb') as f:
+            f.write(IMAGE[:100])
+        self.assertEqual(self.publish(), 'appliance.raw-id')
+        self.assertEqual(self.converted, [IMAGE])
+
+    def test_publish_existing(self):
+        self.client.images.existing = [
+            {'id': 'old', 'name': 'appliance.raw', 'status': 'active'}]
+        self.assertEqual(self.publish(), 'old')
+        self.assertFalse(self.check_call.called)
+
+    def test_publish_checksum_mismatch(self):
+        self.client.images.get = lambda image_id: {'checksum': 'bogus'}
+        self.assertRaises(Exception, self.publish)
+        self.assertEqual(self.client.images.deleted, ['appliance.raw-id'])
+        self.assertFalse(os.path.exists(self.raw))
+        self.assertEqual(self.known, {'size': len(IMAGE)})
+
+
+class ProvisionTestCase(AstaraUtilsTestCase):
+
+    def setUp(self):
+        super(ProvisionTestCase, self).setUp()
+        self.saved = {}
+        self.main = threading.current_thread()
+        # Log through the real juju_log, which queues messages from tasks
+        _m = patch.object(astara_utils, 'juju_log', juju_log)
+        _m.start()
+        self.addCleanup(_m.stop)
+        self.log = self.patch('log')
+        self.log.side_effect = lambda message, level: self.assertIs(
+            threading.current_thread(), self.main)
+
+    def task(self, name, value=None, error=None):
+        def run():
+            self.assertIsNot(threading.current_thread(), self.main)
+            astara_utils.juju_log('%s running' % name)
+            if error:
+                raise Exception(error)
+            return value
+
+        def save(value):
+            self.assertIs(threading.current_thread(), self.main)
+            self.saved[name] = value
+
+        return run, save
+
+    def outcome(self, name):
+        return self.db.get(astara_utils.PROVISION_KEY % name)
+
+    def test_provision(self):
+        astara_utils.provision({
+            'networks': self.task('networks', {'networks': []}),
+            'image': self.task('image', {'image': 'img-id'}),
+            'flavor': None,
+        })
+        self.assertEqual(self.saved, {'networks': {'networks': []},
+                                      'image': {'image': 'img-id'}})
+        self.assertEqual(self.outcome('networks')['status'], 'done')
+        self.assertEqual(self.outcome('image')['status'], 'done')
+        self.assertIsNone(self.outcome('flavor'))
+        # Logged from the main thread once the tasks ended
+        self.log.assert_any_call('networks running', None)
+
+    def test_provision_failed_task_keeps_other_results(self):
+        with self.assertRaises(Exception) as e:
+            astara_utils.provision({
+                'networks': self.task('networks', {'networks': []}),
+                'image': self.task('image', error='glance is down'),
+                'flavor': self.task('flavor', 'flavor-id'),
+            })
+        self.assertEqual(str(e.exception), 'Failed to provision: image')
+        self.assertEqual(self.saved, {'networks': {'networks': []},
+                                      'image': None,
+                                      'flavor': 'flavor-id'})
+        self.assertEqual(self.outcome('networks')['status'], 'done')
+        self.assertEqual(self.outcome('flavor')['status'], 'done')
+        self.assertEqual(self.outcome('image')['status'], 'failed')
+        self.assertEqual(self.outcome('image')['error'], 'glance is down')
+
+    def test_provision_nothing(self):
+        astara_utils.provision({'networks': None})
+        self.assertEqual(self.saved, {})
+
+    @patch.object(astara_utils, '_auth_args')
+    @patch.object(astara_utils, 'get_novaclient')
+    def test_flavor_task_cached(self, get_novaclient, _auth_args):
+        astara_utils.ResourceCache().set(
+            'flavor', astara_utils._flavor_inputs(), 'flavor-id')
+        self.assertIsNone(astara_utils.flavor_task())
+        self.assertFalse(_auth_args.called)
+
+    @patch.object(astara_utils, '_auth_args')
+    @patch.object(astara_utils, 'get_novaclient')
+    def test_flavor_task(self, get_novaclient, _auth_args):
+        flavors = get_novaclient.return_value.flavors
+        flavors.list.return_value = []
+        flavors.create.return_value.id = 'flavor-id'
+        astara_utils.provision({'flavor': astara_utils.flavor_task()})
+        flavors.create.assert_called_with(name='astara', ram=512, disk=2,
+                                          vcpus=1)
+        self.assertEqual(
+            astara_utils.ResourceCache().get(
+                'flavor', astara_utils._flavor_inputs()), 'flavor-id')
@@ -13,15 +13,62 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import math
+import socket
+
 from charmhelpers.core.hookenv import (
+    WARNING,
+    config,
+    leader_get,
     relation_ids,
     related_units,
     relation_get,
     log,
 )
 
+from charmhelpers.contrib.hahelpers.cluster import peer_units
+from charmhelpers.contrib.network.ip import format_ipv6_addr
 from charmhelpers.contrib.openstack import context
 
+# Leader setting holding the peak rate at which routers are created, as
+# sampled by the leader in astara_utils.sample_router_creates()
+ROUTER_CREATE_RATE_KEY = 'router-create-rate'
+
+
+def router_create_rate():
+    """Returns the peak rate at which routers were created, in routers per
+    second, as last shared by the leader"""
+    rate = leader_get(ROUTER_CREATE_RATE_KEY)
+    return float(rate) if rate else 0.0
+
+
+def _host_sort_key(host):
+    """Sort key for (address, port) pairs ordering IP addresses by value
+    rather than as strings, and host names after them"""
+    addr, port = host
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            return (0, family, socket.inet_pton(family, addr), int(port))
+        except socket.error:
+            pass
+    return (1, 0, addr, int(port))
+
+
+def pez_pool_size():
+    """Returns the number of hot-standby appliances to keep per pez pool
+
+    This is pez-pool-size, unless pez-pool-autosize is set. In that case it
+    is the number of routers created at the peak observed rate during the
+    time it takes to boot a replacement appliance (pez-replenish-time). The
+    result is kept between pez-pool-size and pez-pool-max-size.
+    """
+    size = int(config('pez-pool-size'))
+    if not config('pez-pool-autosize'):
+        return size
+    needed = int(math.ceil(
+        router_create_rate() * int(config('pez-replenish-time'))))
+    return max(size, min(needed, int(config('pez-pool-max-size'))))
+
 
 class AstaraOrchestratorContext(context.OSContextGenerator):
     interfaces = ['astara-orchestrator']
@@ -42,34 +89,46 @@ class AstaraOrchestratorContext(context.OSContextGenerator):
         This'll see if we have zookeeper or memcached relations and use that
         found as the coordinator. Note memcahe is only for testing and
         zookeeper will be preferred if both are found.
-        """
 
-        # NOTE: Neither the zookeeper or memcache charms do any kind of
-        # clustering of peers, so we just look for one that tells us its
-        # port and point at that.
-        zk_relation_ids = relation_ids('zookeeper')
-        for rid in zk_relation_ids:
+        The zookeeper URL lists every zookeeper unit, so coordination
+        survives the loss of any of them. tooz only talks to a single
+        memcached server, the one with the lowest address is used.
+        """
+        zk_hosts = set()
+        for rid in relation_ids('zookeeper'):
             for unit in related_units(rid):
                 rel_data = relation_get(unit=unit, rid=rid)
                 zk_port = rel_data.get('port')
                 zk_addr = rel_data.get('private-address')
-                if zk_port:
-                    url = 'kazoo://%s:%s?timeout=5' % (zk_addr, zk_port)
-                    log('Using zookeeper @ %s for astara coordination' % url)
-                    return {'coordination_url': url}
+                if zk_port and zk_addr:
+                    zk_hosts.add('%s:%s' % (format_ipv6_addr(zk_addr) or
+                                            zk_addr, zk_port))
+        if zk_hosts:
+            url = 'kazoo://%s?timeout=5' % ','.join(sorted(zk_hosts))
+            log('Using zookeeper @ %s for astara coordination' % url)
+            return {'coordination_url': url}
 
-        memcached_relation_ids = relation_ids('cache')
-        for rid in memcached_relation_ids:
+        mc_hosts = set()
+        for rid in relation_ids('memcached'):
             for unit in related_units(rid):
                 rel_data = relation_get(unit=unit, rid=rid)
                 mc_port = rel_data.get('tcp-port')
                 mc_addr = rel_data.get('private-address')
-                if mc_port:
-                    url = 'mecached://%s:%s' % (mc_port, mc_addr)
-                    log('Using memcached @ %s for astara coordination' % url)
-                    return {'coordination_url': url}
+                if mc_port and mc_addr:
+                    mc_hosts.add((mc_addr, mc_port))
+        if mc_hosts:
+            mc_addr, mc_port = min(mc_hosts, key=_host_sort_key)
+            url = 'memcached://%s:%s' % (format_ipv6_addr(mc_addr) or
+                                         mc_addr, mc_port)
+            log('Using memcached @ %s for astara coordination' % url)
+            return {'coordination_url': url}
 
         log('no astara coordination relation data found')
+        members = peer_units()
+        if members:
+            log('%s other astara-orchestrator units (%s) are running without '
+                'coordination, each of them will manage every router' %
+                (len(members), ', '.join(sorted(members))), level=WARNING)
         return {}
 
     def _astara_context(self):
@@ -84,12 +143,36 @@ class AstaraOrchestratorContext(context.OSContextGenerator):
         log('astara-orchestrator relation data incomplete.')
         return {}
 
+    def _pez_context(self):
+        ctxt = {'instance_provider': config('instance-provider')}
+        if ctxt['instance_provider'] == 'pez':
+            ctxt['pez_pool_size'] = pez_pool_size()
+        return ctxt
+
     def __call__(self):
         ctxt = self._astara_context()
         if not ctxt:
             return {}
+        ctxt.update(self._pez_context())
         coord_url = self._coordinator_context()
         if coord_url:
             ctxt.update({'coordination_enabled': True})
             ctxt.update(coord_url)
         return ctxt
+
+
+class AstaraWorkerContext(context.WorkerConfigContext):
+    """Sizes the orchestrator's worker processes, threads and RPC pools.
+
+    The number of worker processes scales with the CPU count through
+    worker-multiplier, as it does for the other OpenStack services.
+    """
+
+    def __call__(self):
+        ctxt = super(AstaraWorkerContext, self).__call__()
+        ctxt['workers'] = max(1, ctxt['workers'])
+        ctxt['worker_threads'] = config('worker-threads')
+        ctxt['health_check_period'] = config('health-check-period')
+        ctxt['rpc_thread_pool_size'] = config('rpc-thread-pool-size')
+        ctxt['rpc_conn_pool_size'] = config('rpc-conn-pool-size')
+        return ctxt
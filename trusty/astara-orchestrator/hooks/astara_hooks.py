@@ -24,9 +24,14 @@ from charmhelpers.fetch import (
 from charmhelpers.core.hookenv import (
     Hooks,
     config,
+    enable_log_buffering,
+    enable_relation_set_buffering,
+    enable_relation_snapshot,
     log as juju_log,
     local_unit,
     relation_get,
+    relation_ids,
+    related_units,
     relation_set,
     unit_get,
     UnregisteredHookError,
@@ -38,12 +43,16 @@ from charmhelpers.core.host import (
 
 
 from astara_utils import (
+    configure_pez_service,
     determine_packages,
     migrate_database,
+    pez_enabled,
     register_configs,
     restart_map,
+    sample_router_creates,
     git_install,
     ASTARA_CONFIG,
+    PEZ_SERVICE,
 )
 
 from charmhelpers.contrib.openstack.utils import (
@@ -52,6 +61,11 @@ from charmhelpers.contrib.openstack.utils import (
     git_install_requested,
 )
 
+from charmhelpers.contrib.hahelpers.cluster import (
+    is_elected_leader,
+    peer_units,
+)
+
 from charmhelpers.contrib.openstack.ip import (
     canonical_url,
     PUBLIC, INTERNAL, ADMIN
@@ -82,19 +96,37 @@ def db_changed():
         return
 
     CONFIGS.write(ASTARA_CONFIG)
+    sync_database(relation_get('allowed_units'))
+
+
+def sync_database(allowed_units):
+    """Migrates the database if this unit is the leader and may access it"""
+    if not is_elected_leader(None):
+        juju_log('Not the leader, deferring db sync to it')
+        return
+    # Bugs 1353135 & 1187508. Dbs can appear to be ready before the units
+    # acl entry has been added. So, if the db supports passing a list of
+    # permitted units then check if we're in the list.
+    if allowed_units and local_unit() in allowed_units.split():
+        juju_log('Cluster leader, performing db sync')
+        migrate_database()
+    else:
+        juju_log('allowed_units either not presented, or local unit '
+                 'not in acl list: %s' % allowed_units)
 
-    # XXX (This is where leadership election will go)
-    if True:
-        # Bugs 1353135 & 1187508. Dbs can appear to be ready before the units
-        # acl entry has been added. So, if the db supports passing a list of
-        # permitted units then check if we're in the list.
-        allowed_units = relation_get('allowed_units')
-        if allowed_units and local_unit() in allowed_units.split():
-            juju_log('Cluster leader, performing db sync')
-            migrate_database()
-        else:
-            juju_log('allowed_units either not presented, or local unit '
-                     'not in acl list: %s' % allowed_units)
+
+@hooks.hook('leader-elected')
+def leader_elected():
+    # A new leader takes over the db sync in case its predecessor left
+    # before completing it.
+    if 'shared-db' not in CONFIGS.complete_contexts():
+        return
+    for rid in relation_ids('shared-db'):
+        for unit in related_units(rid):
+            allowed_units = relation_get('allowed_units', rid=rid, unit=unit)
+            if allowed_units:
+                sync_database(allowed_units)
+                return
 
 
 @hooks.hook('identity-service-relation-joined')
@@ -160,14 +192,52 @@ def config_changed():
             git_install(config('openstack-origin-git'))
 
     CONFIGS.write_all()
+    configure_pez_service()
+
+
+@hooks.hook('update-status')
+@restart_on_change({ASTARA_CONFIG: [PEZ_SERVICE]})
+def update_status():
+    # Resize the pez pools as the rate of router creation changes.
+    if not (pez_enabled() and config('pez-pool-autosize')):
+        return
+    if not is_elected_leader(None):
+        # The leader samples neutron and shares the rate with the others
+        return
+    sample_router_creates()
+    CONFIGS.write(ASTARA_CONFIG)
+
+
+@hooks.hook('leader-settings-changed')
+@restart_on_change({ASTARA_CONFIG: [PEZ_SERVICE]})
+def leader_settings_changed():
+    # The leader shares the rate of router creation the pez pools are
+    # sized from.
+    if pez_enabled() and config('pez-pool-autosize'):
+        CONFIGS.write(ASTARA_CONFIG)
 
 
 @hooks.hook('zookeeper-relation-departed')
 @hooks.hook('zookeeper-relation-changed')
+@hooks.hook('memcached-relation-departed')
+@hooks.hook('memcached-relation-changed')
+@restart_on_change(restart_map())
 def zookeeper_changed():
     CONFIGS.write_all()
 
 
+@hooks.hook('cluster-relation-joined')
+@hooks.hook('cluster-relation-changed')
+@hooks.hook('cluster-relation-departed')
+def cluster_changed():
+    # Orchestrator units share out routers among the members of their
+    # coordination group, the peer relation is only used to keep track of
+    # which units there are.
+    juju_log('astara-orchestrator peers: %s' %
+             (', '.join(sorted(peer_units())) or 'none'))
+    CONFIGS.write_all()
+
+
 @hooks.hook('install')
 def install():
     apt_update(fatal=True)
@@ -177,6 +247,9 @@ def install():
 
 
 def main():
+    enable_log_buffering()
+    enable_relation_snapshot()
+    enable_relation_set_buffering()
     try:
         hooks.execute(sys.argv)
     except UnregisteredHookError as e:
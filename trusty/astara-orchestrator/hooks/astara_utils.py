@@ -14,13 +14,21 @@
 
 import os
 import subprocess
+import time
 
 from collections import OrderedDict
 
 import astara_context
 
-from charmhelpers.core.hookenv import charm_dir
+from charmhelpers.core import unitdata
+from charmhelpers.core.hookenv import (
+    charm_dir,
+    config,
+    leader_set,
+    log,
+)
 from charmhelpers.contrib.openstack import context, templating
+from charmhelpers.contrib.openstack.neutron import iter_neutron_resources
 from charmhelpers.contrib.python.packages import pip_install
 from charmhelpers.core.templating import render
 
@@ -30,6 +38,9 @@ from charmhelpers.core.host import (
     add_group,
     add_user_to_group,
     mkdir,
+    service_running,
+    service_start,
+    service_stop,
     write_file,
 )
 
@@ -45,6 +56,15 @@ from charmhelpers.contrib.openstack.utils import (
 TEMPLATES = 'templates/'
 ASTARA_CONFIG = '/etc/astara/orchestrator.ini'
 
+PEZ_SERVICE = 'astara-pez-service'
+PEZ_UPSTART = '/etc/init/astara-pez-service.conf'
+# Keeps upstart from starting the pez service at boot while it is disabled
+PEZ_UPSTART_OVERRIDE = '/etc/init/astara-pez-service.override'
+# Router creation samples older than this many seconds are discarded
+ROUTER_CREATES_WINDOW = 24 * 60 * 60
+# unitdata key of the router creation samples taken by the leader
+ROUTER_CREATES_KEY = 'astara.router-creates'
+
 CONSOLE_SCRIPTS = [
     'astara-ctl',
     'astara-dbsync',
@@ -79,12 +99,20 @@ def determine_packages():
     return packages
 
 
+def pez_enabled():
+    return config('instance-provider') == 'pez'
+
+
 def resource_map():
+    services = ['astara-orchestrator']
+    if pez_enabled():
+        services.append(PEZ_SERVICE)
     rm = OrderedDict([
         (ASTARA_CONFIG, {
-            'services': ['astara-orchestrator'],
+            'services': services,
             'contexts': [
                 astara_context.AstaraOrchestratorContext(),
+                astara_context.AstaraWorkerContext(),
                 context.AMQPContext(),
                 context.SharedDBContext(),
                 context.IdentityServiceContext(
@@ -127,6 +155,7 @@ def git_pre_install():
 
     logs = [
         '/var/log/astara/astara-orchestrator.log',
+        '/var/log/astara/astara-pez-service.log',
     ]
 
     adduser('astara', shell='/bin/bash', system_user=True)
@@ -180,6 +209,106 @@ def git_post_install(projects_yaml):
            astara_orchestrator_context, perms=0o644,
            templates_dir=templates_dir)
 
+    astara_pez_context = dict(
+        astara_orchestrator_context,
+        service_description='Astara Appliance Instance Pool Manager',
+        process_name=PEZ_SERVICE,
+        executable_name=os.path.join(bin_dir, PEZ_SERVICE),
+        log_file='/var/log/astara/astara-pez-service.log',
+    )
+    render('git.upstart', PEZ_UPSTART, astara_pez_context, perms=0o644,
+           templates_dir=templates_dir)
+
+
+def configure_pez_service():
+    """Starts or stops the astara-pez-service according to
+    instance-provider"""
+    if not os.path.exists(PEZ_UPSTART):
+        if pez_enabled():
+            log('%s is not installed, pez requires installing from git' %
+                PEZ_SERVICE)
+        return
+    if pez_enabled():
+        if os.path.exists(PEZ_UPSTART_OVERRIDE):
+            os.remove(PEZ_UPSTART_OVERRIDE)
+        if not service_running(PEZ_SERVICE):
+            service_start(PEZ_SERVICE)
+    else:
+        write_file(PEZ_UPSTART_OVERRIDE, 'manual\n', perms=0o644)
+        if service_running(PEZ_SERVICE):
+            service_stop(PEZ_SERVICE)
+
+
+def get_neutronclient():
+    """Returns a neutron client using the astara service credentials, or
+    None if the identity-service relation is not complete"""
+    ctxt = context.IdentityServiceContext(service='astara',
+                                          service_user='astara')()
+    if not ctxt or not context.context_complete(ctxt):
+        return None
+    from neutronclient.v2_0 import client
+    return client.Client(
+        username=ctxt['admin_user'],
+        password=ctxt['admin_password'],
+        tenant_name=ctxt['admin_tenant_name'],
+        auth_url='%s://%s:%s/v2.0' % (ctxt['service_protocol'],
+                                      ctxt['service_host'],
+                                      ctxt['service_port']),
+        region_name=config('region'),
+    )
+
+
+def peak_router_create_rate(samples):
+    """Returns the highest rate of router creation over samples, in routers
+    per second"""
+    rates = [created / float(end - start)
+             for start, end, created in samples
+             if end > start]
+    return max(rates) if rates else 0.0
+
+
+def sample_router_creates():
+    """Records how many routers were created since the previous sample.
+
+    This is meant to run on the leader only. It keeps the number of
+    routers it counted last time, and the growth since then is taken to be
+    the number created. Routers deleted in the meantime offset those
+    created, so the rate is underestimated while routers are also being
+    deleted. Samples are kept for ROUTER_CREATES_WINDOW, and the peak rate
+    over them is shared with the other units as a leader setting, read by
+    astara_context.pez_pool_size() to size the pez pools.
+    """
+    client = get_neutronclient()
+    if client is None:
+        return
+    count = sum(1 for _ in iter_neutron_resources(
+        client.list_routers, 'routers', fields=['id']))
+    now = time.time()
+    db = unitdata.kv()
+    data = db.get(ROUTER_CREATES_KEY) or {}
+    samples = [s for s in data.get('samples', [])
+               if s[1] > now - ROUTER_CREATES_WINDOW]
+    if 'count' in data:
+        created = max(0, count - data['count'])
+        samples.append([data['time'], now, created])
+        log('%s routers created in the last %ds' %
+            (created, now - data['time']))
+    db.set(ROUTER_CREATES_KEY, {
+        'time': now,
+        'count': count,
+        'samples': samples,
+    })
+    db.flush()
+    if not samples:
+        # A new leader keeps the rate its predecessor shared for now
+        return
+
+    # Only changes are shared, as every leader-set runs
+    # leader-settings-changed on the other units
+    rate = '%.6f' % peak_router_create_rate(samples)
+    if rate != '%.6f' % astara_context.router_create_rate():
+        leader_set({astara_context.ROUTER_CREATE_RATE_KEY: rate})
+
 
 def migrate_database():
     """Runs astara-dbsync to initialize a new database or migrate existing"""
@@ -0,0 +1,269 @@
+from mock import patch, PropertyMock
+
+from test_utils import CharmTestCase
+
+from charmhelpers.contrib.openstack import context, templating
+
+import astara_context
+import astara_utils
+
+TO_PATCH = [
+    'config',
+    'leader_get',
+]
+
+
+class PezPoolSizeTestCase(CharmTestCase):
+
+    def setUp(self):
+        super(PezPoolSizeTestCase, self).setUp(astara_context, TO_PATCH)
+        self.config.side_effect = self.test_config.get
+        self.leader_settings = {}
+        self.leader_get.side_effect = self.leader_settings.get
+
+    def test_router_create_rate(self):
+        self.leader_settings['router-create-rate'] = '0.250000'
+        self.assertEqual(astara_context.router_create_rate(), 0.25)
+        self.leader_get.assert_called_with('router-create-rate')
+
+    def test_router_create_rate_not_shared(self):
+        self.assertEqual(astara_context.router_create_rate(), 0.0)
+
+    def test_pez_pool_size(self):
+        self.test_config.set('pez-pool-size', 3)
+        self.leader_settings['router-create-rate'] = '1.000000'
+        self.assertEqual(astara_context.pez_pool_size(), 3)
+        self.assertFalse(self.leader_get.called)
+
+    def test_pez_pool_size_autosize(self):
+        self.test_config.set('pez-pool-autosize', True)
+        # 0.05 routers per second over a 120s replenish time
+        self.leader_settings['router-create-rate'] = '0.050000'
+        self.assertEqual(astara_context.pez_pool_size(), 6)
+
+    def test_pez_pool_size_autosize_rounds_up(self):
+        self.test_config.set('pez-pool-autosize', True)
+        self.leader_settings['router-create-rate'] = '0.020000'
+        self.assertEqual(astara_context.pez_pool_size(), 3)
+
+    def test_pez_pool_size_autosize_min(self):
+        self.test_config.set('pez-pool-autosize', True)
+        self.test_config.set('pez-pool-size', 4)
+        self.assertEqual(astara_context.pez_pool_size(), 4)
+
+    def test_pez_pool_size_autosize_max(self):
+        self.test_config.set('pez-pool-autosize', True)
+        self.leader_settings['router-create-rate'] = '5.000000'
+        self.assertEqual(astara_context.pez_pool_size(), 10)
+
+
+class AstaraWorkerContextTestCase(CharmTestCase):
+
+    def setUp(self):
+        super(AstaraWorkerContextTestCase, self).setUp(astara_context,
+                                                       ['config'])
+        self.config.side_effect = self.test_config.get
+        patcher = patch.object(context, 'config', self.config)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch.object(astara_context.AstaraWorkerContext,
+                               'num_cpus', new_callable=PropertyMock)
+        self.num_cpus = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.num_cpus.return_value = 4
+
+    def test_defaults(self):
+        self.assertEqual(astara_context.AstaraWorkerContext()(), {
+            'workers': 8,
+            'worker_threads': 4,
+            'health_check_period': 60,
+            'rpc_thread_pool_size': 64,
+            'rpc_conn_pool_size': 30,
+        })
+
+    def test_config(self):
+        self.test_config.set('worker-multiplier', 3)
+        self.test_config.set('worker-threads', 16)
+        self.test_config.set('health-check-period', 30)
+        self.test_config.set('rpc-thread-pool-size', 128)
+        self.test_config.set('rpc-conn-pool-size', 60)
+        self.assertEqual(astara_context.AstaraWorkerContext()(), {
+            'workers': 12,
+            'worker_threads': 16,
+            'health_check_period': 30,
+            'rpc_thread_pool_size': 128,
+            'rpc_conn_pool_size': 60,
+        })
+
+    def test_at_least_one_worker(self):
+        self.test_config.set('worker-multiplier', 0)
+        self.assertEqual(astara_context.AstaraWorkerContext()()['workers'], 1)
+
+
+class AstaraOrchestratorContextTestCase(CharmTestCase):
+
+    def setUp(self):
+        super(AstaraOrchestratorContextTestCase, self).setUp(
+            astara_context, ['config', 'log', 'peer_units', 'relation_get',
+                             'relation_ids', 'related_units'])
+        self.config.side_effect = self.test_config.get
+        self.peer_units.return_value = []
+        self.relations = {}
+        self.relation_ids.side_effect = lambda reltype: sorted(
+            rid for rid in self.relations if rid.startswith(reltype + ':'))
+        self.related_units.side_effect = lambda rid: sorted(
+            self.relations[rid])
+        self.relation_get.side_effect = (
+            lambda unit=None, rid=None: self.relations[rid][unit])
+
+    def relate(self, rid, unit, **settings):
+        self.relations.setdefault(rid, {})[unit] = settings
+
+    def coordinator_context(self):
+        return astara_context.AstaraOrchestratorContext(
+        )._coordinator_context()
+
+    def test_zookeeper_all_units(self):
+        self.relate('zookeeper:1', 'zookeeper/0',
+                    **{'private-address': u'10.0.0.9', 'port': u'2181'})
+        self.relate('zookeeper:1', 'zookeeper/1',
+                    **{'private-address': u'2001:db8::1', 'port': u'2181'})
+        self.relate('zookeeper:1', 'zookeeper/2',
+                    **{'private-address': u'10.0.0.10', 'port': u'2181'})
+        # Not ready yet
+        self.relate('zookeeper:1', 'zookeeper/3',
+                    **{'private-address': u'10.0.0.11'})
+        self.assertEqual(self.coordinator_context(), {
+            'coordination_url': 'kazoo://10.0.0.10:2181,10.0.0.9:2181,'
+                                '[2001:db8::1]:2181?timeout=5'})
+
+    def test_memcached_lowest_address(self):
+        for i, addr in enumerate([u'10.0.0.9', u'10.0.0.10', u'10.0.0.100',
+                                  u'memcached-host']):
+            self.relate('memcached:2', 'memcached/%d' % i,
+                        **{'private-address': addr, 'tcp-port': u'11211'})
+        self.assertEqual(self.coordinator_context(),
+                         {'coordination_url': 'memcached://10.0.0.9:11211'})
+
+    def test_memcached_lowest_port(self):
+        self.relate('memcached:2', 'memcached/0',
+                    **{'private-address': u'10.0.0.9', 'tcp-port': u'11311'})
+        self.relate('memcached:2', 'memcached/1',
+                    **{'private-address': u'10.0.0.9', 'tcp-port': u'11211'})
+        self.assertEqual(self.coordinator_context(),
+                         {'coordination_url': 'memcached://10.0.0.9:11211'})
+
+    def test_memcached_ipv6(self):
+        self.relate('memcached:2', 'memcached/0',
+                    **{'private-address': u'2001:db8::10',
+                       'tcp-port': u'11211'})
+        self.relate('memcached:2', 'memcached/1',
+                    **{'private-address': u'2001:db8::9',
+                       'tcp-port': u'11211'})
+        self.assertEqual(
+            self.coordinator_context(),
+            {'coordination_url': 'memcached://[2001:db8::9]:11211'})
+
+    def test_zookeeper_preferred(self):
+        self.relate('zookeeper:1', 'zookeeper/0',
+                    **{'private-address': u'10.0.0.9', 'port': u'2181'})
+        self.relate('memcached:2', 'memcached/0',
+                    **{'private-address': u'10.0.0.8', 'tcp-port': u'11211'})
+        self.assertEqual(
+            self.coordinator_context(),
+            {'coordination_url': 'kazoo://10.0.0.9:2181?timeout=5'})
+
+    def test_no_coordination(self):
+        self.assertEqual(self.coordinator_context(), {})
+        self.assertFalse([c for c in self.log.call_args_list
+                          if c[1].get('level') == astara_context.WARNING])
+
+    def test_no_coordination_with_peers(self):
+        self.peer_units.return_value = ['astara-orchestrator/1']
+        self.assertEqual(self.coordinator_context(), {})
+        self.log.assert_called_with(
+            '1 other astara-orchestrator units (astara-orchestrator/1) are '
+            'running without coordination, each of them will manage every '
+            'router', level=astara_context.WARNING)
+
+    def relate_astara(self, **settings):
+        data = dict((key, u'value') for key in
+                    astara_context.AstaraOrchestratorContext
+                    .astara_neutron_keys)
+        data.update(settings)
+        self.relate('astara-orchestrator:3', 'astara-neutron-api/0', **data)
+
+    def test_astara_incomplete(self):
+        self.relate_astara(router_image_uuid=None)
+        self.relate('zookeeper:1', 'zookeeper/0',
+                    **{'private-address': u'10.0.0.9', 'port': u'2181'})
+        self.assertEqual(astara_context.AstaraOrchestratorContext()(), {})
+
+    def test_astara_complete(self):
+        self.relate_astara()
+        self.relate('zookeeper:1', 'zookeeper/0',
+                    **{'private-address': u'10.0.0.9', 'port': u'2181'})
+        ctxt = astara_context.AstaraOrchestratorContext()()
+        self.assertEqual(ctxt['management_network_id'], u'value')
+        self.assertEqual(ctxt['instance_provider'], 'on_demand')
+        self.assertTrue(ctxt['coordination_enabled'])
+        self.assertEqual(ctxt['coordination_url'],
+                         'kazoo://10.0.0.9:2181?timeout=5')
+
+    def test_astara_complete_without_coordination(self):
+        self.relate_astara()
+        ctxt = astara_context.AstaraOrchestratorContext()()
+        self.assertNotIn('coordination_enabled', ctxt)
+        self.assertNotIn('coordination_url', ctxt)
+
+
+class StaticContext(object):
+
+    interfaces = []
+
+    def __init__(self, ctxt):
+        self.ctxt = ctxt
+
+    def __call__(self):
+        return self.ctxt
+
+
+class OrchestratorConfigTestCase(CharmTestCase):
+
+    def setUp(self):
+        super(OrchestratorConfigTestCase, self).setUp(templating, ['log'])
+
+    def render(self, ctxt):
+        configs = templating.OSConfigRenderer(
+            templates_dir=astara_utils.TEMPLATES,
+            openstack_release='liberty')
+        configs.register(astara_utils.ASTARA_CONFIG, [StaticContext(ctxt)])
+        return configs.render(astara_utils.ASTARA_CONFIG).splitlines()
+
+    def test_render_before_astara_relation(self):
+        # AstaraOrchestratorContext is empty until the astara relation
+        # completes.
+        lines = self.render({})
+        self.assertIn('instance_provider=on_demand', lines)
+        self.assertIn('pool_size=1', lines)
+
+    @patch.object(astara_context, 'pez_pool_size')
+    @patch.object(astara_context, 'config')
+    def test_render_pez(self, config, pez_pool_size):
+        config.return_value = 'pez'
+        pez_pool_size.return_value = 4
+        lines = self.render(astara_context.AstaraOrchestratorContext()
+                            ._pez_context())
+        self.assertIn('instance_provider=pez', lines)
+        self.assertIn('pool_size=4', lines)
+
+    def test_render_workers(self):
+        lines = self.render({'workers': 8, 'worker_threads': 4,
+                             'health_check_period': 60,
+                             'rpc_thread_pool_size': 64,
+                             'rpc_conn_pool_size': 30})
+        for line in ('num_worker_processes=8', 'num_worker_threads=4',
+                     'health_check_period=60',
+                     'executor_thread_pool_size=64',
+                     'rpc_conn_pool_size=30'):
+            self.assertIn(line, lines)
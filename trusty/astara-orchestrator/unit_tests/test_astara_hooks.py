@@ -0,0 +1,154 @@
+from mock import MagicMock
+
+from test_utils import CharmTestCase
+
+import astara_utils as utils
+
+_reg = utils.register_configs
+_map = utils.restart_map
+
+utils.register_configs = MagicMock()
+utils.restart_map = MagicMock()
+
+import astara_hooks as hooks
+
+utils.register_configs = _reg
+utils.restart_map = _map
+
+TO_PATCH = [
+    'CONFIGS',
+    'config',
+    'is_elected_leader',
+    'juju_log',
+    'local_unit',
+    'migrate_database',
+    'peer_units',
+    'pez_enabled',
+    'related_units',
+    'relation_get',
+    'relation_ids',
+    'sample_router_creates',
+]
+
+
+class PezAutosizeHooksTestCase(CharmTestCase):
+
+    def setUp(self):
+        super(PezAutosizeHooksTestCase, self).setUp(hooks, TO_PATCH)
+        self.config.side_effect = self.test_config.get
+        self.test_config.set('pez-pool-autosize', True)
+        self.pez_enabled.return_value = True
+
+    def test_update_status_leader(self):
+        self.is_elected_leader.return_value = True
+        hooks.update_status()
+        self.assertTrue(self.sample_router_creates.called)
+        self.CONFIGS.write.assert_called_with(hooks.ASTARA_CONFIG)
+
+    def test_update_status_not_leader(self):
+        self.is_elected_leader.return_value = False
+        hooks.update_status()
+        self.assertFalse(self.sample_router_creates.called)
+        self.assertFalse(self.CONFIGS.write.called)
+
+    def test_update_status_autosize_disabled(self):
+        self.test_config.set('pez-pool-autosize', False)
+        self.is_elected_leader.return_value = True
+        hooks.update_status()
+        self.assertFalse(self.sample_router_creates.called)
+
+    def test_leader_settings_changed(self):
+        hooks.leader_settings_changed()
+        self.CONFIGS.write.assert_called_with(hooks.ASTARA_CONFIG)
+        self.assertFalse(self.sample_router_creates.called)
+
+
+class DatabaseHooksTestCase(CharmTestCase):
+
+    def setUp(self):
+        super(DatabaseHooksTestCase, self).setUp(hooks, TO_PATCH)
+        self.config.side_effect = self.test_config.get
+        self.local_unit.return_value = 'astara-orchestrator/0'
+        self.CONFIGS.complete_contexts.return_value = ['shared-db']
+        self.relation_ids.return_value = ['shared-db:1']
+        self.related_units.return_value = ['mysql/0']
+        self.allowed_units = 'astara-orchestrator/0 astara-orchestrator/1'
+        self.relation_get.side_effect = (
+            lambda attribute=None, rid=None, unit=None: self.allowed_units)
+
+    def test_sync_database_leader(self):
+        self.is_elected_leader.return_value = True
+        hooks.sync_database(self.allowed_units)
+        self.assertTrue(self.migrate_database.called)
+
+    def test_sync_database_not_leader(self):
+        self.is_elected_leader.return_value = False
+        hooks.sync_database(self.allowed_units)
+        self.assertFalse(self.migrate_database.called)
+
+    def test_sync_database_not_allowed(self):
+        self.is_elected_leader.return_value = True
+        hooks.sync_database('astara-orchestrator/1')
+        hooks.sync_database(None)
+        self.assertFalse(self.migrate_database.called)
+
+    def test_db_changed(self):
+        self.is_elected_leader.return_value = True
+        hooks.db_changed()
+        self.CONFIGS.write.assert_called_with(hooks.ASTARA_CONFIG)
+        self.assertTrue(self.migrate_database.called)
+
+    def test_db_changed_not_leader(self):
+        self.is_elected_leader.return_value = False
+        hooks.db_changed()
+        self.CONFIGS.write.assert_called_with(hooks.ASTARA_CONFIG)
+        self.assertFalse(self.migrate_database.called)
+
+    def test_db_changed_incomplete(self):
+        self.CONFIGS.complete_contexts.return_value = []
+        hooks.db_changed()
+        self.assertFalse(self.CONFIGS.write.called)
+        self.assertFalse(self.migrate_database.called)
+
+    def test_leader_elected(self):
+        self.is_elected_leader.return_value = True
+        hooks.leader_elected()
+        self.relation_get.assert_called_with('allowed_units',
+                                             rid='shared-db:1', unit='mysql/0')
+        self.assertTrue(self.migrate_database.called)
+
+    def test_leader_elected_db_incomplete(self):
+        self.is_elected_leader.return_value = True
+        self.CONFIGS.complete_contexts.return_value = []
+        hooks.leader_elected()
+        self.assertFalse(self.migrate_database.called)
+
+    def test_leader_elected_no_allowed_units(self):
+        self.is_elected_leader.return_value = True
+        self.allowed_units = None
+        hooks.leader_elected()
+        self.assertFalse(self.migrate_database.called)
+
+
+class CoordinationHooksTestCase(CharmTestCase):
+
+    def setUp(self):
+        super(CoordinationHooksTestCase, self).setUp(hooks, TO_PATCH)
+
+    def test_cluster_changed(self):
+        self.peer_units.return_value = ['astara-orchestrator/2',
+                                        'astara-orchestrator/1']
+        hooks.cluster_changed()
+        self.juju_log.assert_called_with(
+            'astara-orchestrator peers: astara-orchestrator/1, '
+            'astara-orchestrator/2')
+        self.assertTrue(self.CONFIGS.write_all.called)
+
+    def test_cluster_changed_no_peers(self):
+        self.peer_units.return_value = []
+        hooks.cluster_changed()
+        self.juju_log.assert_called_with('astara-orchestrator peers: none')
+
+    def test_zookeeper_changed(self):
+        hooks.zookeeper_changed()
+        self.assertTrue(self.CONFIGS.write_all.called)
@@ -0,0 +1,95 @@
+from mock import patch
+
+from charmhelpers.core import unitdata
+from test_utils import CharmTestCase
+
+import astara_utils
+
+TO_PATCH = [
+    'get_neutronclient',
+    'iter_neutron_resources',
+    'leader_set',
+    'log',
+    'time',
+    'unitdata',
+]
+
+
+class SampleRouterCreatesTestCase(CharmTestCase):
+
+    def setUp(self):
+        super(SampleRouterCreatesTestCase, self).setUp(astara_utils,
+                                                       TO_PATCH)
+        self.db = unitdata.Storage(':memory:')
+        self.unitdata.kv.return_value = self.db
+        self.routers = []
+        self.iter_neutron_resources.side_effect = (
+            lambda *args, **kwargs: iter(self.routers))
+        self.shared_rate = None
+        _m = patch.object(astara_utils.astara_context, 'router_create_rate')
+        rate = _m.start()
+        self.addCleanup(_m.stop)
+        rate.side_effect = lambda: float(self.shared_rate or 0)
+        self.leader_set.side_effect = self.share
+
+    def share(self, settings):
+        self.shared_rate = settings['router-create-rate']
+
+    def sample(self, now, routers):
+        self.time.time.return_value = now
+        self.routers = [{'id': 'router-%s' % i} for i in range(routers)]
+        astara_utils.sample_router_creates()
+
+    def samples(self):
+        return self.db.get(astara_utils.ROUTER_CREATES_KEY)
+
+    def test_sample(self):
+        self.sample(1000, 10)
+        self.assertEqual(self.samples(),
+                         {'time': 1000, 'count': 10, 'samples': []})
+        # Nothing to share until there are samples
+        self.assertFalse(self.leader_set.called)
+        self.sample(1300, 40)
+        self.assertEqual(self.samples(),
+                         {'time': 1300, 'count': 40,
+                          'samples': [[1000, 1300, 30]]})
+        self.leader_set.assert_called_with(
+            {'router-create-rate': '0.100000'})
+
+    def test_sample_peak_rate(self):
+        self.sample(1000, 10)
+        self.sample(1300, 40)
+        self.leader_set.reset_mock()
+        # Slower, the peak rate is unchanged and not shared again
+        self.sample(1600, 50)
+        self.assertFalse(self.leader_set.called)
+        self.sample(1700, 70)
+        self.leader_set.assert_called_with(
+            {'router-create-rate': '0.200000'})
+
+    def test_sample_routers_deleted(self):
+        self.sample(1000, 10)
+        self.sample(1300, 4)
+        self.assertEqual(self.samples()['samples'], [[1000, 1300, 0]])
+        self.assertFalse(self.leader_set.called)
+
+    def test_sample_window(self):
+        self.sample(1000, 10)
+        self.sample(1300, 40)
+        day = astara_utils.ROUTER_CREATES_WINDOW
+        self.sample(1300 + day, 40)
+        self.assertEqual(self.samples()['samples'],
+                         [[1300, 1300 + day, 0]])
+        self.assertEqual(self.shared_rate, '0.000000')
+
+    def test_sample_no_credentials(self):
+        self.get_neutronclient.return_value = None
+        astara_utils.sample_router_creates()
+        self.assertIsNone(self.samples())
+        self.assertFalse(self.leader_set.called)
+
+    def test_peak_router_create_rate(self):
+        self.assertEqual(astara_utils.peak_router_create_rate([]), 0.0)
+        self.assertEqual(astara_utils.peak_router_create_rate(
+            [[0, 100, 5], [100, 200, 20], [200, 200, 3]]), 0.2)
+
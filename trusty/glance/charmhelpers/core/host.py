@@ -368,6 +368,18 @@ class ChecksumError(ValueError):
     pass
 
 
+_file_changes = []
+
+
+def record_file_change(path):
+    """Record that the contents of path changed during this hook
+
+    :func:`restart_on_change` trusts the report for path instead of hashing
+    the file again after the decorated function returns.
+    """
+    _file_changes.append(path)
+
+
 def restart_on_change(restart_map, stopstart=False):
     """Restart services based on configuration files changing
 
@@ -386,14 +398,21 @@ def restart_on_change(restart_map, stopstart=False):
     restarted if any file matching the pattern got changed, created
     or removed. Standard wildcards are supported, see documentation
     for the 'glob' module for more information.
+
+    Paths reported with :func:`record_file_change` while the decorated
+    function ran, such as config files written by an OSConfigRenderer, are
+    considered changed without hashing them again. All other paths are
+    hashed before and after the function runs.
     """
     def wrap(f):
         def wrapped_f(*args, **kwargs):
             checksums = {path: path_hash(path) for path in restart_map}
+            first_change = len(_file_changes)
             f(*args, **kwargs)
+            changed = set(_file_changes[first_change:])
             restarts = []
             for path in restart_map:
-                if path_hash(path) != checksums[path]:
+                if path in changed or path_hash(path) != checksums[path]:
                     restarts += restart_map[path]
             services_list = list(OrderedDict.fromkeys(restarts))
             if not stopstart:
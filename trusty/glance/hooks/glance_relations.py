@@ -26,11 +26,15 @@ from glance_utils import (
     setup_ipv6,
     REQUIRED_INTERFACES,
     check_optional_relations,
+    default_store,
     is_api_ready,
 )
 
 from charmhelpers.core.hookenv import (
     config,
+    enable_log_buffering,
+    enable_relation_set_buffering,
+    enable_relation_snapshot,
     Hooks,
     log as juju_log,
     ERROR,
@@ -226,7 +230,7 @@ def image_service_joined(relation_id=None):
     relation_data = {
         'glance-api-server':
         "{}:9292".format(canonical_url(CONFIGS, INTERNAL)),
-
+        'glance-backend': default_store(CONFIGS),
     }
 
     if is_api_ready(CONFIGS):
@@ -289,6 +293,8 @@ def ceph_changed():
         # Ensure that glance-api is restarted since only now can we
         # guarantee that ceph resources are ready.
         service_restart('glance-api')
+        for rid in relation_ids('image-service'):
+            image_service_joined(rid)
     else:
         send_request_if_needed(get_ceph_request())
 
@@ -298,6 +304,8 @@ def ceph_broken():
     service = service_name()
     delete_keyring(service=service)
     CONFIGS.write_all()
+    for rid in relation_ids('image-service'):
+        image_service_joined(rid)
 
 
 @hooks.hook('identity-service-relation-joined')
@@ -540,6 +548,9 @@ def update_nrpe_config():
 
 
 if __name__ == '__main__':
+    enable_log_buffering()
+    enable_relation_snapshot()
+    enable_relation_set_buffering()
     try:
         hooks.execute(sys.argv)
     except UnregisteredHookError as e:
@@ -465,3 +465,13 @@ def check_optional_relations(configs):
 
 def is_api_ready(configs):
     return (not incomplete_relation_data(configs, REQUIRED_INTERFACES))
+
+
+def default_store(configs):
+    """The store glance-api.conf directs new images to: rbd, swift or file"""
+    complete_contexts = configs.complete_contexts()
+    if 'ceph-glance' in complete_contexts:
+        return 'rbd'
+    if 'object-store' in complete_contexts:
+        return 'swift'
+    return 'file'
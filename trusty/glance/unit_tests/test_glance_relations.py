@@ -313,6 +313,7 @@ class GlanceRelationTests(CharmTestCase):
         relations.image_service_joined()
         args = {
             'glance-api-server': 'http://glancehost:9292',
+            'glance-backend': 'file',
             'relation_id': None
         }
         self.relation_set.assert_called_with(**args)
@@ -323,10 +324,20 @@ class GlanceRelationTests(CharmTestCase):
         relations.image_service_joined(relation_id='image-service:1')
         args = {
             'glance-api-server': 'http://glancehost:9292',
+            'glance-backend': 'file',
             'relation_id': 'image-service:1',
         }
         self.relation_set.assert_called_with(**args)
 
+    @patch.object(relations, 'CONFIGS')
+    @patch.object(relations, 'canonical_url')
+    def test_image_service_joined_ceph_backend(self, _canonical_url, configs):
+        _canonical_url.return_value = 'http://glancehost'
+        configs.complete_contexts.return_value = ['ceph-glance']
+        relations.image_service_joined(relation_id='image-service:1')
+        self.assertEquals(
+            self.relation_set.call_args[1]['glance-backend'], 'rbd')
+
     @patch.object(relations, 'CONFIGS')
     def test_object_store_joined_without_identity_service(self, configs):
         configs.complete_contexts = MagicMock()
@@ -432,6 +443,15 @@ class GlanceRelationTests(CharmTestCase):
         self.delete_keyring.assert_called_with(service='glance')
         self.assertTrue(configs.write_all.called)
 
+    @patch.object(relations, 'image_service_joined')
+    @patch.object(relations, 'CONFIGS')
+    def test_ceph_broken_with_image_service(self, configs,
+                                            image_service_joined):
+        self.service_name.return_value = 'glance'
+        self.relation_ids.return_value = ['image-service:0']
+        relations.ceph_broken()
+        image_service_joined.assert_called_with('image-service:0')
+
     @patch.object(relations, 'canonical_url')
     def test_keystone_joined(self, _canonical_url):
         _canonical_url.return_value = 'http://glancehost'
@@ -293,3 +293,13 @@ class TestGlanceUtils(CharmTestCase):
             call('glance-registry'),
         ]
         self.assertEquals(service_restart.call_args_list, expected)
+
+    def test_default_store(self):
+        configs = MagicMock()
+        configs.complete_contexts.return_value = ['ceph-glance',
+                                                  'object-store']
+        self.assertEquals(utils.default_store(configs), 'rbd')
+        configs.complete_contexts.return_value = ['object-store']
+        self.assertEquals(utils.default_store(configs), 'swift')
+        configs.complete_contexts.return_value = []
+        self.assertEquals(utils.default_store(configs), 'file')
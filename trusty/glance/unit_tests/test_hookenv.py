@@ -0,0 +1,361 @@
+import json
+import os
+import unittest
+
+import yaml
+
+from mock import patch, MagicMock
+
+from charmhelpers.core import hookenv
+
+
+class HookCacheStatsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        for name, value in [('cache', hookenv.HookCache()),
+                            ('_log_buffer', None),
+                            ('stdlib_atexit', MagicMock())]:
+            patcher = patch.object(hookenv, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        hookenv.cache.set('config', ((), ()), {})
+        hookenv.cache.get('config', ((), ()))
+
+    @patch.object(hookenv, '_juju_log')
+    def test_stats_logged_at_exit_with_log_buffering(self, _juju_log):
+        hookenv.enable_log_buffering()
+        self.assertFalse(_juju_log.called)
+        for args, kwargs in hookenv.stdlib_atexit.register.call_args_list:
+            args[0](*args[1:], **kwargs)
+        self.assertIn('cache config: 1 hits, 0 misses, 1 entries',
+                      _juju_log.call_args[0][0])
+
+    @patch('charmhelpers.core.tracing.Tracer')
+    @patch.object(hookenv, 'log')
+    def test_stats_logged_at_exit_with_tracing(self, log, Tracer):
+        hooks = hookenv.Hooks(trace=True)
+        hooks.register('install', MagicMock())
+        hooks.execute(['install'])
+        log.assert_any_call('cache config: 1 hits, 0 misses, 1 entries',
+                            level=hookenv.DEBUG)
+
+    @patch.object(hookenv, 'log')
+    def test_stats_not_logged_by_default(self, log):
+        hooks = hookenv.Hooks(trace=False)
+        hooks.register('install', MagicMock())
+        hooks.execute(['install'])
+        self.assertFalse(log.called)
+
+
+class CachedTestCase(unittest.TestCase):
+
+    def setUp(self):
+        patcher = patch.object(hookenv, 'cache', hookenv.HookCache())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_same_name_in_different_modules(self):
+        def make(module, result):
+            def get_admin_token():
+                return result
+            get_admin_token.__module__ = module
+            return hookenv.cached(get_admin_token)
+
+        charm = make('keystone_utils', 'charm-token')
+        helper = make('charmhelpers.contrib.openstack.utils', 'other-token')
+        self.assertEquals(charm(), 'charm-token')
+        self.assertEquals(helper(), 'other-token')
+        self.assertEquals(
+            sorted(hookenv.cache.stats()),
+            ['charmhelpers.contrib.openstack.utils.get_admin_token',
+             'keystone_utils.get_admin_token'])
+
+
+class FakeHookTools(object):
+    """Answers relation hook tool calls from an in-memory model"""
+
+    def __init__(self, relations):
+        self.relations = relations
+        self.calls = []
+
+    def check_output(self, cmd, **kwargs):
+        self.calls.append(cmd)
+        if cmd[0] == 'relation-set':
+            return 'usage: relation-set [options] --file <path>'
+        if cmd[0] == 'relation-ids':
+            return json.dumps(sorted(
+                rid for rid in self.relations
+                if rid.split(':')[0] == cmd[-1])).encode('UTF-8')
+        if cmd[0] == 'relation-list':
+            return json.dumps(sorted(
+                unit for unit in self.relations[cmd[-1]]
+                if unit != os.environ['JUJU_UNIT_NAME'])).encode('UTF-8')
+        if cmd[0] == 'relation-get':
+            args = cmd[2:]
+            rid = os.environ['JUJU_RELATION_ID']
+            if args[0] == '-r':
+                rid, args = args[1], args[2:]
+            attribute = args[0]
+            unit = args[1] if len(args) > 1 else os.environ['JUJU_REMOTE_UNIT']
+            settings = self.relations[rid].get(unit)
+            if attribute != '-':
+                settings = (settings or {}).get(attribute)
+            return json.dumps(settings).encode('UTF-8')
+        raise AssertionError('unexpected command %s' % cmd)
+
+    def check_call(self, cmd, **kwargs):
+        self.calls.append(cmd)
+        assert cmd[0] == 'relation-set' and cmd[3] == '--file', cmd
+        with open(cmd[4]) as settings_file:
+            settings = yaml.safe_load(settings_file)
+        local = self.relations[cmd[2]].setdefault(
+            os.environ['JUJU_UNIT_NAME'], {})
+        for key, value in settings.items():
+            if value is None:
+                local.pop(key, None)
+            else:
+                local[key] = value
+
+    def count(self, tool):
+        return len([cmd for cmd in self.calls if cmd[0] == tool])
+
+
+class HookToolsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tools = FakeHookTools({
+            'cluster:1': {
+                'glance/0': {'private-address': '10.0.0.10'},
+                'glance/1': {'private-address': '10.0.0.11',
+                             'ready': 'yes'},
+                'glance/2': {'private-address': '10.0.0.12'},
+            },
+        })
+        for name, value in [('cache', hookenv.HookCache()),
+                            ('_atexit', []),
+                            ('_relation_snapshot', None),
+                            ('_relation_set_buffer', None)]:
+            patcher = patch.object(hookenv, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        for name in ('check_output', 'check_call'):
+            patcher = patch.object(hookenv.subprocess, name,
+                                   getattr(self.tools, name))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = patch.dict(os.environ, {'JUJU_UNIT_NAME': 'glance/0',
+                                          'JUJU_RELATION': 'cluster',
+                                          'JUJU_RELATION_ID': 'cluster:1',
+                                          'JUJU_REMOTE_UNIT': 'glance/1'})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+class RelationSnapshotTestCase(HookToolsTestCase):
+
+    def setUp(self):
+        super(RelationSnapshotTestCase, self).setUp()
+        hookenv.enable_relation_snapshot()
+
+    def test_one_relation_get_per_unit(self):
+        self.assertEquals(hookenv.relation_get('private-address'),
+                          '10.0.0.11')
+        self.assertEquals(hookenv.relation_get('ready'), 'yes')
+        self.assertEquals(hookenv.relation_get(), {
+            'private-address': '10.0.0.11', 'ready': 'yes'})
+        self.assertEquals(
+            hookenv.relation_get('ready', unit='glance/2', rid='cluster:1'),
+            None)
+        self.assertEquals(self.tools.count('relation-get'), 2)
+
+    def test_walk_relations(self):
+        addresses = []
+        for _ in range(2):
+            addresses = [hookenv.relation_get('private-address', unit, rid)
+                         for rid in hookenv.relation_ids('cluster')
+                         for unit in hookenv.related_units(rid)]
+        self.assertEquals(addresses, ['10.0.0.11', '10.0.0.12'])
+        self.assertEquals(self.tools.count('relation-ids'), 1)
+        self.assertEquals(self.tools.count('relation-list'), 1)
+        self.assertEquals(self.tools.count('relation-get'), 2)
+
+    def test_preload(self):
+        with patch.object(hookenv, 'relation_types') as relation_types:
+            relation_types.return_value = ['cluster']
+            hookenv.enable_relation_snapshot(preload=True)
+        self.assertEquals(self.tools.count('relation-get'), 2)
+        hookenv.relation_get('private-address', 'glance/2', 'cluster:1')
+        self.assertEquals(self.tools.count('relation-get'), 2)
+
+    def test_relation_set_invalidates_local_unit(self):
+        self.assertEquals(
+            hookenv.relation_get('ready', 'glance/0', 'cluster:1'), None)
+        self.assertEquals(
+            hookenv.relation_get('ready', 'glance/1', 'cluster:1'), 'yes')
+        hookenv.relation_set('cluster:1', ready='no')
+        self.assertEquals(
+            hookenv.relation_get('ready', 'glance/0', 'cluster:1'), 'no')
+        self.assertEquals(
+            hookenv.relation_get('ready', 'glance/1', 'cluster:1'), 'yes')
+        # Only the local unit was read again.
+        self.assertEquals(self.tools.count('relation-get'), 3)
+
+    def test_disable(self):
+        hookenv.relation_get('ready')
+        hookenv.disable_relation_snapshot()
+        self.assertEquals(hookenv.relation_snapshot(), None)
+        self.assertEquals(hookenv.relation_get('ready'), 'yes')
+        self.assertEquals(self.tools.count('relation-get'), 2)
+
+
+class RelationSetBufferingTestCase(HookToolsTestCase):
+
+    def setUp(self):
+        super(RelationSetBufferingTestCase, self).setUp()
+        self.tools.relations['identity-service:2'] = {
+            'keystone/0': {'service_host': '10.0.0.20'}}
+        hookenv.enable_relation_set_buffering()
+
+    def local_settings(self, rid):
+        return self.tools.relations[rid].get('glance/0', {})
+
+    def test_writes_coalesced_per_relation(self):
+        hookenv.relation_set(ready='no', hostname='glance-0')
+        hookenv.relation_set('cluster:1', {'ready': 'yes'}, port=9292)
+        hookenv.relation_set('identity-service:2', service='glance')
+        self.assertEquals(self.tools.count('relation-set'), 0)
+        hookenv._run_atexit()
+        self.assertEquals(
+            [cmd[2] for cmd in self.tools.calls if cmd[0] == 'relation-set'
+             and cmd[1] == '-r'],
+            ['cluster:1', 'identity-service:2'])
+        self.assertEquals(self.local_settings('cluster:1'), {
+            'private-address': '10.0.0.10', 'ready': 'yes',
+            'hostname': 'glance-0', 'port': '9292'})
+        self.assertEquals(self.local_settings('identity-service:2'),
+                          {'service': 'glance'})
+
+    def test_unset_key_buffered(self):
+        hookenv.relation_set(ready='yes')
+        hookenv.relation_set(ready=None)
+        hookenv._run_atexit()
+        self.assertEquals(self.local_settings('cluster:1'),
+                          {'private-address': '10.0.0.10'})
+
+    def test_local_relation_get_flushes_relation(self):
+        hookenv.relation_set('cluster:1', ready='yes')
+        hookenv.relation_set('identity-service:2', service='glance')
+        self.assertEquals(
+            hookenv.relation_get('ready', 'glance/0', 'cluster:1'), 'yes')
+        self.assertEquals(self.local_settings('cluster:1')['ready'], 'yes')
+        # Other relations stay buffered until the hook exits.
+        self.assertEquals(self.local_settings('identity-service:2'), {})
+        hookenv._run_atexit()
+        self.assertEquals(self.local_settings('identity-service:2'),
+                          {'service': 'glance'})
+
+    def test_remote_relation_get_does_not_flush(self):
+        hookenv.relation_set('cluster:1', ready='yes')
+        self.assertEquals(
+            hookenv.relation_get('ready', 'glance/1', 'cluster:1'), 'yes')
+        self.assertEquals(self.tools.count('relation-set'), 0)
+
+    def test_relation_flush(self):
+        hookenv.relation_set('cluster:1', ready='yes')
+        hookenv.relation_flush('cluster:1')
+        hookenv.relation_flush()
+        hookenv._run_atexit()
+        self.assertEquals(self.tools.count('relation-set'), 2)
+
+    def test_accepts_file_checked_once(self):
+        hookenv.relation_set('cluster:1', ready='yes')
+        hookenv.relation_flush()
+        hookenv.relation_set('identity-service:2', service='glance')
+        hookenv.relation_flush()
+        self.assertEquals(
+            [cmd for cmd in self.tools.calls if cmd[0] == 'relation-set' and
+             cmd[1] == '--help'],
+            [['relation-set', '--help']])
+
+
+class LogBufferTestCase(unittest.TestCase):
+
+    def setUp(self):
+        for name, value in [('cache', hookenv.HookCache()),
+                            ('_log_buffer', None),
+                            ('stdlib_atexit', MagicMock())]:
+            patcher = patch.object(hookenv, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = patch.object(hookenv, '_juju_log')
+        self._juju_log = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def run_exit_handlers(self):
+        for args, kwargs in hookenv.stdlib_atexit.register.call_args_list:
+            args[0](*args[1:], **kwargs)
+
+    def written(self):
+        return [c[0] for c in self._juju_log.call_args_list]
+
+    def test_order_kept_across_levels(self):
+        hookenv.enable_log_buffering()
+        hookenv.log('one')
+        hookenv.log('two')
+        hookenv.log('three', level=hookenv.WARNING)
+        hookenv.log('four')
+        self.assertEquals(self.written(), [])
+        self.run_exit_handlers()
+        self.assertEquals(self.written(), [('one\ntwo', None),
+                                           ('three', hookenv.WARNING),
+                                           ('four', None)])
+
+    def test_threshold_drops_messages(self):
+        hookenv.enable_log_buffering(level=hookenv.INFO)
+        hookenv.log('debug', level=hookenv.DEBUG)
+        hookenv.log('info', level=hookenv.INFO)
+        hookenv.log('default')
+        hookenv.log('custom', level='TRACE')
+        self.run_exit_handlers()
+        self.assertEquals(self.written(), [('info', hookenv.INFO),
+                                           ('default', None),
+                                           ('custom', 'TRACE')])
+
+    def test_flushed_when_full(self):
+        hookenv.enable_log_buffering(maxsize=3)
+        for i in range(4):
+            hookenv.log(str(i))
+        self.assertEquals(self.written(), [('0\n1\n2', None)])
+        self.run_exit_handlers()
+        self.assertEquals(self.written(), [('0\n1\n2', None), ('3', None)])
+
+    def test_error_not_delayed(self):
+        hookenv.enable_log_buffering()
+        hookenv.log('starting', level=hookenv.DEBUG)
+        hookenv.log('failed', level=hookenv.ERROR)
+        self.assertEquals(self.written(), [('starting', hookenv.DEBUG),
+                                           ('failed', hookenv.ERROR)])
+        hookenv.log('gave up', level=hookenv.CRITICAL)
+        self.assertEquals(self.written()[-1], ('gave up', hookenv.CRITICAL))
+
+    def test_flushed_when_hook_fails(self):
+        hookenv.enable_log_buffering()
+        hooks = hookenv.Hooks(trace=False)
+
+        def install():
+            hookenv.log('installing')
+            raise ValueError('boom')
+
+        hooks.register('install', install)
+        self.assertRaises(ValueError, hooks.execute, ['install'])
+        self.assertEquals(self.written(), [])
+        self.run_exit_handlers()
+        self.assertEquals(self.written(), [('installing', None)])
+
+    def test_enable_twice_updates_settings(self):
+        log_buffer = hookenv.enable_log_buffering()
+        self.assertIs(hookenv.enable_log_buffering(hookenv.INFO, 10),
+                      log_buffer)
+        self.assertEquals((log_buffer.level, log_buffer.maxsize),
+                          (hookenv.INFO, 10))
+        self.assertEquals(hookenv.stdlib_atexit.register.call_count, 1)
@@ -0,0 +1,65 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import patch, call
+
+from charmhelpers.core import host
+
+
+class RestartOnChangeTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.conf = os.path.join(self.tmpdir, 'glance-api.conf')
+        self.write(self.conf, 'debug = False\n')
+        patcher = patch.object(host, 'service')
+        self.service = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch.object(host, '_file_changes', [])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def write(self, path, content):
+        with open(path, 'w') as f:
+            f.write(content)
+
+    def run_hook(self, hook):
+        host.restart_on_change({self.conf: ['glance-api']})(hook)()
+
+    def test_change_outside_renderer(self):
+        # eg. a package upgrade, or charm code writing the file directly
+        self.run_hook(lambda: self.write(self.conf, 'debug = True\n'))
+        self.service.assert_called_once_with('restart', 'glance-api')
+
+    def test_unchanged(self):
+        self.run_hook(lambda: self.write(self.conf, 'debug = False\n'))
+        self.assertFalse(self.service.called)
+
+    @patch.object(host, 'path_hash')
+    def test_reported_change_not_hashed_again(self, path_hash):
+        path_hash.return_value = 'unchanged'
+
+        def hook():
+            self.write(self.conf, 'debug = True\n')
+            host.record_file_change(self.conf)
+
+        self.run_hook(hook)
+        path_hash.assert_called_once_with(self.conf)
+        self.service.assert_called_once_with('restart', 'glance-api')
+
+    def test_change_reported_before_hook_ignored(self):
+        host.record_file_change(self.conf)
+        self.run_hook(lambda: None)
+        self.assertFalse(self.service.called)
+
+    def test_stopstart(self):
+        hook = host.restart_on_change({self.conf: ['glance-api']},
+                                      stopstart=True)(
+            lambda: self.write(self.conf, 'debug = True\n'))
+        hook()
+        self.assertEquals(self.service.call_args_list,
+                          [call('stop', 'glance-api'),
+                           call('start', 'glance-api')])
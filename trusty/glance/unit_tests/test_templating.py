@@ -0,0 +1,88 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import patch
+
+from charmhelpers.contrib.openstack import templating
+
+
+class ExternalContext(object):
+    """A context generator reading state outside of Juju, eg. a file"""
+
+    interfaces = ['external']
+
+    def __init__(self, state):
+        self.state = state
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return {'value': self.state['value']}
+
+
+class OSConfigRendererTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        templates = os.path.join(self.tmpdir, 'templates')
+        os.mkdir(templates)
+        for name in ('api.conf', 'registry.conf'):
+            with open(os.path.join(templates, name), 'w') as f:
+                f.write('value = {{ value }}\n')
+        for name in ('log', 'record_file_change'):
+            patcher = patch.object(templating, name)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.state = {'value': 1}
+        self.context = ExternalContext(self.state)
+        self.renderer = templating.OSConfigRenderer(templates, 'icehouse')
+        self.api_conf = os.path.join(self.tmpdir, 'api.conf')
+        self.registry_conf = os.path.join(self.tmpdir, 'registry.conf')
+        for config_file in (self.api_conf, self.registry_conf):
+            self.renderer.register(config_file, [self.context])
+
+    def read(self, path):
+        with open(path) as f:
+            return f.read()
+
+    def test_write_all_evaluates_shared_context_once(self):
+        self.assertEquals(sorted(self.renderer.write_all()),
+                          [self.api_conf, self.registry_conf])
+        self.assertEquals(self.context.calls, 1)
+        self.assertEquals(self.read(self.api_conf), 'value = 1')
+        self.assertEquals(self.read(self.registry_conf), 'value = 1')
+
+    def test_complete_contexts_evaluates_shared_context_once(self):
+        self.assertEquals(self.renderer.complete_contexts(),
+                          ['external', 'external'])
+        self.assertEquals(self.context.calls, 1)
+
+    def test_input_changed_mid_hook(self):
+        self.renderer.write_all()
+        self.state['value'] = 2
+        self.assertTrue(self.renderer.write(self.api_conf))
+        self.assertEquals(self.read(self.api_conf), 'value = 2')
+        self.state['value'] = 3
+        self.renderer.write_all()
+        self.assertEquals(self.read(self.registry_conf), 'value = 3')
+        self.assertEquals(self.context.calls, 3)
+
+    def test_complete_contexts_then_write_all(self):
+        self.renderer.complete_contexts()
+        self.state['value'] = 2
+        self.renderer.write_all()
+        self.assertEquals(self.read(self.api_conf), 'value = 2')
+        self.assertEquals(self.context.calls, 2)
+
+    def test_unchanged_file_not_rewritten(self):
+        self.renderer.write_all()
+        templating.record_file_change.reset_mock()
+        self.assertEquals(self.renderer.write_all(), [])
+        self.assertFalse(templating.record_file_change.called)
+        with open(self.api_conf, 'w') as f:
+            f.write('edited\n')
+        self.assertEquals(self.renderer.write_all(), [self.api_conf])
+        templating.record_file_change.assert_called_once_with(self.api_conf)
@@ -0,0 +1,48 @@
+import tempfile
+import threading
+import unittest
+
+from subprocess import check_call, check_output
+
+from charmhelpers.core import tracing
+
+
+class TracerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tracer = tracing.Tracer('install')
+        self.tracer.install()
+        self.addCleanup(self.tracer.uninstall)
+
+    def test_traces_calls_imported_before_install(self):
+        check_call(['true'])
+        check_output(['echo', 'hello'])
+        self.assertEquals(
+            [(e['name'], e['cat']) for e in self.tracer.events],
+            [('true', 'subprocess'), ('echo', 'subprocess')])
+        self.assertEquals(self.tracer.events[1]['args'],
+                          {'argv': ['echo', 'hello']})
+
+    def test_hook_tools(self):
+        check_call(['juju-log', 'message'], shell=False,
+                   executable='true', stdout=tempfile.TemporaryFile())
+        self.assertEquals(self.tracer.events[0]['cat'], 'hook-tool')
+
+    def test_spans_per_thread(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def run():
+            with self.tracer.span('worker', 'task'):
+                started.set()
+                release.wait()
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        started.wait()
+        with self.tracer.span('main', 'task'):
+            self.assertEquals(self.tracer._stack, ['task'])
+            release.set()
+            thread.join()
+        self.assertEquals(sorted(e['name'] for e in self.tracer.events),
+                          ['main', 'worker'])
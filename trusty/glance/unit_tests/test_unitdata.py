@@ -0,0 +1,124 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import patch
+
+from charmhelpers.core import unitdata
+
+
+class StorageUpdateTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.batched = unitdata.Storage(':memory:')
+        self.single = unitdata.Storage(':memory:')
+
+    def rows(self, db):
+        db.cursor.execute('select key, data from kv order by key')
+        kv = db.cursor.fetchall()
+        db.cursor.execute('select key, revision, data from kv_revisions '
+                          'order by revision, key')
+        return kv, db.cursor.fetchall()
+
+    def store(self, mapping, prefix=''):
+        self.batched.update(mapping, prefix=prefix)
+        for key, value in mapping.items():
+            self.single.set('%s%s' % (prefix, key), value)
+
+    def test_matches_set(self):
+        mappings = [
+            {'a': 1, 'b': [1, 2], 'c': {'d': True}, 'e': None},
+            {'a': 1, 'b': [1, 2, 3], 'f': 'new'},
+            {'a': 2},
+        ]
+        for i, mapping in enumerate(mappings):
+            with self.batched.hook_scope('hook-%d' % i):
+                with self.single.hook_scope('hook-%d' % i):
+                    self.store(mapping, prefix='p.')
+        self.assertEquals(self.rows(self.batched), self.rows(self.single))
+        kv, revisions = self.rows(self.batched)
+        # Unchanged values get no new revision.
+        self.assertEquals(
+            [(key, revision) for key, revision, _ in revisions],
+            [('p.a', 1), ('p.b', 1), ('p.c', 1), ('p.e', 1),
+             ('p.b', 2), ('p.f', 2), ('p.a', 3)])
+        self.assertEquals(self.batched.get('p.a'), 2)
+
+    def test_matches_set_over_batch_size(self):
+        mapping = dict(('key.%d' % i, i) for i in range(1200))
+        self.store(mapping)
+        self.store(dict(mapping, **{'key.7': 'changed', 'key.1100': None}))
+        self.assertEquals(self.rows(self.batched), self.rows(self.single))
+        self.assertEquals(len(self.rows(self.batched)[0]), 1200)
+
+    @patch.object(unitdata, '_SQL_BATCH', 2)
+    def test_reads_in_batches(self):
+        self.batched.set('b', 1)
+        self.batched.update({'a': 1, 'b': 1, 'c': 1, 'd': 1, 'e': 1})
+        self.assertEquals(self.batched.getrange(''),
+                          dict((k, 1) for k in 'abcde'))
+
+
+class StorageCompactTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.db = unitdata.Storage(':memory:')
+
+    def run_hooks(self, count):
+        for i in range(count):
+            with self.db.hook_scope('hook-%d' % i):
+                self.db.set('x', i)
+
+    def history(self):
+        self.db.cursor.execute('select version from hooks order by version')
+        hooks = [row[0] for row in self.db.cursor.fetchall()]
+        self.db.cursor.execute(
+            'select revision, data from kv_revisions order by revision')
+        return hooks, self.db.cursor.fetchall()
+
+    def test_keeps_last_revisions(self):
+        self.db.history_retention = 3
+        self.run_hooks(5)
+        self.assertEquals(self.history(),
+                          ([3, 4, 5], [(3, '2'), (4, '3'), (5, '4')]))
+        self.assertEquals(self.db.get('x'), 4)
+
+    def test_fewer_hooks_than_retention(self):
+        self.db.history_retention = 3
+        self.run_hooks(3)
+        self.assertEquals(self.history()[0], [1, 2, 3])
+
+    def test_default_retention(self):
+        self.run_hooks(unitdata.HISTORY_RETENTION + 2)
+        hooks, revisions = self.history()
+        self.assertEquals(len(hooks), unitdata.HISTORY_RETENTION)
+        self.assertEquals(hooks[0], 3)
+        self.assertEquals(len(revisions), unitdata.HISTORY_RETENTION)
+
+    def test_retention_disabled(self):
+        self.db.history_retention = None
+        self.run_hooks(5)
+        self.assertEquals(self.history()[0], [1, 2, 3, 4, 5])
+
+    def test_explicit_compact(self):
+        self.db.history_retention = None
+        self.run_hooks(5)
+        self.db.compact(keep=2)
+        self.assertEquals(self.history(), ([4, 5], [(4, '3'), (5, '4')]))
+
+
+class StorageJournalTestCase(unittest.TestCase):
+
+    def test_wal(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        db = unitdata.Storage(os.path.join(tmpdir, 'unit-state.db'))
+        self.addCleanup(db.close)
+        db.cursor.execute('pragma journal_mode')
+        self.assertEquals(db.cursor.fetchone()[0], 'wal')
+        db.set('x', 1)
+        db.flush()
+        other = unitdata.Storage(os.path.join(tmpdir, 'unit-state.db'))
+        self.addCleanup(other.close)
+        self.assertEquals(other.get('x'), 1)
@@ -0,0 +1,31 @@
+# Copyright 2014-2015 Canonical Limited.
+#
+# This file is part of charm-helpers.
+#
+# charm-helpers is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# charm-helpers is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with charm-helpers.  If not, see <http://www.gnu.org/licenses/>.
+
+from . import cmdline
+from charmhelpers.core import tracing
+
+
+@cmdline.subcommand_builder('trace-summary',
+                            description="Summarize recent hook traces")
+def trace_summary(subparser):
+    subparser.add_argument("--path", default=None,
+                           help="Trace directory (default: "
+                                "$CHARM_DIR/{})".format(tracing.TRACE_DIR))
+    subparser.add_argument("--limit", type=int, default=10,
+                           help="Number of recent hook runs to include")
+    subparser.add_argument("--top", type=int, default=20,
+                           help="Number of spans to report")
+    return tracing.summarize
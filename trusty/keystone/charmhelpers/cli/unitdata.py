@@ -37,3 +37,17 @@ def unitdata_cmd(subparser):
             unitdata.kv().flush()
             return ''
     return _unitdata_cmd
+
+
+@cmdline.subcommand_builder('unitdata-benchmark',
+                            description="Measure the per-hook cost of "
+                                        "storing unit data")
+def unitdata_benchmark(subparser):
+    subparser.add_argument("--keys", type=int, default=10000,
+                           help="Number of keys written per hook")
+    subparser.add_argument("--hooks", type=int, default=5,
+                           help="Number of hooks to average over")
+    subparser.add_argument("--changed", type=float, default=0.01,
+                           help="Fraction of values changed per hook in the "
+                                "partial update")
+    return unitdata.benchmark
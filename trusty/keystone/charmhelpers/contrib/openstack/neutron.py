@@ -354,3 +354,55 @@ def parse_vlan_range_mappings(mappings):
         mappings[p] = tuple(r.split(':'))
 
     return mappings
+
+
+# Number of resources requested per page by iter_neutron_resources()
+NEUTRON_PAGE_SIZE = 100
+
+
+def iter_neutron_resources(list_func, collection, fields=None,
+                           page_size=NEUTRON_PAGE_SIZE, **filters):
+    """Iterate over the Neutron resources matching filters.
+
+    Filters and the fields to return are passed to the Neutron API rather
+    than applied to a full listing, and results are fetched a page at a
+    time, so that looking up a handful of resources does not download
+    every network or router in the cloud. Pages are only requested as the
+    iteration reaches them.
+
+    Example::
+
+        for router in iter_neutron_resources(client.list_routers,
+                                             'routers', fields=['id'],
+                                             distributed=True):
+            ...
+
+    :param list_func: neutronclient listing method, eg.
+        ``client.list_networks``
+    :param collection: Key of the resources in each response, eg.
+        ``'networks'``
+    :param fields: List of attributes to return for each resource
+    :param page_size: Number of resources requested per page. Servers with
+        pagination disabled return all matches at once.
+    :param filters: Attribute values to filter on
+    """
+    params = dict(filters)
+    if fields:
+        params['fields'] = fields
+    if page_size:
+        params['limit'] = page_size
+    for page in list_func(retrieve_all=False, **params):
+        for resource in page[collection]:
+            yield resource
+
+
+def find_neutron_resource(list_func, collection, fields=None, **filters):
+    """Return the first Neutron resource matching filters, or None.
+
+    See :func:`iter_neutron_resources`; no further pages are requested once
+    a match is found.
+    """
+    for resource in iter_neutron_resources(list_func, collection,
+                                           fields=fields, **filters):
+        return resource
+    return None
@@ -15,29 +15,102 @@
 # along with charm-helpers.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import shutil
+from contextlib import contextmanager
 
 import six
 
 from charmhelpers.fetch import apt_install, apt_update
 from charmhelpers.core.hookenv import (
+    charm_dir,
     log,
+    DEBUG,
     ERROR,
-    INFO
+    INFO,
+    WARNING,
 )
+from charmhelpers.core.host import record_file_change
 from charmhelpers.contrib.openstack.utils import OPENSTACK_CODENAMES
 
 try:
-    from jinja2 import FileSystemLoader, ChoiceLoader, Environment, exceptions
+    from jinja2 import (
+        ChoiceLoader,
+        Environment,
+        FileSystemBytecodeCache,
+        FileSystemLoader,
+        exceptions,
+    )
 except ImportError:
     apt_update(fatal=True)
     apt_install('python-jinja2', fatal=True)
-    from jinja2 import FileSystemLoader, ChoiceLoader, Environment, exceptions
+    from jinja2 import (
+        ChoiceLoader,
+        Environment,
+        FileSystemBytecodeCache,
+        FileSystemLoader,
+        exceptions,
+    )
+
+
+# Directory under the charm dir holding compiled templates
+BYTECODE_CACHE_DIR = '.jinja2-cache'
 
 
 class OSConfigException(Exception):
     pass
 
 
+# Results of context generators keyed by generator id, while inside a
+# shared_contexts() block.
+_context_results = None
+
+
+@contextmanager
+def shared_contexts():
+    """
+    Evaluate each context generator at most once inside the with block.
+
+    Used by OSConfigRenderer.write_all() and complete_contexts(), where
+    generators shared between config files would otherwise run once per
+    file. Results are dropped when the outermost block exits, so the next
+    write() or pass runs generators again and sees any state, on disk or
+    elsewhere, that changed in between.
+    """
+    global _context_results
+    if _context_results is not None:
+        yield
+        return
+    _context_results = {}
+    try:
+        yield
+    finally:
+        _context_results = None
+
+
+def evaluate_context(context):
+    """
+    Call a context generator, reusing its result if it already ran in the
+    current shared_contexts() block.
+    """
+    if _context_results is None:
+        return context()
+    result = _context_results.get(id(context))
+    if result is not None and result[0] is context:
+        return result[1]
+    ctxt = context()
+    _context_results[id(context)] = (context, ctxt)
+    return ctxt
+
+
+def flush_context_cache():
+    """
+    Forget context generator results of the current shared_contexts()
+    block, eg. after changing state on disk that generators inspect.
+    """
+    if _context_results is not None:
+        _context_results.clear()
+
+
 def get_loader(templates_dir, os_release):
     """
     Create a jinja2.ChoiceLoader containing template dirs up to
@@ -101,22 +174,22 @@ class OSConfigTemplate(object):
 
     def context(self):
         ctxt = {}
+        complete_contexts = []
         for context in self.contexts:
-            _ctxt = context()
+            _ctxt = evaluate_context(context)
             if _ctxt:
                 ctxt.update(_ctxt)
                 # track interfaces for every complete context.
-                [self._complete_contexts.append(interface)
+                [complete_contexts.append(interface)
                  for interface in context.interfaces
-                 if interface not in self._complete_contexts]
+                 if interface not in complete_contexts]
+        self._complete_contexts = complete_contexts
         return ctxt
 
     def complete_contexts(self):
         '''
         Return a list of interfaces that have satisfied contexts.
         '''
-        if self._complete_contexts:
-            return self._complete_contexts
         self.context()
         return self._complete_contexts
 
@@ -220,10 +293,42 @@ class OSConfigRenderer(object):
                                                        contexts=contexts)
         log('Registered config file: %s' % config_file, level=INFO)
 
+    def _bytecode_cache_dir(self):
+        """
+        Directory for compiled templates of the current charm revision and
+        OpenStack release, or None outside of a charm.
+
+        Jinja2 checks each cached template against a checksum of its source,
+        so edited templates are recompiled even within the same directory.
+        """
+        if not charm_dir():
+            return None
+        revision = '0'
+        revision_file = os.path.join(charm_dir(), 'revision')
+        if os.path.exists(revision_file):
+            with open(revision_file) as f:
+                revision = f.read().strip() or revision
+        return os.path.join(charm_dir(), BYTECODE_CACHE_DIR,
+                            '%s-%s' % (revision, self.openstack_release))
+
+    def _bytecode_cache(self):
+        cache_dir = self._bytecode_cache_dir()
+        if cache_dir is None:
+            return None
+        try:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+        except OSError as e:
+            log('Unable to create template cache %s: %s' % (cache_dir, e),
+                level=WARNING)
+            return None
+        return FileSystemBytecodeCache(cache_dir)
+
     def _get_tmpl_env(self):
         if not self._tmpl_env:
             loader = get_loader(self.templates_dir, self.openstack_release)
-            self._tmpl_env = Environment(loader=loader)
+            self._tmpl_env = Environment(loader=loader,
+                                         bytecode_cache=self._bytecode_cache())
 
     def _get_template(self, template):
         self._get_tmpl_env()
@@ -231,12 +336,10 @@ class OSConfigRenderer(object):
         log('Loaded template from %s' % template.filename, level=INFO)
         return template
 
-    def render(self, config_file):
-        if config_file not in self.templates:
-            log('Config not registered: %s' % config_file, level=ERROR)
-            raise OSConfigException
-        ctxt = self.templates[config_file].context()
-
+    def _load_template(self, config_file):
+        """
+        Find the template for config_file, returning it along with its name.
+        """
         _tmpl = os.path.basename(config_file)
         try:
             template = self._get_template(_tmpl)
@@ -252,30 +355,78 @@ class OSConfigRenderer(object):
                     (self.templates_dir, os.path.basename(config_file), _tmpl),
                     level=ERROR)
                 raise e
+        return template, _tmpl
+
+    def render(self, config_file):
+        if config_file not in self.templates:
+            log('Config not registered: %s' % config_file, level=ERROR)
+            raise OSConfigException
+        ctxt = self.templates[config_file].context()
 
+        template, _tmpl = self._load_template(config_file)
         log('Rendering from template: %s' % _tmpl, level=INFO)
         return template.render(ctxt)
 
+    def precompile(self):
+        """
+        Compile the templates of all registered config files into the
+        on-disk bytecode cache, so that later hooks can skip parsing them.
+        Caches left behind by other charm revisions or releases are
+        removed. Intended to be called from install and upgrade-charm hooks.
+        """
+        cache_dir = self._bytecode_cache_dir()
+        if cache_dir is None:
+            return
+        parent = os.path.dirname(cache_dir)
+        if os.path.isdir(parent):
+            for entry in os.listdir(parent):
+                path = os.path.join(parent, entry)
+                if path != cache_dir and os.path.isdir(path):
+                    shutil.rmtree(path, ignore_errors=True)
+        for config_file in self.templates:
+            try:
+                self._load_template(config_file)
+            except exceptions.TemplateError:
+                # Reported by _load_template; rendering will fail later.
+                pass
+
     def write(self, config_file):
         """
         Write a single config file, raises if config file is not registered.
+
+        The file is left untouched if it already holds the rendered
+        content. Returns True if the file was changed.
         """
         if config_file not in self.templates:
             log('Config not registered: %s' % config_file, level=ERROR)
             raise OSConfigException
 
         _out = self.render(config_file)
+        if isinstance(_out, six.text_type):
+            _out = _out.encode('utf-8')
+        try:
+            with open(config_file, 'rb') as current:
+                unchanged = current.read() == _out
+        except IOError:
+            unchanged = False
+        if unchanged:
+            log('Template %s unchanged.' % config_file, level=DEBUG)
+            return False
 
         with open(config_file, 'wb') as out:
             out.write(_out)
 
+        record_file_change(config_file)
         log('Wrote template %s.' % config_file, level=INFO)
+        return True
 
     def write_all(self):
         """
-        Write out all registered config files.
+        Write out all registered config files. Returns the list of files
+        that changed.
         """
-        [self.write(k) for k in six.iterkeys(self.templates)]
+        with shared_contexts():
+            return [k for k in six.iterkeys(self.templates) if self.write(k)]
 
     def set_release(self, openstack_release):
         """
@@ -284,6 +435,7 @@ class OSConfigRenderer(object):
         """
         self._tmpl_env = None
         self.openstack_release = openstack_release
+        flush_context_cache()
         self._get_tmpl_env()
 
     def complete_contexts(self):
@@ -291,8 +443,9 @@ class OSConfigRenderer(object):
         Returns a list of context interfaces that yield a complete context.
         '''
         interfaces = []
-        [interfaces.extend(i.complete_contexts())
-         for i in six.itervalues(self.templates)]
+        with shared_contexts():
+            [interfaces.extend(i.complete_contexts())
+             for i in six.itervalues(self.templates)]
         return interfaces
 
     def get_incomplete_context_data(self, interfaces):
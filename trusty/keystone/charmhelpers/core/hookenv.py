@@ -21,7 +21,9 @@
 #  Charm Helpers Developers <juju@lists.ubuntu.com>
 
 from __future__ import print_function
+import atexit as stdlib_atexit
 import copy
+from collections import OrderedDict
 from distutils.version import LooseVersion
 from functools import wraps
 import glob
@@ -47,7 +49,96 @@ INFO = "INFO"
 DEBUG = "DEBUG"
 MARKER = object()
 
-cache = {}
+class HookCache(object):
+    """Memoized results of hook tool calls for the duration of a hook.
+
+    Entries live in one namespace per cached function and are keyed on a
+    tuple of the call arguments. Every string argument (a unit name, a
+    relation id, a config key...) is indexed, so :meth:`flush` drops the
+    entries that mention it without scanning the rest of the cache.
+
+    If ``maxsize`` is set, each namespace holds at most that many entries
+    and the least recently used ones are evicted first. Hit and miss
+    counts are kept per namespace and logged by :meth:`log_stats`, which
+    runs at the end of the hook when log buffering or tracing is enabled.
+    """
+
+    def __init__(self, maxsize=None):
+        self.maxsize = maxsize
+        self._data = {}
+        self._index = {}
+        self._stats = {}
+
+    @staticmethod
+    def _tags(key):
+        args, kwargs = key
+        values = list(args) + [v for _, v in kwargs]
+        return set(v for v in values if isinstance(v, six.string_types))
+
+    def _counters(self, namespace):
+        return self._stats.setdefault(namespace, {'hits': 0, 'misses': 0})
+
+    def get(self, namespace, key):
+        """Return the cached value, raising KeyError on a miss"""
+        entries = self._data.get(namespace)
+        if entries is None or key not in entries:
+            self._counters(namespace)['misses'] += 1
+            raise KeyError(key)
+        self._counters(namespace)['hits'] += 1
+        value = entries.pop(key)
+        entries[key] = value
+        return value
+
+    def set(self, namespace, key, value):
+        """Store value under key, evicting old entries if over maxsize"""
+        entries = self._data.setdefault(namespace, OrderedDict())
+        entries.pop(key, None)
+        entries[key] = value
+        for tag in self._tags(key):
+            self._index.setdefault(tag, set()).add((namespace, key))
+        if self.maxsize is not None:
+            while len(entries) > self.maxsize:
+                self._discard(namespace, next(iter(entries)))
+
+    def _discard(self, namespace, key):
+        self._data[namespace].pop(key, None)
+        for tag in self._tags(key):
+            refs = self._index.get(tag)
+            if refs is not None:
+                refs.discard((namespace, key))
+                if not refs:
+                    del self._index[tag]
+
+    def flush(self, tag):
+        """Drop every entry whose arguments include the string tag"""
+        for namespace, key in list(self._index.pop(tag, ())):
+            self._discard(namespace, key)
+
+    def clear(self):
+        """Drop every entry and reset the hit and miss counters"""
+        self._data.clear()
+        self._index.clear()
+        self._stats.clear()
+
+    def __len__(self):
+        return sum(len(entries) for entries in self._data.values())
+
+    def stats(self):
+        """Return a dict of hits, misses and size for each namespace"""
+        stats = {}
+        for namespace, counters in self._stats.items():
+            stats[namespace] = dict(
+                counters, size=len(self._data.get(namespace, ())))
+        return stats
+
+    def log_stats(self, level=DEBUG):
+        """Write the hit and miss counters to the juju log"""
+        for namespace, stats in sorted(self.stats().items()):
+            log('cache {}: {hits} hits, {misses} misses, {size} entries'
+                ''.format(namespace, **stats), level=level)
+
+
+cache = HookCache()
 
 
 def cached(func):
@@ -63,34 +154,43 @@ def cached(func):
 
     will cache the result of unit_get + 'test' for future calls.
     """
+    namespace = '%s.%s' % (func.__module__, func.__name__)
+
     @wraps(func)
     def wrapper(*args, **kwargs):
-        global cache
-        key = str((func, args, kwargs))
+        key = (args, tuple(sorted(kwargs.items())))
+        try:
+            hash(key)
+        except TypeError:
+            # Unhashable arguments can't be cached.
+            return func(*args, **kwargs)
         try:
-            return cache[key]
+            return cache.get(namespace, key)
         except KeyError:
             pass  # Drop out of the exception handler scope.
         res = func(*args, **kwargs)
-        cache[key] = res
+        cache.set(namespace, key, res)
         return res
     wrapper._wrapped = func
     return wrapper
 
 
 def flush(key):
-    """Flushes any entries from function cache where the
-    key is found in the function+args """
-    flush_list = []
-    for item in cache:
-        if key in item:
-            flush_list.append(item)
-    for item in flush_list:
-        del cache[item]
+    """Flushes any entries from function cache where key is one of the
+    arguments"""
+    cache.flush(key)
 
 
 def log(message, level=None):
     """Write a message to the juju log"""
+    if _log_buffer is not None:
+        _log_buffer.write(message, level)
+        return
+    _juju_log(message, level)
+
+
+def _juju_log(message, level=None):
+    """Run juju-log for a single message"""
     command = ['juju-log']
     if level:
         command += ['-l', level]
@@ -111,6 +211,90 @@ def log(message, level=None):
             raise
 
 
+LOG_LEVELS = (DEBUG, INFO, WARNING, ERROR, CRITICAL)
+
+
+class LogBuffer(object):
+    """Collects juju log messages and writes them out in batches.
+
+    Consecutive messages at the same level are joined into a single
+    juju-log call, so message order is preserved. Messages below the
+    ``level`` threshold are dropped before they are formatted; levels
+    that are not in :data:`LOG_LEVELS` are always kept. ERROR and CRITICAL
+    messages are written out straight away, along with everything queued
+    before them.
+
+    Do not instantiate this directly - call :func:`enable_log_buffering`,
+    which also makes sure the buffer is written out when the hook exits,
+    whether or not it succeeded.
+    """
+
+    def __init__(self, level=None, maxsize=100):
+        self.level = level
+        self.maxsize = maxsize
+        self._messages = []
+
+    def _dropped(self, level):
+        if self.level not in LOG_LEVELS or level not in LOG_LEVELS + (None,):
+            return False
+        return (LOG_LEVELS.index(level or INFO) <
+                LOG_LEVELS.index(self.level))
+
+    def write(self, message, level=None):
+        """Queue a message, writing the buffer out once it is full"""
+        if self._dropped(level):
+            return
+        if not isinstance(message, six.string_types):
+            message = repr(message)
+        self._messages.append((level, message))
+        if level in (ERROR, CRITICAL) or len(self._messages) >= self.maxsize:
+            self.flush()
+
+    def flush(self):
+        """Write out all queued messages"""
+        batch_level, batch = None, []
+        messages, self._messages = self._messages, []
+        for level, message in messages:
+            if batch and level != batch_level:
+                _juju_log('\n'.join(batch), batch_level)
+                batch = []
+            batch_level = level
+            batch.append(message)
+        if batch:
+            _juju_log('\n'.join(batch), batch_level)
+
+
+_log_buffer = None
+
+
+def enable_log_buffering(level=None, maxsize=100):
+    """Buffer log messages and write them out in batches
+
+    Messages below level are discarded. The buffer is written out every
+    maxsize messages, as soon as an ERROR or CRITICAL message is logged and
+    when the process exits, including when the hook fails with an exception.
+    """
+    global _log_buffer
+    if _log_buffer is None:
+        _log_buffer = LogBuffer(level, maxsize)
+        stdlib_atexit.register(_flush_log_at_exit)
+    else:
+        _log_buffer.level = level
+        _log_buffer.maxsize = maxsize
+    return _log_buffer
+
+
+def flush_log():
+    """Write out any buffered log messages"""
+    if _log_buffer is not None:
+        _log_buffer.flush()
+
+
+def _flush_log_at_exit():
+    cache.log_stats()
+    flush_log()
+
+
 class Serializable(UserDict):
     """Wrapper, an object that can be serialized to yaml or json"""
 
@@ -345,9 +529,17 @@ def config(scope=None):
         return None
 
 
-@cached
 def relation_get(attribute=None, unit=None, rid=None):
     """Get relation information"""
+    if _relation_set_buffer and unit is not None and unit == local_unit():
+        relation_flush(rid or os.environ.get('JUJU_RELATION_ID'))
+    if _relation_snapshot is not None:
+        return _relation_snapshot.get(attribute, unit, rid)
+    return _cached_relation_get(attribute, unit, rid)
+
+
+def _relation_get(attribute=None, unit=None, rid=None):
+    """Run relation-get, bypassing the cache and the relation snapshot"""
     _args = ['relation-get', '--format=json']
     if rid:
         _args.append('-r')
@@ -365,14 +557,17 @@ def relation_get(attribute=None, unit=None, rid=None):
         raise
 
 
+_cached_relation_get = cached(_relation_get)
+
+
 def relation_set(relation_id=None, relation_settings=None, **kwargs):
-    """Set relation information for the current unit"""
+    """Set relation information for the current unit
+
+    If :func:`enable_relation_set_buffering` has been called, the settings
+    are merged with any others written to the same relation during this
+    hook and only sent to Juju by :func:`relation_flush`.
+    """
     relation_settings = relation_settings if relation_settings else {}
-    relation_cmd_line = ['relation-set']
-    accepts_file = "--file" in subprocess.check_output(
-        relation_cmd_line + ["--help"], universal_newlines=True)
-    if relation_id is not None:
-        relation_cmd_line.extend(('-r', relation_id))
     settings = relation_settings.copy()
     settings.update(kwargs)
     for key, value in settings.items():
@@ -380,7 +575,26 @@ def relation_set(relation_id=None, relation_settings=None, **kwargs):
         # sites pass in things like dicts or numbers.
         if value is not None:
             settings[key] = "{}".format(value)
-    if accepts_file:
+    relid = relation_id or os.environ.get('JUJU_RELATION_ID')
+    if _relation_set_buffer is not None and relid is not None:
+        _relation_set_buffer.setdefault(relid, {}).update(settings)
+        return
+    _relation_set(relation_id, settings)
+
+
+@cached
+def _relation_set_accepts_file():
+    """Whether relation-set supports --file"""
+    return "--file" in subprocess.check_output(
+        ['relation-set', '--help'], universal_newlines=True)
+
+
+def _relation_set(relation_id, settings):
+    """Run relation-set and invalidate cached reads of the local unit"""
+    relation_cmd_line = ['relation-set']
+    if relation_id is not None:
+        relation_cmd_line.extend(('-r', relation_id))
+    if _relation_set_accepts_file():
         # --file was introduced in Juju 1.23.2. Use it by default if
         # available, since otherwise we'll break if the relation data is
         # too big. Ideally we should tell relation-set to read the data from
@@ -399,6 +613,41 @@ def relation_set(relation_id=None, relation_settings=None, **kwargs):
         subprocess.check_call(relation_cmd_line)
     # Flush cache of any relation-gets for local unit
     flush(local_unit())
+    if _relation_snapshot is not None:
+        _relation_snapshot.invalidate(relation_id or os.environ.get(
+            'JUJU_RELATION_ID'), local_unit())
+
+
+_relation_set_buffer = None
+
+
+def enable_relation_set_buffering():
+    """Buffer relation_set calls until the end of the hook
+
+    Settings written to the same relation id are merged, and each relation
+    is written with a single relation-set when the hook completes
+    successfully. Reading the local unit's settings with
+    :func:`relation_get` flushes that relation first, so reads still see
+    earlier writes.
+    """
+    global _relation_set_buffer
+    if _relation_set_buffer is None:
+        _relation_set_buffer = OrderedDict()
+        atexit(relation_flush)
+
+
+def relation_flush(relation_id=None):
+    """Write out settings buffered for relation_id, or for every relation"""
+    if not _relation_set_buffer:
+        return
+    if relation_id is None:
+        relids = list(_relation_set_buffer)
+    else:
+        relids = [relation_id]
+    for relid in relids:
+        settings = _relation_set_buffer.pop(relid, None)
+        if settings:
+            _relation_set(relid, settings)
 
 
 def relation_clear(r_id=None):
@@ -412,10 +661,16 @@ def relation_clear(r_id=None):
                  **settings)
 
 
-@cached
 def relation_ids(reltype=None):
     """A list of relation_ids"""
     reltype = reltype or relation_type()
+    if _relation_snapshot is not None and reltype is not None:
+        return _relation_snapshot.relation_ids(reltype)
+    return _cached_relation_ids(reltype)
+
+
+def _relation_ids(reltype):
+    """Run relation-ids, bypassing the cache and the relation snapshot"""
     relid_cmd_line = ['relation-ids', '--format=json']
     if reltype is not None:
         relid_cmd_line.append(reltype)
@@ -424,10 +679,19 @@ def relation_ids(reltype=None):
     return []
 
 
-@cached
+_cached_relation_ids = cached(_relation_ids)
+
+
 def related_units(relid=None):
     """A list of related units"""
     relid = relid or relation_id()
+    if _relation_snapshot is not None and relid is not None:
+        return _relation_snapshot.related_units(relid)
+    return _cached_related_units(relid)
+
+
+def _related_units(relid):
+    """Run relation-list, bypassing the cache and the relation snapshot"""
     units_cmd_line = ['relation-list', '--format=json']
     if relid is not None:
         units_cmd_line.extend(('-r', relid))
@@ -435,6 +699,118 @@ def related_units(relid=None):
         subprocess.check_output(units_cmd_line).decode('UTF-8')) or []
 
 
+_cached_related_units = cached(_related_units)
+
+
+class RelationSnapshot(object):
+    """An in-memory view of the relation data visible to the current hook.
+
+    Relation ids, related units and unit settings are read with one
+    ``relation-ids``, ``relation-list`` or ``relation-get`` call each the
+    first time they are needed, and served from memory after that. The
+    full settings of a unit are fetched at once, so reading several
+    attributes of the same unit costs a single ``relation-get``.
+
+    Juju does not change the set of relations or units visible to a hook
+    while it runs, so only the local unit's settings can go stale; these
+    are invalidated by :func:`relation_set`.
+
+    Do not instantiate this directly - call
+    :func:`enable_relation_snapshot` instead, which makes
+    :func:`relation_get`, :func:`relation_ids` and :func:`related_units`
+    read from the snapshot.
+    """
+
+    def __init__(self):
+        self._relation_ids = {}
+        self._units = {}
+        self._settings = {}
+
+    def relation_ids(self, reltype):
+        """A list of relation ids for reltype"""
+        if reltype not in self._relation_ids:
+            self._relation_ids[reltype] = _relation_ids(reltype)
+        return list(self._relation_ids[reltype])
+
+    def related_units(self, relid):
+        """A list of the units related on relid"""
+        if relid not in self._units:
+            self._units[relid] = _related_units(relid)
+        return list(self._units[relid])
+
+    def settings(self, relid, unit):
+        """The settings of unit on relid, or None if unavailable"""
+        key = (relid, unit)
+        if key not in self._settings:
+            self._settings[key] = _relation_get(unit=unit, rid=relid)
+        return self._settings[key]
+
+    def get(self, attribute=None, unit=None, rid=None):
+        """Get relation information, as :func:`relation_get`"""
+        rid = rid or os.environ.get('JUJU_RELATION_ID')
+        unit = unit or remote_unit()
+        if rid is None or unit is None:
+            # Let relation-get work out what the caller meant.
+            return _relation_get(attribute, unit, rid)
+        settings = self.settings(rid, unit)
+        if settings is None:
+            return None
+        if attribute is None:
+            return dict(settings)
+        return settings.get(attribute)
+
+    def load(self, relid):
+        """Load the settings of every unit related on relid"""
+        for unit in self.related_units(relid):
+            self.settings(relid, unit)
+
+    def load_all(self):
+        """Load the settings of every unit on every relation of the charm"""
+        for reltype in relation_types():
+            for relid in self.relation_ids(reltype):
+                self.load(relid)
+
+    def invalidate(self, relid=None, unit=None):
+        """Drop cached settings for unit on relid
+
+        Either argument may be None to match all relation ids or units.
+        """
+        for key in list(self._settings):
+            if relid is not None and key[0] != relid:
+                continue
+            if unit is not None and key[1] != unit:
+                continue
+            del self._settings[key]
+
+
+_relation_snapshot = None
+
+
+def relation_snapshot():
+    """The :class:`RelationSnapshot` for this hook, or None if disabled"""
+    return _relation_snapshot
+
+
+def enable_relation_snapshot(preload=False):
+    """Serve relation data for the rest of the hook from a snapshot
+
+    If preload is True, the settings of every unit on every relation are
+    loaded straight away rather than on first use.
+    """
+    global _relation_snapshot
+    if _relation_snapshot is None:
+        _relation_snapshot = RelationSnapshot()
+    if preload:
+        _relation_snapshot.load_all()
+    return _relation_snapshot
+
+
+def disable_relation_snapshot():
+    """Discard the relation snapshot and go back to querying Juju"""
+    global _relation_snapshot
+    _relation_snapshot = None
+
+
 @cached
 def relation_for_unit(unit=None, rid=None):
     """Get the json represenation of a unit's relation"""
@@ -682,10 +1058,15 @@ class Hooks(object):
             hooks.execute(sys.argv)
     """
 
-    def __init__(self, config_save=None):
+    def __init__(self, config_save=None, trace=None):
         super(Hooks, self).__init__()
         self._hooks = {}
 
+        # Tracing is opt-in, see charmhelpers.core.tracing.
+        if trace is None:
+            trace = bool(os.environ.get('CHARM_HELPERS_TRACE'))
+        self.trace = trace
+
         # For unknown reasons, we allow the Hooks constructor to override
         # config().implicit_save.
         if config_save is not None:
@@ -697,6 +1078,32 @@ class Hooks(object):
 
     def execute(self, args):
         """Execute a registered hook based on args[0]"""
+        if not self.trace:
+            return self._execute(args)
+        from charmhelpers.core import tracing
+        hook_name = os.path.basename(args[0])
+        tracer = tracing.Tracer(hook_name)
+        tracer.install()
+        status = 'error'
+        try:
+            with tracer.span(hook_name, 'hook'):
+                self._execute(args)
+            status = 'ok'
+        except SystemExit as x:
+            if x.code is None or x.code == 0:
+                status = 'ok'
+            raise
+        finally:
+            tracer.uninstall()
+            if _log_buffer is None:
+                # Otherwise logged when the buffer is written out at exit
+                cache.log_stats()
+            try:
+                tracer.save(status)
+            except (IOError, OSError) as e:
+                log('Unable to save hook trace: {}'.format(e), level=WARNING)
+
+    def _execute(self, args):
         _run_atstart()
         hook_name = os.path.basename(args[0])
         if hook_name in self._hooks:
@@ -4,6 +4,7 @@ import json
 import os
 import sys
 
+from collections import OrderedDict
 from subprocess import check_call
 
 from charmhelpers.contrib import unison
@@ -12,6 +13,9 @@ from charmhelpers.core.hookenv import (
     Hooks,
     UnregisteredHookError,
     config,
+    enable_log_buffering,
+    enable_relation_set_buffering,
+    enable_relation_snapshot,
     is_relation_made,
     log,
     local_unit,
@@ -260,10 +264,8 @@ def update_all_identity_relation_units(check_db_ready=True):
     if is_elected_leader(CLUSTER_RES):
         ensure_initial_admin(config)
 
-    log('Firing identity_changed hook for all related services.')
-    for rid in relation_ids('identity-service'):
-        for unit in related_units(rid):
-            identity_changed(relation_id=rid, remote_unit=unit)
+    log('Reconciling all identity-service relations.')
+    reconcile_identity_relations()
 
 
 @synchronize_ca_if_changed(force=True)
@@ -334,34 +336,95 @@ def identity_changed(relation_id=None, remote_unit=None):
 
         add_service_to_keystone(relation_id, remote_unit)
         settings = relation_get(rid=relation_id, unit=remote_unit)
-        service = settings.get('service', None)
-        if service:
-            # If service is known and endpoint has changed, notify service if
-            # it is related with notifications interface.
-            csum = hashlib.sha256()
-            # We base the decision to notify on whether these parameters have
-            # changed (if csum is unchanged from previous notify, relation will
-            # not fire).
-            csum.update(settings.get('public_url', None))
-            csum.update(settings.get('admin_url', None))
-            csum.update(settings.get('internal_url', None))
-            notifications['%s-endpoint-changed' % (service)] = csum.hexdigest()
+        notifications = endpoint_notifications(settings)
     else:
-        # Each unit needs to set the db information otherwise if the unit
-        # with the info dies the settings die with it Bug# 1355848
-        for rel_id in relation_ids('identity-service'):
-            peerdb_settings = peer_retrieve_by_prefix(rel_id)
-            # Ensure the null'd settings are unset in the relation.
-            peerdb_settings = filter_null(peerdb_settings)
-            if 'service_password' in peerdb_settings:
-                relation_set(relation_id=rel_id, **peerdb_settings)
-
+        sync_peerdb_relation_settings()
         log('Deferring identity_changed() to service leader.')
 
     if notifications:
         send_notifications(notifications)
 
 
+def endpoint_notifications(settings):
+    """Returns the endpoint-changed notification for a service's settings"""
+    service = settings.get('service', None)
+    if not service:
+        return {}
+
+    # If service is known and endpoint has changed, notify service if
+    # it is related with notifications interface.
+    csum = hashlib.sha256()
+    # We base the decision to notify on whether these parameters have
+    # changed (if csum is unchanged from previous notify, relation will
+    # not fire).
+    csum.update(settings.get('public_url', None))
+    csum.update(settings.get('admin_url', None))
+    csum.update(settings.get('internal_url', None))
+    return {'%s-endpoint-changed' % (service): csum.hexdigest()}
+
+
+def sync_peerdb_relation_settings():
+    """Set identity-service relation settings from the peer db.
+
+    Each unit needs to set the db information otherwise if the unit
+    with the info dies the settings die with it Bug# 1355848
+    """
+    for rel_id in relation_ids('identity-service'):
+        peerdb_settings = peer_retrieve_by_prefix(rel_id)
+        # Ensure the null'd settings are unset in the relation.
+        peerdb_settings = filter_null(peerdb_settings)
+        if 'service_password' in peerdb_settings:
+            relation_set(relation_id=rel_id, **peerdb_settings)
+
+
+def identity_service_units():
+    """Returns (relation id, unit) pairs, one per distinct set of settings.
+
+    Units of a service normally all request the same endpoints and the
+    settings keystone answers with are per relation, so of the units of a
+    relation advertising the same settings only the last one (the one that
+    would have been handled last unit by unit) needs handling.
+    """
+    ignored = ('private-address', 'ingress-address', 'egress-subnets')
+    pairs = []
+    for rid in relation_ids('identity-service'):
+        desired = OrderedDict()
+        for unit in related_units(rid):
+            settings = relation_get(rid=rid, unit=unit) or {}
+            key = json.dumps(dict((k, v) for k, v in settings.iteritems()
+                                  if k not in ignored), sort_keys=True)
+            desired.pop(key, None)
+            desired[key] = unit
+        pairs.extend((rid, unit) for unit in desired.values())
+    return pairs
+
+
+def reconcile_identity_relations():
+    """Bring the catalog and all identity-service relations up to date.
+
+    Unlike running identity_changed() for every remote unit, the desired
+    state of all units is gathered first and units requesting the same
+    settings are handled once. The catalog lookups of every
+    add_service_to_keystone() share the one snapshot held by the hook's
+    KeystoneManager, so only missing entries are created, and endpoint
+    change notifications are sent in one go. Configs are rendered and SSL
+    dirs hashed by the caller, once.
+    """
+    if not is_elected_leader(CLUSTER_RES):
+        sync_peerdb_relation_settings()
+        log('Deferring identity-service updates to service leader.')
+        return
+
+    notifications = {}
+    for rid, unit in identity_service_units():
+        add_service_to_keystone(rid, unit)
+        settings = relation_get(rid=rid, unit=unit)
+        notifications.update(endpoint_notifications(settings))
+
+    if notifications:
+        send_notifications(notifications)
+
+
 def send_ssl_sync_request():
     """Set sync request on cluster relation.
 
@@ -635,6 +698,9 @@ def update_nrpe_config():
 
 
 def main():
+    enable_log_buffering()
+    enable_relation_snapshot()
+    enable_relation_set_buffering()
     try:
         hooks.execute(sys.argv)
     except UnregisteredHookError as e:
@@ -7,6 +7,7 @@ import os
 import pwd
 import re
 import shutil
+import stat
 import subprocess
 import tarfile
 import threading
@@ -18,6 +19,7 @@ from itertools import chain
 from base64 import b64encode
 from collections import OrderedDict
 from copy import deepcopy
+from multiprocessing.pool import ThreadPool
 
 from charmhelpers.contrib.hahelpers.cluster import(
     is_elected_leader,
@@ -64,11 +66,15 @@ from charmhelpers.core.strutils import (
 
 import charmhelpers.contrib.unison as unison
 
+from charmhelpers.core import unitdata
+
 from charmhelpers.core.decorators import (
     retry_on_exception,
 )
 
 from charmhelpers.core.hookenv import (
+    atexit,
+    cached,
     charm_dir,
     config,
     is_relation_made,
@@ -80,9 +86,11 @@ from charmhelpers.core.hookenv import (
     relation_ids,
     related_units,
     DEBUG,
+    ERROR,
     INFO,
     WARNING,
     status_get,
+    unit_private_ip,
 )
 
 from charmhelpers.fetch import (
@@ -159,6 +167,10 @@ KEYSTONE_LOGGER_CONF = "/etc/keystone/logging.conf"
 KEYSTONE_CONF_DIR = os.path.dirname(KEYSTONE_CONF)
 STORED_PASSWD = "/var/lib/keystone/keystone.passwd"
 STORED_TOKEN = "/var/lib/keystone/keystone.token"
+# unitdata key of the saved scoped token of the admin user
+ADMIN_SESSION_TOKEN_KEY = 'keystone.admin-session-token'
+# Saved tokens closer than this many seconds to expiry are not reused
+TOKEN_EXPIRY_MARGIN = 300
 SERVICE_PASSWD_PATH = '/var/lib/keystone/services.passwd'
 
 HAPROXY_CONF = '/etc/haproxy/haproxy.cfg'
@@ -168,7 +180,16 @@ APACHE_24_CONF = '/etc/apache2/sites-available/openstack_https_frontend.conf'
 APACHE_SSL_DIR = '/etc/apache2/ssl/keystone'
 SYNC_FLAGS_DIR = '/var/lib/keystone/juju_sync_flags/'
 SYNC_DIR = '/var/lib/keystone/juju_sync/'
+# Tarball of ssl files synced by earlier versions of the charm
 SSL_SYNC_ARCHIVE = os.path.join(SYNC_DIR, 'juju-ssl-sync.tar')
+SSL_SYNC_MANIFEST = os.path.join(SYNC_DIR, 'juju-ssl-sync.json')
+SSL_SYNC_OBJECTS_DIR = os.path.join(SYNC_DIR, 'objects')
+# unitdata key of the index of digests of ssl files
+SSL_DIGESTS_KEY = 'keystone.ssl-digests'
+# unitdata key of the files written by the last sync manifest applied
+SSL_SYNC_APPLIED_KEY = 'keystone.ssl-sync-applied'
+# Mode of synced files whose manifest does not record one
+SSL_SYNC_DEFAULT_MODE = 0o640
 SSL_DIR = '/var/lib/keystone/juju_ssl/'
 PKI_CERTS_DIR = os.path.join(SSL_DIR, 'pki')
 SSL_CA_NAME = 'Ubuntu Cloud'
@@ -176,6 +197,8 @@ CLUSTER_RES = 'grp_ks_vips'
 SSH_USER = 'juju_keystone'
 CA_CERT_PATH = '/usr/local/share/ca-certificates/keystone_juju_ca_cert.crt'
 SSL_SYNC_SEMAPHORE = threading.Semaphore()
+# Maximum number of peers synced at the same time
+PEER_SYNC_WORKERS = 8
 SSL_DIRS = [SSL_DIR, APACHE_SSL_DIR, CA_CERT_PATH]
 BASE_RESOURCE_MAP = OrderedDict([
     (KEYSTONE_CONF, {
@@ -437,18 +460,19 @@ def migrate_database():
 # OLD
 
 
-def get_local_endpoint():
+def get_local_endpoint(api_version=2):
     """Returns the URL for the local end-point bypassing haproxy/ssl"""
+    api_suffix = 'v3' if api_version >= 3 else 'v2.0'
     if config('prefer-ipv6'):
         ipv6_addr = get_ipv6_addr(exc_list=[config('vip')])[0]
-        endpoint_url = 'http://[%s]:{}/v2.0/' % ipv6_addr
+        endpoint_url = 'http://[%s]:{}/{}/' % ipv6_addr
         local_endpoint = endpoint_url.format(
             determine_api_port(api_port('keystone-admin'),
-                               singlenode_mode=True))
+                               singlenode_mode=True), api_suffix)
     else:
-        local_endpoint = 'http://localhost:{}/v2.0/'.format(
+        local_endpoint = 'http://localhost:{}/{}/'.format(
             determine_api_port(api_port('keystone-admin'),
-                               singlenode_mode=True))
+                               singlenode_mode=True), api_suffix)
 
     return local_endpoint
 
@@ -478,32 +502,157 @@ def set_admin_token(admin_token='None'):
 def get_admin_token():
     """Temporary utility to grab the admin token as configured in
        keystone.conf
+
+    keystone.conf is parsed once per hook.
     """
-    with open(KEYSTONE_CONF, 'r') as f:
+    return _read_admin_token(KEYSTONE_CONF)
+
+
+@cached
+def _read_admin_token(path):
+    with open(path, 'r') as f:
         for l in f.readlines():
             if l.split(' ')[0] == 'admin_token':
                 try:
                     return l.split('=')[1].strip()
                 except:
                     error_out('Could not parse admin_token line from %s' %
-                              KEYSTONE_CONF)
-    error_out('Could not find admin_token line in %s' % KEYSTONE_CONF)
+                              path)
+    error_out('Could not find admin_token line in %s' % path)
+
+
+def _restore_session_token(auth, owner):
+    """Hand the saved, unexpired scoped token of owner to the auth plugin"""
+    from keystoneclient import access
+    saved = unitdata.kv().get(ADMIN_SESSION_TOKEN_KEY)
+    if not saved or saved['owner'] != owner:
+        return
+    try:
+        auth_ref = access.AccessInfo.factory(body=saved['body'],
+                                             auth_token=saved['token'])
+    except Exception as e:
+        log('Unable to restore saved admin token: %s' % e, level=WARNING)
+        return
+    if auth_ref.will_expire_soon(stale_duration=TOKEN_EXPIRY_MARGIN):
+        return
+    auth.auth_ref = auth_ref
+
+
+def _save_session_token(auth, owner):
+    auth_ref = auth.auth_ref
+    db = unitdata.kv()
+    saved = db.get(ADMIN_SESSION_TOKEN_KEY) or {}
+    if auth_ref is None or saved.get('token') == auth_ref.auth_token:
+        return
+    db.set(ADMIN_SESSION_TOKEN_KEY, {'owner': owner,
+                                     'token': auth_ref.auth_token,
+                                     'body': {'token': dict(auth_ref)}})
+    db.flush()
+
+
+def get_admin_session():
+    """Returns a keystone Session authenticated as the admin user.
+
+    The token is scoped to the admin project and is saved in unitdata when
+    the hook exits, to be reused by later hooks until it nears expiry.
+    Returns None if the admin user can not (yet) authenticate, e.g. before
+    ensure_initial_admin() has created it, or if the installed
+    keystoneclient predates sessions.
+    """
+    passwd = get_admin_passwd()
+    if not passwd:
+        return None
+
+    try:
+        from keystoneclient import session as kssession
+        from keystoneclient.auth.identity import v3
+    except ImportError:
+        log('Installed keystoneclient does not support sessions',
+            level=WARNING)
+        return None
+
+    auth_url = get_local_endpoint(api_version=3)
+    owner = [auth_url, config('admin-user'), 'admin']
+    auth = v3.Password(auth_url=auth_url,
+                       username=config('admin-user'),
+                       password=passwd,
+                       user_domain_id='default',
+                       project_name='admin',
+                       project_domain_id='default')
+    _restore_session_token(auth, owner)
+    session = kssession.Session(auth=auth)
+    try:
+        session.get_token()
+    except Exception as e:
+        log('Unable to authenticate as %s: %s' % (config('admin-user'), e),
+            level=INFO)
+        return None
+
+    atexit(_save_session_token, auth, owner)
+    return session
+
+
+def _forget_admin_session():
+    """Drops the admin session and its saved token.
+
+    Keystone revokes the tokens of a user whose password changes, so this
+    is needed once the admin password has been updated.
+    """
+    mgr = _managers.pop('v3', None)
+    if mgr is not None:
+        # Otherwise the token is saved again when the hook exits
+        mgr.session.auth.invalidate()
+    db = unitdata.kv()
+    db.unset(ADMIN_SESSION_TOKEN_KEY)
+    db.flush()
+
+
+_managers = {}
+
+
+def get_manager(endpoint=None, token=None):
+    """Returns the KeystoneManager shared by everything in this hook.
+
+    Sharing one manager means its name to id indexes are only built once.
+    With preferred-api-version 3 this is a v3 manager authenticated as the
+    admin user, unless the admin user can not authenticate, in which case
+    (as with an explicit endpoint or token) the v2.0 API is used with the
+    admin token.
+    """
+    if (endpoint is None and token is None and
+            config('preferred-api-version') >= 3):
+        if 'v3' not in _managers:
+            session = get_admin_session()
+            if session:
+                import manager
+                _managers['v3'] = manager.KeystoneManager3(session)
+            else:
+                log('Falling back to the v2.0 API and admin token',
+                    level=INFO)
+                _managers['v3'] = None
+        if _managers['v3']:
+            return _managers['v3']
+
+    endpoint = endpoint or get_local_endpoint()
+    token = token or get_admin_token()
+    if (endpoint, token) not in _managers:
+        import manager
+        _managers[(endpoint, token)] = manager.KeystoneManager(
+            endpoint=endpoint, token=token)
+    return _managers[(endpoint, token)]
 
 
 def create_service_entry(service_name, service_type, service_desc, owner=None):
     """ Add a new service entry to keystone if one does not already exist """
-    import manager
-    manager = manager.KeystoneManager(endpoint=get_local_endpoint(),
-                                      token=get_admin_token())
-    for service in [s._info for s in manager.api.services.list()]:
-        if service['name'] == service_name:
-            log("Service entry for '%s' already exists." % service_name,
-                level=DEBUG)
-            return
+    manager = get_manager()
+    if manager.resolve_service_id(service_name):
+        log("Service entry for '%s' already exists." % service_name,
+            level=DEBUG)
+        return
 
-    manager.api.services.create(name=service_name,
-                                service_type=service_type,
-                                description=service_desc)
+    manager.create_service(name=service_name,
+                           service_type=service_type,
+                           description=service_desc)
     log("Created new service entry '%s'" % service_name, level=DEBUG)
 
 
@@ -511,45 +660,40 @@ def create_endpoint_template(region, service, publicurl, adminurl,
                              internalurl):
     """ Create a new endpoint template for service if one does not already
         exist matching name *and* region """
-    import manager
-    manager = manager.KeystoneManager(endpoint=get_local_endpoint(),
-                                      token=get_admin_token())
+    manager = get_manager()
     service_id = manager.resolve_service_id(service)
-    for ep in [e._info for e in manager.api.endpoints.list()]:
-        if ep['service_id'] == service_id and ep['region'] == region:
-            log("Endpoint template already exists for '%s' in '%s'"
-                % (service, region))
-
-            up_to_date = True
-            for k in ['publicurl', 'adminurl', 'internalurl']:
-                if ep.get(k) != locals()[k]:
-                    up_to_date = False
-
-            if up_to_date:
-                return
-            else:
-                # delete endpoint and recreate if endpoint urls need updating.
-                log("Updating endpoint template with new endpoint urls.")
-                manager.api.endpoints.delete(ep['id'])
-
-    manager.api.endpoints.create(region=region,
-                                 service_id=service_id,
-                                 publicurl=publicurl,
-                                 adminurl=adminurl,
-                                 internalurl=internalurl)
+    urls = {'publicurl': publicurl, 'adminurl': adminurl,
+            'internalurl': internalurl}
+    for ep in manager.list_endpoints(service_id=service_id, region=region):
+        log("Endpoint template already exists for '%s' in '%s'"
+            % (service, region))
+
+        up_to_date = True
+        for k in ['publicurl', 'adminurl', 'internalurl']:
+            if ep.get(k) != urls[k]:
+                up_to_date = False
+
+        if up_to_date:
+            return
+        else:
+            # delete endpoint and recreate if endpoint urls need updating.
+            log("Updating endpoint template with new endpoint urls.")
+            manager.delete_endpoint(ep['id'])
+
+    manager.create_endpoint(region=region,
+                            service_id=service_id,
+                            publicurl=publicurl,
+                            adminurl=adminurl,
+                            internalurl=internalurl)
     log("Created new endpoint template for '%s' in '%s'" % (region, service),
         level=DEBUG)
 
 
 def create_tenant(name):
     """Creates a tenant if it does not already exist"""
-    import manager
-    manager = manager.KeystoneManager(endpoint=get_local_endpoint(),
-                                      token=get_admin_token())
-    tenants = [t._info for t in manager.api.tenants.list()]
-    if not tenants or name not in [t['name'] for t in tenants]:
-        manager.api.tenants.create(tenant_name=name,
-                                   description='Created by Juju')
+    manager = get_manager()
+    if not manager.resolve_tenant_id(name):
+        manager.create_tenant(name=name, description='Created by Juju')
         log("Created new tenant: %s" % name, level=DEBUG)
         return
 
@@ -557,21 +701,12 @@ def create_tenant(name):
 
 
 def user_exists(name):
-    import manager
-    manager = manager.KeystoneManager(endpoint=get_local_endpoint(),
-                                      token=get_admin_token())
-    users = [u._info for u in manager.api.users.list()]
-    if not users or name not in [u['name'] for u in users]:
-        return False
-
-    return True
+    return get_manager().resolve_user_id(name) is not None
 
 
 def create_user(name, password, tenant):
     """Creates a user if it doesn't already exist, as a member of tenant"""
-    import manager
-    manager = manager.KeystoneManager(endpoint=get_local_endpoint(),
-                                      token=get_admin_token())
+    manager = get_manager()
     if user_exists(name):
         log("A user named '%s' already exists" % name, level=DEBUG)
         return
@@ -580,22 +715,19 @@ def create_user(name, password, tenant):
     if not tenant_id:
         error_out('Could not resolve tenant_id for tenant %s' % tenant)
 
-    manager.api.users.create(name=name,
-                             password=password,
-                             email='juju@localhost',
-                             tenant_id=tenant_id)
+    manager.create_user(name=name,
+                        password=password,
+                        email='juju@localhost',
+                        tenant_id=tenant_id)
     log("Created new user '%s' tenant: %s" % (name, tenant_id),
         level=DEBUG)
 
 
 def create_role(name, user=None, tenant=None):
     """Creates a role if it doesn't already exist. grants role to user"""
-    import manager
-    manager = manager.KeystoneManager(endpoint=get_local_endpoint(),
-                                      token=get_admin_token())
-    roles = [r._info for r in manager.api.roles.list()]
-    if not roles or name not in [r['name'] for r in roles]:
-        manager.api.roles.create(name=name)
+    manager = get_manager()
+    if not manager.resolve_role_id(name):
+        manager.create_role(name=name)
         log("Created new role '%s'" % name, level=DEBUG)
     else:
         log("A role named '%s' already exists" % name, level=DEBUG)
@@ -617,20 +749,17 @@ def create_role(name, user=None, tenant=None):
 
 def grant_role(user, role, tenant):
     """Grant user and tenant a specific role"""
-    import manager
-    manager = manager.KeystoneManager(endpoint=get_local_endpoint(),
-                                      token=get_admin_token())
+    manager = get_manager()
     log("Granting user '%s' role '%s' on tenant '%s'" %
         (user, role, tenant))
     user_id = manager.resolve_user_id(user)
     role_id = manager.resolve_role_id(role)
     tenant_id = manager.resolve_tenant_id(tenant)
 
-    cur_roles = manager.api.roles.roles_for_user(user_id, tenant_id)
-    if not cur_roles or role_id not in [r.id for r in cur_roles]:
-        manager.api.roles.add_user_role(user=user_id,
-                                        role=role_id,
-                                        tenant=tenant_id)
+    if role_id not in manager.roles_for_user(user_id, tenant_id):
+        manager.add_user_role(user_id=user_id,
+                              role_id=role_id,
+                              tenant_id=tenant_id)
         log("Granted user '%s' role '%s' on tenant '%s'" %
             (user, role, tenant), level=DEBUG)
     else:
@@ -740,18 +869,18 @@ def create_keystone_endpoint(public_ip, service_port,
 
 
 def update_user_password(username, password):
-    import manager
-    manager = manager.KeystoneManager(endpoint=get_local_endpoint(),
-                                      token=get_admin_token())
+    manager = get_manager()
     log("Updating password for user '%s'" % username)
 
     user_id = manager.resolve_user_id(username)
     if user_id is None:
         error_out("Could not resolve user id for '%s'" % username)
 
-    manager.api.users.update_password(user=user_id, password=password)
+    manager.update_password(user_id=user_id, password=password)
     log("Successfully updated password for user '%s'" %
         username)
+    if username == config('admin-user'):
+        _forget_admin_session()
 
 
 def load_stored_passwords(path=SERVICE_PASSWD_PATH):
@@ -905,12 +1034,51 @@ def create_peer_actions(actions):
                    perms=0o744)
 
 
+def collect_authed_units(peer_interface):
+    """Find the units on peer interface that have authorized this host.
+
+    Returns an OrderedDict of the private address of each such unit, keyed
+    by unit name.
+    """
+    units = OrderedDict()
+    for r_id in (relation_ids(peer_interface) or []):
+        for unit in related_units(r_id):
+            private_addr = relation_get('private-address',
+                                        rid=r_id, unit=unit)
+            authed_hosts = relation_get('ssh_authorized_hosts',
+                                        rid=r_id, unit=unit)
+
+            if not authed_hosts:
+                log('Peer %s has not authorized *any* hosts yet, skipping.' %
+                    (unit), level=INFO)
+                continue
+
+            if unit_private_ip() in authed_hosts.split(':'):
+                units[unit] = private_addr
+            else:
+                log('Peer %s has not authorized *this* host yet, skipping.' %
+                    (unit), level=INFO)
+    return units
+
+
 @retry_on_exception(3, base_delay=2, exc_type=subprocess.CalledProcessError)
+def unison_sync_to_peer(unit, host, paths_to_sync, gid):
+    """Do unison sync to one peer and retry a few times if it fails since the
+    peer may not be ready for sync.
+    """
+    log('Synchronizing CA to %s (%s).' % (unit, host), level=DEBUG)
+    unison.sync_to_peer(host, user=SSH_USER, paths=paths_to_sync,
+                        verbose=True, gid=gid, fatal=True)
+
+
 def unison_sync(paths_to_sync):
-    """Do unison sync and retry a few times if it fails since peers may not be
-    ready for sync.
+    """Do unison sync to all peers at once, up to PEER_SYNC_WORKERS at a time.
+
+    Each peer is retried on its own, so one peer that is slow or not yet
+    ready for sync neither holds up nor causes a resync of the others.
 
-    Returns list of synced units or None if one or more peers was not synced.
+    Returns list of units synced. Peers that failed to sync, or that have
+    not provided their ssh keys yet, are not in it.
     """
     log('Synchronizing CA (%s) to all peers.' % (', '.join(paths_to_sync)),
         level=INFO)
@@ -919,16 +1087,37 @@ def unison_sync(paths_to_sync):
     # NOTE(dosaboy): This will sync to all peers who have already provided
     # their ssh keys. If any existing peers have not provided their keys yet,
     # they will be silently ignored.
-    unison.sync_to_peers(peer_interface='cluster', paths=paths_to_sync,
-                         user=SSH_USER, verbose=True, gid=keystone_gid,
-                         fatal=True)
-
-    synced_units = peer_units()
-    if len(unison.collect_authed_hosts('cluster')) != len(synced_units):
+    hosts = collect_authed_units('cluster')
+    if len(hosts) != len(peer_units()):
         log("Not all peer units synced due to missing public keys", level=INFO)
-        return None
-    else:
-        return synced_units
+
+    if not hosts:
+        return []
+
+    def _sync(unit):
+        try:
+            unison_sync_to_peer(unit, hosts[unit], paths_to_sync,
+                                keystone_gid)
+        except Exception as e:
+            return e
+
+    pool = ThreadPool(min(PEER_SYNC_WORKERS, len(hosts)))
+    try:
+        results = pool.map(_sync, hosts.keys())
+    finally:
+        pool.close()
+        pool.join()
+
+    synced_units = []
+    for unit, error in zip(hosts.keys(), results):
+        if error is None:
+            synced_units.append(unit)
+        else:
+            log("Failed to sync %s: %s" % (unit, error), level=ERROR)
+
+    log("Synced %d of %d peers" % (len(synced_units), len(hosts)),
+        level=INFO)
+    return synced_units
 
 
 def get_ssl_sync_request_units():
@@ -1041,19 +1230,145 @@ def ensure_ssl_cert_master():
 
 
 def stage_paths_for_sync(paths):
-    shutil.rmtree(SYNC_DIR)
-    ensure_ssl_dirs()
-    with tarfile.open(SSL_SYNC_ARCHIVE, 'w') as fd:
-        for path in paths:
-            if os.path.exists(path):
-                log("Adding path '%s' sync tarball" % (path), level=DEBUG)
-                fd.add(path)
-            else:
-                log("Path '%s' does not exist - not adding to sync "
-                    "tarball" % (path), level=INFO)
+    """Stage the files found at or below paths for sync to peers.
 
+    Each file is stored in SSL_SYNC_OBJECTS_DIR named by its digest, and
+    SSL_SYNC_MANIFEST maps every file to its digest, mode and owner, so
+    that peers keep private keys as private as they are here. Files that
+    have not changed since the last sync are therefore already staged, and
+    already on peers, so unison only transfers the changed ones. Objects no
+    longer in the manifest are removed.
+
+    Returns the manifest.
+    """
+    ensure_ssl_dirs()
+    if not os.path.isdir(SSL_SYNC_OBJECTS_DIR):
+        mkdir(SSL_SYNC_OBJECTS_DIR, SSH_USER, 'keystone', 0o755)
+
+    for path in paths:
+        if not os.path.exists(path):
+            log("Path '%s' does not exist - not adding to sync "
+                "manifest" % (path), level=INFO)
+
+    digests = file_digests(paths)
+    for path, digest in digests.iteritems():
+        obj = os.path.join(SSL_SYNC_OBJECTS_DIR, digest)
+        if not os.path.exists(obj):
+            log("Staging '%s' for sync" % (path), level=DEBUG)
+            shutil.copyfile(path, '%s.tmp' % (obj))
+            os.rename('%s.tmp' % (obj), obj)
+
+    staged = set(digests.itervalues())
+    for obj in os.listdir(SSL_SYNC_OBJECTS_DIR):
+        if obj not in staged:
+            os.remove(os.path.join(SSL_SYNC_OBJECTS_DIR, obj))
+
+    if os.path.exists(SSL_SYNC_ARCHIVE):
+        os.remove(SSL_SYNC_ARCHIVE)
+
+    modes = dict((f, stat.S_IMODE(os.stat(f).st_mode)) for f in digests)
+    owners = dict((f, file_owner(f)) for f in digests)
+    manifest = {'files': digests, 'modes': modes, 'owners': owners}
+    write_file(SSL_SYNC_MANIFEST, json.dumps(manifest, sort_keys=True),
+               owner=SSH_USER, group='keystone', perms=0o755)
     ensure_permissions(SYNC_DIR, user=SSH_USER, group='keystone',
                        perms=0o755, recurse=True)
+    return manifest
+
+
+def file_owner(path):
+    """Returns the names of the user and group owning path.
+
+    Either is None if the id has no name on this host.
+    """
+    st = os.stat(path)
+    try:
+        user = pwd.getpwuid(st.st_uid).pw_name
+    except KeyError:
+        user = None
+    try:
+        group = grp.getgrgid(st.st_gid).gr_name
+    except KeyError:
+        group = None
+    return [user, group]
+
+
+def apply_sync_manifest(path):
+    """Update local ssl files to match the sync manifest at path.
+
+    Only files whose digest differs from the manifest are replaced. Each
+    replacement is first copied next to the file it replaces and checked
+    against its digest, and files are only renamed into place once all of
+    them are staged, so a failed or partial sync leaves them untouched.
+    Files get the mode and owner the manifest records for them. Manifests
+    from older sync masters record neither; files then get
+    SSL_SYNC_DEFAULT_MODE and keep their owner, with new files owned by
+    keystone.
+
+    Files written by the previously applied manifest that are not in this
+    one have been removed on the sync master, and are removed here too.
+
+    Returns the list of files replaced or removed.
+    """
+    with open(path, 'r') as fd:
+        manifest = json.load(fd)
+
+    objects = os.path.join(os.path.dirname(path), 'objects')
+    wanted = manifest['files']
+    modes = manifest.get('modes', {})
+    owners = manifest.get('owners', {})
+    current = file_digests(wanted.keys())
+    staged = []
+    try:
+        for syncfile, digest in sorted(wanted.iteritems()):
+            mode = modes.get(syncfile, SSL_SYNC_DEFAULT_MODE)
+            if syncfile in owners:
+                user, group = owners[syncfile]
+            elif os.path.exists(syncfile):
+                user, group = file_owner(syncfile)
+            else:
+                user, group = 'keystone', 'keystone'
+
+            if current.get(syncfile) == digest:
+                if stat.S_IMODE(os.stat(syncfile).st_mode) != mode:
+                    os.chmod(syncfile, mode)
+                if file_owner(syncfile) != [user, group]:
+                    ensure_permissions(syncfile, user=user, group=group)
+                continue
+
+            syncdir = os.path.dirname(syncfile)
+            if not os.path.isdir(syncdir):
+                mkdir(syncdir, 'keystone', 'keystone', 0o755)
+
+            tmp = '%s.juju-sync' % (syncfile)
+            shutil.copyfile(os.path.join(objects, digest), tmp)
+            staged.append((tmp, syncfile))
+            if file_sha256(tmp) != digest:
+                raise Exception("Staged copy of '%s' does not match sync "
+                                "manifest" % (syncfile))
+
+            ensure_permissions(tmp, user=user, group=group, perms=mode)
+    except:
+        for tmp, _ in staged:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        raise
+
+    for tmp, syncfile in staged:
+        os.rename(tmp, syncfile)
+    updated = [syncfile for _, syncfile in staged]
+
+    db = unitdata.kv()
+    for syncfile in sorted(set(db.get(SSL_SYNC_APPLIED_KEY) or []) -
+                           set(wanted)):
+        if os.path.isfile(syncfile):
+            log("Removing '%s', no longer synced" % (syncfile), level=DEBUG)
+            os.remove(syncfile)
+            updated.append(syncfile)
+
+    db.set(SSL_SYNC_APPLIED_KEY, sorted(wanted))
+    db.flush()
+    return updated
 
 
 def is_pki_enabled():
@@ -1077,7 +1392,12 @@ def update_certs_if_available(f):
             path = relation_get(attribute='ssl-cert-available-updates',
                                 rid=rid, unit=local_unit())
 
-        if path and os.path.exists(path):
+        if path and os.path.exists(path) and not tarfile.is_tarfile(path):
+            updated = apply_sync_manifest(path)
+            log("Updated certs from '%s': %s" %
+                (path, ', '.join(updated) or 'no changes'), level=DEBUG)
+        elif path and os.path.exists(path):
+            # Tarball from a sync master running an older charm
             log("Updating certs from '%s'" % (path), level=DEBUG)
             with tarfile.open(path) as fd:
                 files = ["/%s" % m.name for m in fd.getmembers()]
@@ -1153,21 +1473,23 @@ def synchronize_ca(fatal=False):
     create_peer_actions(peer_actions)
 
     paths_to_sync = list(set(paths_to_sync))
-    stage_paths_for_sync(paths_to_sync)
+    manifest = stage_paths_for_sync(paths_to_sync)
 
     hash1 = hashlib.sha256()
-    for path in paths_to_sync:
-        update_hash_from_path(hash1, path)
+    hash1.update(json.dumps(manifest, sort_keys=True))
 
-    cluster_rel_settings = {'ssl-cert-available-updates': SSL_SYNC_ARCHIVE,
+    cluster_rel_settings = {'ssl-cert-available-updates': SSL_SYNC_MANIFEST,
                             'sync-hash': hash1.hexdigest()}
 
-    synced_units = unison_sync([SSL_SYNC_ARCHIVE, SYNC_FLAGS_DIR])
-    if synced_units:
-        # Format here needs to match that used when peers request sync
-        synced_units = [u.replace('/', '-') for u in synced_units]
-        cluster_rel_settings['ssl-synced-units'] = \
-            json.dumps(synced_units)
+    synced_units = unison_sync([SYNC_DIR, SYNC_FLAGS_DIR])
+    missed_units = sorted(set(peer_units()) - set(synced_units))
+    if missed_units:
+        log("Peers not synced, will retry on next sync request: %s" %
+            (', '.join(missed_units)), level=WARNING)
+
+    # Format here needs to match that used when peers request sync
+    synced_units = [u.replace('/', '-') for u in synced_units]
+    cluster_rel_settings['ssl-synced-units'] = json.dumps(synced_units)
 
     trigger = str(uuid.uuid4())
     log("Sending restart-services-trigger=%s to all peers" % (trigger),
@@ -1190,21 +1512,77 @@ def clear_ssl_synced_units():
                      relation_settings={'ssl-synced-units': None})
 
 
-def update_hash_from_path(hash, path, recurse_depth=10):
-    """Recurse through path and update the provided hash for every file found.
-    """
+def find_files(path, recurse_depth=10):
+    """Returns path if it is a file, or the files found below it."""
+    if os.path.isfile(path):
+        return [path]
+
     if not recurse_depth:
-        log("Max recursion depth (%s) reached for update_hash_from_path() at "
+        log("Max recursion depth (%s) reached for find_files() at "
             "path='%s' - not going any deeper" % (recurse_depth, path),
             level=WARNING)
-        return
+        return []
 
-    for p in glob.glob("%s/*" % path):
-        if os.path.isdir(p):
-            update_hash_from_path(hash, p, recurse_depth=recurse_depth - 1)
-        else:
-            with open(p, 'r') as fd:
-                hash.update(fd.read())
+    files = []
+    for p in sorted(glob.glob("%s/*" % path)):
+        files.extend(find_files(p, recurse_depth=recurse_depth - 1))
+
+    return files
+
+
+def file_sha256(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as fd:
+        for chunk in iter(lambda: fd.read(65536), b''):
+            sha.update(chunk)
+
+    return sha.hexdigest()
+
+
+def file_digests(paths, recurse_depth=10):
+    """Returns the sha256 digest of every file found at or below paths.
+
+    Digests are kept in unitdata along with the mtime and size of each file
+    when it was hashed, and a file is only read again once either changes.
+    """
+    db = unitdata.kv()
+    index = db.get(SSL_DIGESTS_KEY) or {}
+    changed = False
+    digests = {}
+    for path in paths:
+        for f in find_files(path, recurse_depth=recurse_depth):
+            st = os.stat(f)
+            entry = index.get(f)
+            if not entry or entry[:2] != [st.st_mtime, st.st_size]:
+                entry = [st.st_mtime, st.st_size, file_sha256(f)]
+                index[f] = entry
+                changed = True
+
+            digests[f] = entry[2]
+
+        # Forget files that have gone
+        for f in index.keys():
+            if ((f == path or f.startswith(path.rstrip('/') + '/')) and
+                    f not in digests):
+                del index[f]
+                changed = True
+
+    if changed:
+        db.set(SSL_DIGESTS_KEY, index)
+        db.flush()
+
+    return digests
+
+
+def update_hash_from_path(hash, path, recurse_depth=10):
+    """Recurse through path and update the provided hash for every file found.
+
+    Uses the digests of file_digests() so unchanged files are not read again.
+    """
+    digests = file_digests([path], recurse_depth=recurse_depth)
+    for f, digest in sorted(digests.iteritems()):
+        hash.update(f)
+        hash.update(digest)
 
 
 def synchronize_ca_if_changed(force=False, fatal=False):
@@ -1373,9 +1751,7 @@ def create_service_credentials(user, new_roles=None):
 
 
 def add_service_to_keystone(relation_id=None, remote_unit=None):
-    import manager
-    manager = manager.KeystoneManager(endpoint=get_local_endpoint(),
-                                      token=get_admin_token())
+    manager = get_manager()
     settings = relation_get(rid=relation_id, unit=remote_unit)
     # the minimum settings needed per endpoint
     single = set(['service', 'region', 'public_url', 'admin_url',
@@ -3,41 +3,227 @@ from keystoneclient.v2_0 import client
 
 
 class KeystoneManager(object):
+    """Keystone admin API client with name to id indexes.
+
+    Tenants, users, roles, services and endpoints are each listed once, when
+    first needed. The indexes are then kept up to date as resources are
+    created and deleted through the manager, so one manager shared by a
+    hook (see keystone_utils.get_manager) makes a single list call per kind
+    of resource however many lookups it does.
+    """
 
     def __init__(self, endpoint, token):
         self.api = client.Client(endpoint=endpoint, token=token)
+        self._indexes = {}
+        self._user_roles = {}
+
+    def _index(self, kind, key='name'):
+        """Returns a dict of the info of every resource of kind by key"""
+        if kind not in self._indexes:
+            resources = getattr(self.api, kind).list()
+            self._indexes[kind] = dict((r._info[key], r._info)
+                                       for r in resources)
+        return self._indexes[kind]
+
+    def _resolve_id(self, kind, name):
+        info = self._index(kind).get(name)
+        if info:
+            return info['id']
+
+    def invalidate(self, kind=None):
+        """Drops the index of kind, or all of them, to be listed again"""
+        if kind is None:
+            self._indexes.clear()
+            self._user_roles.clear()
+        else:
+            self._indexes.pop(kind, None)
 
     def resolve_tenant_id(self, name):
         """Find the tenant_id of a given tenant"""
-        tenants = [t._info for t in self.api.tenants.list()]
-        for t in tenants:
-            if name == t['name']:
-                return t['id']
+        return self._resolve_id('tenants', name)
 
     def resolve_role_id(self, name):
         """Find the role_id of a given role"""
-        roles = [r._info for r in self.api.roles.list()]
-        for r in roles:
-            if name == r['name']:
-                return r['id']
+        return self._resolve_id('roles', name)
 
     def resolve_user_id(self, name):
         """Find the user_id of a given user"""
-        users = [u._info for u in self.api.users.list()]
-        for u in users:
-            if name == u['name']:
-                return u['id']
+        return self._resolve_id('users', name)
 
     def resolve_service_id(self, name):
         """Find the service_id of a given service"""
-        services = [s._info for s in self.api.services.list()]
-        for s in services:
-            if name == s['name']:
-                return s['id']
+        return self._resolve_id('services', name)
 
     def resolve_service_id_by_type(self, type):
         """Find the service_id of a given service"""
-        services = [s._info for s in self.api.services.list()]
-        for s in services:
+        for s in self._index('services').values():
             if type == s['type']:
                 return s['id']
+
+    def create_tenant(self, name, description=None):
+        tenant = self.api.tenants.create(tenant_name=name,
+                                         description=description)
+        self._index('tenants')[name] = tenant._info
+        return tenant._info['id']
+
+    def create_user(self, name, password, email=None, tenant_id=None):
+        user = self.api.users.create(name=name, password=password,
+                                     email=email, tenant_id=tenant_id)
+        self._index('users')[name] = user._info
+        return user._info['id']
+
+    def update_password(self, user_id, password):
+        self.api.users.update_password(user=user_id, password=password)
+
+    def create_role(self, name):
+        role = self.api.roles.create(name=name)
+        self._index('roles')[name] = role._info
+        return role._info['id']
+
+    def roles_for_user(self, user_id, tenant_id):
+        """Returns the set of ids of the roles of a user on a tenant"""
+        key = (user_id, tenant_id)
+        if key not in self._user_roles:
+            roles = self.api.roles.roles_for_user(user_id, tenant_id)
+            self._user_roles[key] = set(r.id for r in roles)
+        return self._user_roles[key]
+
+    def add_user_role(self, user_id, role_id, tenant_id):
+        self.api.roles.add_user_role(user=user_id, role=role_id,
+                                     tenant=tenant_id)
+        self.roles_for_user(user_id, tenant_id).add(role_id)
+
+    def create_service(self, name, service_type, description=None):
+        service = self.api.services.create(name=name,
+                                           service_type=service_type,
+                                           description=description)
+        self._index('services')[name] = service._info
+        return service._info['id']
+
+    def list_endpoints(self, service_id=None, region=None):
+        """Returns the info of the endpoints of a service in a region"""
+        return [ep for ep in self._index('endpoints', key='id').values()
+                if (service_id is None or ep['service_id'] == service_id) and
+                (region is None or ep['region'] == region)]
+
+    def create_endpoint(self, region, service_id, publicurl, adminurl,
+                        internalurl):
+        endpoint = self.api.endpoints.create(region=region,
+                                             service_id=service_id,
+                                             publicurl=publicurl,
+                                             adminurl=adminurl,
+                                             internalurl=internalurl)
+        self._index('endpoints', key='id')[endpoint._info['id']] = \
+            endpoint._info
+        return endpoint._info['id']
+
+    def delete_endpoint(self, endpoint_id):
+        self.api.endpoints.delete(endpoint_id)
+        self._index('endpoints', key='id').pop(endpoint_id, None)
+
+
+class KeystoneManager3(KeystoneManager):
+    """KeystoneManager for the v3 admin API.
+
+    The v3 client is built on a keystoneclient Session, which authenticates
+    with the given auth plugin and keeps one pool of HTTP connections for
+    every request the manager makes. Tenants map onto projects in the
+    default domain, and the per-interface v3 endpoints of a service in a
+    region are presented as one v2 style endpoint, so callers do not need
+    to know which API version is in use.
+    """
+
+    INTERFACES = ('public', 'admin', 'internal')
+
+    def __init__(self, session):
+        from keystoneclient.v3 import client as client3
+        self.session = session
+        self.api = client3.Client(session=session)
+        self._indexes = {}
+        self._user_roles = {}
+
+    def _index(self, kind, key='name'):
+        if kind == 'endpoints':
+            if kind not in self._indexes:
+                self._indexes[kind] = self._endpoint_index()
+            return self._indexes[kind]
+        if kind == 'tenants':
+            if kind not in self._indexes:
+                projects = self.api.projects.list(domain='default')
+                self._indexes[kind] = dict((p._info[key], p._info)
+                                           for p in projects)
+            return self._indexes[kind]
+        return super(KeystoneManager3, self)._index(kind, key=key)
+
+    def _endpoint_index(self):
+        """Groups the v3 endpoints by service and region"""
+        groups = {}
+        for ep in self.api.endpoints.list():
+            info = ep._info
+            region = info.get('region_id', info.get('region'))
+            group = groups.setdefault((info['service_id'], region), {
+                'service_id': info['service_id'],
+                'region': region,
+                'ids': [],
+            })
+            group['%surl' % info['interface']] = info['url']
+            group['ids'].append(info['id'])
+        index = {}
+        for group in groups.values():
+            group['id'] = sorted(group['ids'])[0]
+            index[group['id']] = group
+        return index
+
+    def create_tenant(self, name, description=None):
+        project = self.api.projects.create(name=name, domain='default',
+                                           description=description)
+        self._index('tenants')[name] = project._info
+        return project._info['id']
+
+    def create_user(self, name, password, email=None, tenant_id=None):
+        user = self.api.users.create(name=name, password=password,
+                                     email=email, domain='default',
+                                     default_project=tenant_id)
+        self._index('users')[name] = user._info
+        return user._info['id']
+
+    def update_password(self, user_id, password):
+        self.api.users.update(user_id, password=password)
+
+    def roles_for_user(self, user_id, tenant_id):
+        key = (user_id, tenant_id)
+        if key not in self._user_roles:
+            roles = self.api.roles.list(user=user_id, project=tenant_id)
+            self._user_roles[key] = set(r.id for r in roles)
+        return self._user_roles[key]
+
+    def add_user_role(self, user_id, role_id, tenant_id):
+        self.api.roles.grant(role_id, user=user_id, project=tenant_id)
+        self.roles_for_user(user_id, tenant_id).add(role_id)
+
+    def create_service(self, name, service_type, description=None):
+        service = self.api.services.create(name=name, type=service_type,
+                                           description=description)
+        self._index('services')[name] = service._info
+        return service._info['id']
+
+    def create_endpoint(self, region, service_id, publicurl, adminurl,
+                        internalurl):
+        urls = {'public': publicurl, 'admin': adminurl,
+                'internal': internalurl}
+        group = {'service_id': service_id, 'region': region, 'ids': []}
+        for interface in self.INTERFACES:
+            endpoint = self.api.endpoints.create(service=service_id,
+                                                 url=urls[interface],
+                                                 interface=interface,
+                                                 region=region)
+            group['%surl' % interface] = urls[interface]
+            group['ids'].append(endpoint._info['id'])
+        group['id'] = sorted(group['ids'])[0]
+        self._index('endpoints')[group['id']] = group
+        return group['id']
+
+    def delete_endpoint(self, endpoint_id):
+        group = self._index('endpoints').pop(endpoint_id, None)
+        for ep_id in (group['ids'] if group else [endpoint_id]):
+            self.api.endpoints.delete(ep_id)
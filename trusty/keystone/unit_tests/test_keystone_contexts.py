@@ -3,6 +3,8 @@ import os
 import keystone_context as context
 from mock import patch, MagicMock
 
+from charmhelpers.core import unitdata
+
 from test_utils import (
     CharmTestCase
 )
@@ -19,6 +21,11 @@ class TestKeystoneContexts(CharmTestCase):
 
     def setUp(self):
         super(TestKeystoneContexts, self).setUp(context, TO_PATCH)
+        # Contexts reach keystone_utils helpers that keep state in
+        # unitdata; keep it out of the charm tree.
+        patcher = patch.object(unitdata, 'kv')
+        patcher.start().return_value = unitdata.Storage(':memory:')
+        self.addCleanup(patcher.stop)
 
     @patch.object(context, 'is_cert_provided_in_config')
     @patch.object(context, 'mkdir')
@@ -249,8 +249,8 @@ class KeystoneRelationTests(CharmTestCase):
     @patch('keystone_utils.log')
     @patch('keystone_utils.ensure_ssl_cert_master')
     @patch.object(hooks, 'CONFIGS')
-    @patch.object(hooks, 'identity_changed')
-    def test_db_changed_allowed(self, identity_changed, configs,
+    @patch.object(hooks, 'reconcile_identity_relations')
+    def test_db_changed_allowed(self, reconcile, configs,
                                 mock_ensure_ssl_cert_master,
                                 mock_log):
         self.is_db_initialised.return_value = True
@@ -264,15 +264,13 @@ class KeystoneRelationTests(CharmTestCase):
                           configs.write.call_args_list)
         self.migrate_database.assert_called_with()
         self.assertTrue(self.ensure_initial_admin.called)
-        identity_changed.assert_called_with(
-            relation_id='identity-service:0',
-            remote_unit='unit/0')
+        reconcile.assert_called_with()
 
     @patch('keystone_utils.log')
     @patch('keystone_utils.ensure_ssl_cert_master')
     @patch.object(hooks, 'CONFIGS')
-    @patch.object(hooks, 'identity_changed')
-    def test_db_changed_not_allowed(self, identity_changed, configs,
+    @patch.object(hooks, 'reconcile_identity_relations')
+    def test_db_changed_not_allowed(self, reconcile, configs,
                                     mock_ensure_ssl_cert_master, mock_log):
         self.is_db_ready.return_value = False
         mock_ensure_ssl_cert_master.return_value = False
@@ -284,13 +282,13 @@ class KeystoneRelationTests(CharmTestCase):
                           configs.write.call_args_list)
         self.assertFalse(self.migrate_database.called)
         self.assertFalse(self.ensure_initial_admin.called)
-        self.assertFalse(identity_changed.called)
+        self.assertFalse(reconcile.called)
 
     @patch('keystone_utils.log')
     @patch('keystone_utils.ensure_ssl_cert_master')
     @patch.object(hooks, 'CONFIGS')
-    @patch.object(hooks, 'identity_changed')
-    def test_postgresql_db_changed(self, identity_changed, configs,
+    @patch.object(hooks, 'reconcile_identity_relations')
+    def test_postgresql_db_changed(self, reconcile, configs,
                                    mock_ensure_ssl_cert_master, mock_log):
         self.is_db_initialised.return_value = True
         self.is_db_ready.return_value = True
@@ -303,9 +301,7 @@ class KeystoneRelationTests(CharmTestCase):
                           configs.write.call_args_list)
         self.migrate_database.assert_called_with()
         self.assertTrue(self.ensure_initial_admin.called)
-        identity_changed.assert_called_with(
-            relation_id='identity-service:0',
-            remote_unit='unit/0')
+        reconcile.assert_called_with()
 
     @patch.object(hooks, 'git_install_requested')
     @patch('keystone_utils.log')
@@ -323,10 +319,10 @@ class KeystoneRelationTests(CharmTestCase):
     @patch.object(unison, 'ensure_user')
     @patch.object(unison, 'get_homedir')
     @patch.object(hooks, 'CONFIGS')
-    @patch.object(hooks, 'identity_changed')
+    @patch.object(hooks, 'reconcile_identity_relations')
     @patch.object(hooks, 'configure_https')
     def test_config_changed_no_upgrade_leader(self, configure_https,
-                                              identity_changed,
+                                              reconcile,
                                               configs, get_homedir,
                                               ensure_user,
                                               cluster_joined,
@@ -364,10 +360,8 @@ class KeystoneRelationTests(CharmTestCase):
 
         self.assertTrue(self.ensure_initial_admin.called)
         self.log.assert_called_with(
-            'Firing identity_changed hook for all related services.')
-        identity_changed.assert_called_with(
-            relation_id='identity-service:0',
-            remote_unit='unit/0')
+            'Reconciling all identity-service relations.')
+        reconcile.assert_called_with()
         admin_relation_changed.assert_called_with('identity-service:0')
 
     @patch.object(hooks, 'git_install_requested')
@@ -385,10 +379,10 @@ class KeystoneRelationTests(CharmTestCase):
     @patch.object(unison, 'ensure_user')
     @patch.object(unison, 'get_homedir')
     @patch.object(hooks, 'CONFIGS')
-    @patch.object(hooks, 'identity_changed')
+    @patch.object(hooks, 'reconcile_identity_relations')
     @patch.object(hooks, 'configure_https')
     def test_config_changed_no_upgrade_not_leader(self, configure_https,
-                                                  identity_changed,
+                                                  reconcile,
                                                   configs, get_homedir,
                                                   ensure_user, cluster_joined,
                                                   mock_is_ssl_cert_master,
@@ -419,7 +413,7 @@ class KeystoneRelationTests(CharmTestCase):
 
         self.assertFalse(self.migrate_database.called)
         self.assertFalse(self.ensure_initial_admin.called)
-        self.assertFalse(identity_changed.called)
+        self.assertFalse(reconcile.called)
 
     @patch.object(hooks, 'git_install_requested')
     @patch('keystone_utils.log')
@@ -437,10 +431,10 @@ class KeystoneRelationTests(CharmTestCase):
     @patch.object(unison, 'ensure_user')
     @patch.object(unison, 'get_homedir')
     @patch.object(hooks, 'CONFIGS')
-    @patch.object(hooks, 'identity_changed')
+    @patch.object(hooks, 'reconcile_identity_relations')
     @patch.object(hooks, 'configure_https')
     def test_config_changed_with_openstack_upgrade(self, configure_https,
-                                                   identity_changed,
+                                                   reconcile,
                                                    configs, get_homedir,
                                                    ensure_user, cluster_joined,
                                                    admin_relation_changed,
@@ -479,10 +473,8 @@ class KeystoneRelationTests(CharmTestCase):
 
         self.assertTrue(self.ensure_initial_admin.called)
         self.log.assert_called_with(
-            'Firing identity_changed hook for all related services.')
-        identity_changed.assert_called_with(
-            relation_id='identity-service:0',
-            remote_unit='unit/0')
+            'Reconciling all identity-service relations.')
+        reconcile.assert_called_with()
         admin_relation_changed.assert_called_with('identity-service:0')
 
     @patch.object(hooks, 'git_install_requested')
@@ -500,10 +492,10 @@ class KeystoneRelationTests(CharmTestCase):
     @patch.object(unison, 'ensure_user')
     @patch.object(unison, 'get_homedir')
     @patch.object(hooks, 'CONFIGS')
-    @patch.object(hooks, 'identity_changed')
+    @patch.object(hooks, 'reconcile_identity_relations')
     @patch.object(hooks, 'configure_https')
     def test_config_changed_git_updated(self, configure_https,
-                                        identity_changed,
+                                        reconcile,
                                         configs, get_homedir, ensure_user,
                                         cluster_joined, admin_relation_changed,
                                         mock_peer_units,
@@ -577,10 +569,12 @@ class KeystoneRelationTests(CharmTestCase):
 
     @patch('keystone_utils.log')
     @patch('keystone_utils.ensure_ssl_cert_master')
+    @patch.object(hooks, 'CONFIGS')
     @patch.object(hooks, 'hashlib')
     @patch.object(hooks, 'send_notifications')
     def test_identity_changed_leader(self, mock_send_notifications,
-                                     mock_hashlib, mock_ensure_ssl_cert_master,
+                                     mock_hashlib, configs,
+                                     mock_ensure_ssl_cert_master,
                                      mock_log):
         self.is_db_initialised.return_value = True
         self.is_db_ready.return_value = True
@@ -588,6 +582,7 @@ class KeystoneRelationTests(CharmTestCase):
         hooks.identity_changed(
             relation_id='identity-service:0',
             remote_unit='unit/0')
+        self.assertTrue(configs.write_all.called)
         self.add_service_to_keystone.assert_called_with(
             'identity-service:0',
             'unit/0')
@@ -607,6 +602,52 @@ class KeystoneRelationTests(CharmTestCase):
         self.log.assert_called_with(
             'Deferring identity_changed() to service leader.')
 
+    @patch.object(hooks, 'send_notifications')
+    def test_reconcile_identity_relations(self, mock_send_notifications):
+        self.is_elected_leader.return_value = True
+        self.relation_ids.return_value = ['identity-service:0']
+        self.related_units.return_value = ['unit/0', 'unit/1', 'unit/2']
+        settings = {'service': 'nova', 'region': 'RegionOne',
+                    'public_url': 'http://nova', 'admin_url': 'http://nova',
+                    'internal_url': 'http://nova'}
+
+        def fake_rel_get(rid=None, unit=None):
+            return dict(settings, **{'private-address': unit})
+
+        self.relation_get.side_effect = fake_rel_get
+        hooks.reconcile_identity_relations()
+        self.add_service_to_keystone.assert_called_once_with(
+            'identity-service:0', 'unit/2')
+        self.assertEquals(mock_send_notifications.call_count, 1)
+        self.assertEquals(list(mock_send_notifications.call_args[0][0]),
+                          ['nova-endpoint-changed'])
+
+    @patch.object(hooks, 'send_notifications')
+    def test_reconcile_identity_relations_distinct(self,
+                                                   mock_send_notifications):
+        self.is_elected_leader.return_value = True
+        self.relation_ids.return_value = ['identity-service:0',
+                                          'identity-service:1']
+        self.related_units.return_value = ['unit/0', 'unit/1']
+        self.relation_get.side_effect = \
+            lambda rid=None, unit=None: {'service': unit, 'public_url': 'p',
+                                         'admin_url': 'a',
+                                         'internal_url': 'i'}
+        hooks.reconcile_identity_relations()
+        self.add_service_to_keystone.assert_has_calls([
+            call('identity-service:0', 'unit/0'),
+            call('identity-service:0', 'unit/1'),
+            call('identity-service:1', 'unit/0'),
+            call('identity-service:1', 'unit/1')])
+        self.assertEquals(mock_send_notifications.call_count, 1)
+
+    @patch.object(hooks, 'sync_peerdb_relation_settings')
+    def test_reconcile_identity_relations_no_leader(self, mock_sync):
+        self.is_elected_leader.return_value = False
+        hooks.reconcile_identity_relations()
+        self.assertTrue(mock_sync.called)
+        self.assertFalse(self.add_service_to_keystone.called)
+
     @patch.object(hooks, 'local_unit')
     @patch.object(hooks, 'peer_units')
     @patch.object(unison, 'ssh_authorized_peers')
@@ -786,10 +827,10 @@ class KeystoneRelationTests(CharmTestCase):
 
     @patch('keystone_utils.log')
     @patch('keystone_utils.ensure_ssl_cert_master')
-    @patch.object(hooks, 'identity_changed')
+    @patch.object(hooks, 'reconcile_identity_relations')
     @patch.object(hooks, 'CONFIGS')
     def test_ha_relation_changed_clustered_leader(self, configs,
-                                                  identity_changed,
+                                                  reconcile,
                                                   mock_ensure_ssl_cert_master,
                                                   mock_log):
         self.is_db_initialised.return_value = True
@@ -803,10 +844,8 @@ class KeystoneRelationTests(CharmTestCase):
         hooks.ha_changed()
         self.assertTrue(configs.write_all.called)
         self.log.assert_called_with(
-            'Firing identity_changed hook for all related services.')
-        identity_changed.assert_called_with(
-            relation_id='identity-service:0',
-            remote_unit='unit/0')
+            'Reconciling all identity-service relations.')
+        reconcile.assert_called_with()
 
     @patch('keystone_utils.log')
     @patch('keystone_utils.ensure_ssl_cert_master')
@@ -878,7 +917,7 @@ class KeystoneRelationTests(CharmTestCase):
             peer_interface='cluster', ensure_local_user=True)
         self.assertTrue(mock_synchronize_ca.called)
         self.log.assert_called_with(
-            'Firing identity_changed hook for all related services.')
+            'Reconciling all identity-service relations.')
         self.assertTrue(self.ensure_initial_admin.called)
 
     @patch.object(utils, 'git_install_requested')
@@ -1,8 +1,15 @@
+from collections import OrderedDict
 from mock import patch, call, MagicMock, Mock
 from test_utils import CharmTestCase
+import json
 import os
+import shutil
+import subprocess
+import tempfile
 import manager
 
+from charmhelpers.core import hookenv, unitdata
+
 os.environ['JUJU_UNIT_NAME'] = 'keystone'
 with patch('charmhelpers.core.hookenv.config') as config:
     import keystone_utils as utils
@@ -10,6 +17,10 @@ with patch('charmhelpers.core.hookenv.config') as config:
 with patch.object(utils, 'register_configs'):
     import keystone_hooks as hooks
 
+# Patched by the TestKeystoneUtils fixture, tested on their own below
+create_endpoint_template = utils.create_endpoint_template
+get_admin_token = utils.get_admin_token
+
 TO_PATCH = [
     'api_port',
     'config',
@@ -67,6 +78,7 @@ class TestKeystoneUtils(CharmTestCase):
     def setUp(self):
         super(TestKeystoneUtils, self).setUp(utils, TO_PATCH)
         self.config.side_effect = self.test_config.get
+        utils._managers.clear()
 
         self.ctxt = MagicMock()
         self.rsc_map = {
@@ -235,6 +247,7 @@ class TestKeystoneUtils(CharmTestCase):
 
         mock_keystone = MagicMock()
         mock_keystone.resolve_tenant_id.return_value = 'tenant_id'
+        mock_keystone.resolve_user_id.return_value = None
         KeystoneManager.return_value = mock_keystone
 
         self.relation_get.return_value = {'service': 'keystone',
@@ -729,3 +742,346 @@ class TestKeystoneUtils(CharmTestCase):
         ]
         self.assertEquals(render.call_args_list, expected)
         service_restart.assert_called_with('keystone')
+
+    @patch.object(manager, 'KeystoneManager')
+    def test_get_manager_shared(self, KeystoneManager):
+        self.get_local_endpoint.return_value = 'http://localhost:80/v2.0/'
+        self.get_admin_token.return_value = 'token'
+        self.assertEquals(utils.get_manager(), utils.get_manager())
+        KeystoneManager.assert_called_once_with(
+            endpoint='http://localhost:80/v2.0/', token='token')
+
+    @patch.object(manager, 'KeystoneManager3')
+    @patch.object(utils, 'get_admin_session')
+    def test_get_manager_v3(self, get_admin_session, KeystoneManager3):
+        self.test_config.set('preferred-api-version', 3)
+        self.assertEquals(utils.get_manager(), utils.get_manager())
+        KeystoneManager3.assert_called_once_with(
+            get_admin_session.return_value)
+        self.assertFalse(self.get_admin_token.called)
+
+    @patch.object(manager, 'KeystoneManager')
+    @patch.object(utils, 'get_admin_session')
+    def test_get_manager_v3_fallback(self, get_admin_session,
+                                     KeystoneManager):
+        self.test_config.set('preferred-api-version', 3)
+        get_admin_session.return_value = None
+        self.get_local_endpoint.return_value = 'http://localhost:80/v2.0/'
+        self.get_admin_token.return_value = 'token'
+        self.assertEquals(utils.get_manager(), utils.get_manager())
+        get_admin_session.assert_called_once_with()
+        KeystoneManager.assert_called_once_with(
+            endpoint='http://localhost:80/v2.0/', token='token')
+
+    @patch.object(hookenv, 'cache', hookenv.HookCache())
+    def test_get_admin_token_parsed_once(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        conf = os.path.join(tmpdir, 'keystone.conf')
+        self._write(conf, '[DEFAULT]\nadmin_token = secret\n')
+        with patch.object(utils, 'KEYSTONE_CONF', conf):
+            self.assertEquals(get_admin_token(), 'secret')
+            os.unlink(conf)
+            self.assertEquals(get_admin_token(), 'secret')
+            # Parsed again in the next hook
+            hookenv.cache.clear()
+            self.assertRaises(IOError, get_admin_token)
+
+    @patch.object(utils, 'get_manager')
+    def test_update_user_password(self, get_manager):
+        get_manager.return_value.resolve_user_id.return_value = 'uid'
+        utils._managers['v3'] = get_manager.return_value
+        utils.update_user_password('nova', 'pass')
+        get_manager.return_value.update_password.assert_called_with(
+            user_id='uid', password='pass')
+        self.assertIn('v3', utils._managers)
+
+    @patch.object(utils.unitdata, 'kv')
+    @patch.object(utils, 'get_manager')
+    def test_update_admin_password_forgets_session(self, get_manager, kv):
+        kv.return_value = unitdata.Storage(':memory:')
+        kv.return_value.set(utils.ADMIN_SESSION_TOKEN_KEY, {'token': 'tok'})
+        self.test_config.set('admin-user', 'admin')
+        mgr = get_manager.return_value
+        mgr.resolve_user_id.return_value = 'uid'
+        utils._managers['v3'] = mgr
+        utils.update_user_password('admin', 'newpass')
+        mgr.update_password.assert_called_with(user_id='uid',
+                                               password='newpass')
+        self.assertNotIn('v3', utils._managers)
+        self.assertTrue(mgr.session.auth.invalidate.called)
+        self.assertIsNone(kv.return_value.get(utils.ADMIN_SESSION_TOKEN_KEY))
+
+    @patch.object(utils, 'get_manager')
+    def test_create_endpoint_template_up_to_date(self, get_manager):
+        mgr = get_manager.return_value
+        mgr.resolve_service_id.return_value = 'sid'
+        mgr.list_endpoints.return_value = [
+            {'id': 'ep1', 'service_id': 'sid', 'region': 'RegionOne',
+             'publicurl': 'pub', 'adminurl': 'adm', 'internalurl': 'int'}]
+        create_endpoint_template('RegionOne', 'svc', 'pub', 'adm', 'int')
+        mgr.list_endpoints.assert_called_with(service_id='sid',
+                                              region='RegionOne')
+        self.assertFalse(mgr.delete_endpoint.called)
+        self.assertFalse(mgr.create_endpoint.called)
+
+    @patch.object(utils, 'get_manager')
+    def test_create_endpoint_template_updated(self, get_manager):
+        mgr = get_manager.return_value
+        mgr.resolve_service_id.return_value = 'sid'
+        mgr.list_endpoints.return_value = [
+            {'id': 'ep1', 'service_id': 'sid', 'region': 'RegionOne',
+             'publicurl': 'old', 'adminurl': 'adm', 'internalurl': 'int'}]
+        create_endpoint_template('RegionOne', 'svc', 'pub', 'adm', 'int')
+        mgr.delete_endpoint.assert_called_with('ep1')
+        mgr.create_endpoint.assert_called_with(
+            region='RegionOne', service_id='sid', publicurl='pub',
+            adminurl='adm', internalurl='int')
+
+    def _write(self, path, content):
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as fd:
+            fd.write(content)
+
+    @patch.object(utils, 'file_sha256')
+    @patch.object(utils.unitdata, 'kv')
+    def test_file_digests_cached(self, kv, file_sha256):
+        kv.return_value = unitdata.Storage(':memory:')
+        file_sha256.side_effect = lambda path: 'digest-%s' % path
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self._write(os.path.join(tmpdir, 'a'), 'a')
+        self._write(os.path.join(tmpdir, 'certs', 'b'), 'b')
+        digests = utils.file_digests([tmpdir])
+        self.assertEquals(sorted(digests),
+                          [os.path.join(tmpdir, 'a'),
+                           os.path.join(tmpdir, 'certs', 'b')])
+        self.assertEquals(utils.file_digests([tmpdir]), digests)
+        self.assertEquals(file_sha256.call_count, 2)
+        self._write(os.path.join(tmpdir, 'a'), 'changed')
+        utils.file_digests([tmpdir])
+        file_sha256.assert_called_with(os.path.join(tmpdir, 'a'))
+        self.assertEquals(file_sha256.call_count, 3)
+
+    @patch.object(utils, 'ensure_permissions')
+    @patch.object(utils.unitdata, 'kv')
+    def test_apply_sync_manifest(self, kv, ensure_permissions):
+        kv.return_value = unitdata.Storage(':memory:')
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        unchanged = os.path.join(tmpdir, 'ssl', 'unchanged')
+        changed = os.path.join(tmpdir, 'ssl', 'changed')
+        self._write(unchanged, 'same')
+        self._write(changed, 'old')
+        self._write(os.path.join(tmpdir, 'sync', 'objects',
+                                 utils.file_sha256(unchanged)), 'same')
+        self._write(os.path.join(tmpdir, 'new'), 'new')
+        new_digest = utils.file_sha256(os.path.join(tmpdir, 'new'))
+        self._write(os.path.join(tmpdir, 'sync', 'objects', new_digest),
+                    'new')
+        manifest = os.path.join(tmpdir, 'sync', 'manifest.json')
+        self._write(manifest, json.dumps({'files': {
+            unchanged: utils.file_sha256(unchanged),
+            changed: new_digest}}))
+        user, group = utils.file_owner(changed)
+        self.assertEquals(utils.apply_sync_manifest(manifest), [changed])
+        with open(changed) as fd:
+            self.assertEquals(fd.read(), 'new')
+        # The manifest records no owners, so the file keeps its own
+        ensure_permissions.assert_called_with(
+            '%s.juju-sync' % changed, user=user, group=group,
+            perms=utils.SSL_SYNC_DEFAULT_MODE)
+        self.assertEquals(utils.apply_sync_manifest(manifest), [])
+
+    @patch.object(utils, 'ensure_permissions')
+    @patch.object(utils.unitdata, 'kv')
+    def test_apply_sync_manifest_modes(self, kv, ensure_permissions):
+        kv.return_value = unitdata.Storage(':memory:')
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        key = os.path.join(tmpdir, 'ssl', 'key')
+        cert = os.path.join(tmpdir, 'ssl', 'cert')
+        self._write(cert, 'cert')
+        os.chmod(cert, 0o600)
+        self._write(os.path.join(tmpdir, 'key'), 'key')
+        key_digest = utils.file_sha256(os.path.join(tmpdir, 'key'))
+        self._write(os.path.join(tmpdir, 'sync', 'objects', key_digest),
+                    'key')
+        manifest = os.path.join(tmpdir, 'sync', 'manifest.json')
+        self._write(manifest, json.dumps({
+            'files': {key: key_digest, cert: utils.file_sha256(cert)},
+            'modes': {key: 0o600, cert: 0o644}}))
+        self.assertEquals(utils.apply_sync_manifest(manifest), [key])
+        ensure_permissions.assert_called_once_with(
+            '%s.juju-sync' % key, user='keystone', group='keystone',
+            perms=0o600)
+        # Unchanged, but its mode is brought in line
+        self.assertEquals(os.stat(cert).st_mode & 0o777, 0o644)
+
+    @patch.object(utils, 'file_owner')
+    @patch.object(utils, 'ensure_permissions')
+    @patch.object(utils.unitdata, 'kv')
+    def test_apply_sync_manifest_owners(self, kv, ensure_permissions,
+                                        file_owner):
+        kv.return_value = unitdata.Storage(':memory:')
+        file_owner.return_value = ['keystone', 'keystone']
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        ca = os.path.join(tmpdir, 'ssl', 'ca')
+        cert = os.path.join(tmpdir, 'ssl', 'cert')
+        self._write(cert, 'cert')
+        self._write(os.path.join(tmpdir, 'ca'), 'ca')
+        ca_digest = utils.file_sha256(os.path.join(tmpdir, 'ca'))
+        self._write(os.path.join(tmpdir, 'sync', 'objects', ca_digest),
+                    'ca')
+        manifest = os.path.join(tmpdir, 'sync', 'manifest.json')
+        self._write(manifest, json.dumps({
+            'files': {ca: ca_digest, cert: utils.file_sha256(cert)},
+            'modes': {ca: 0o644, cert: 0o640},
+            'owners': {ca: ['root', 'root'], cert: ['root', 'ssl-cert']}}))
+        self.assertEquals(utils.apply_sync_manifest(manifest), [ca])
+        ensure_permissions.assert_has_calls([
+            call('%s.juju-sync' % ca, user='root', group='root',
+                 perms=0o644),
+            # Unchanged, but its owner is brought in line
+            call(cert, user='root', group='ssl-cert'),
+        ], any_order=True)
+        self.assertEquals(ensure_permissions.call_count, 2)
+
+    @patch.object(utils, 'ensure_permissions')
+    @patch.object(utils.unitdata, 'kv')
+    def test_apply_sync_manifest_removed(self, kv, ensure_permissions):
+        kv.return_value = unitdata.Storage(':memory:')
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        kept = os.path.join(tmpdir, 'ssl', 'kept')
+        gone = os.path.join(tmpdir, 'ssl', 'gone')
+        local = os.path.join(tmpdir, 'ssl', 'local')
+        for f in [kept, gone, local]:
+            self._write(f, f)
+        digests = dict((f, utils.file_sha256(f)) for f in [kept, gone])
+        manifest = os.path.join(tmpdir, 'sync', 'manifest.json')
+        self._write(manifest, json.dumps({'files': digests}))
+        self.assertEquals(utils.apply_sync_manifest(manifest), [])
+
+        del digests[gone]
+        self._write(manifest, json.dumps({'files': digests}))
+        self.assertEquals(utils.apply_sync_manifest(manifest), [gone])
+        self.assertFalse(os.path.exists(gone))
+        # Never synced, so left alone
+        self.assertTrue(os.path.exists(local))
+        self.assertTrue(os.path.exists(kept))
+        self.assertEquals(kv.return_value.get(utils.SSL_SYNC_APPLIED_KEY),
+                          [kept])
+
+    @patch.object(utils, 'ensure_permissions')
+    @patch.object(utils, 'write_file')
+    @patch.object(utils, 'ensure_ssl_dirs')
+    @patch.object(utils.unitdata, 'kv')
+    def test_stage_paths_for_sync_modes(self, kv, ensure_ssl_dirs,
+                                        write_file, ensure_permissions):
+        kv.return_value = unitdata.Storage(':memory:')
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        key = os.path.join(tmpdir, 'ssl', 'key')
+        self._write(key, 'key')
+        os.chmod(key, 0o600)
+        objects = os.path.join(tmpdir, 'sync', 'objects')
+        os.makedirs(objects)
+        with patch.object(utils, 'SSL_SYNC_OBJECTS_DIR', objects):
+            manifest = utils.stage_paths_for_sync(
+                [os.path.join(tmpdir, 'ssl')])
+        self.assertEquals(manifest, {
+            'files': {key: utils.file_sha256(key)},
+            'modes': {key: 0o600},
+            'owners': {key: utils.file_owner(key)}})
+        self.assertEquals(os.listdir(objects), [utils.file_sha256(key)])
+
+    @patch.object(utils, 'ensure_permissions')
+    @patch.object(utils.unitdata, 'kv')
+    def test_apply_sync_manifest_corrupt(self, kv, ensure_permissions):
+        kv.return_value = unitdata.Storage(':memory:')
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        target = os.path.join(tmpdir, 'ssl', 'cert')
+        self._write(target, 'old')
+        self._write(os.path.join(tmpdir, 'sync', 'objects', 'digest'),
+                    'garbage')
+        manifest = os.path.join(tmpdir, 'sync', 'manifest.json')
+        self._write(manifest, json.dumps({'files': {target: 'digest'}}))
+        self.assertRaises(Exception, utils.apply_sync_manifest, manifest)
+        with open(target) as fd:
+            self.assertEquals(fd.read(), 'old')
+        self.assertEquals(os.listdir(os.path.dirname(target)), ['cert'])
+
+    @patch('charmhelpers.core.decorators.time')
+    @patch.object(utils, 'peer_units')
+    @patch.object(utils.grp, 'getgrnam')
+    @patch.object(utils.unison, 'sync_to_peer')
+    @patch.object(utils, 'collect_authed_units')
+    def test_unison_sync_partial(self, collect_authed_units, sync_to_peer,
+                                 getgrnam, peer_units, mock_time):
+        collect_authed_units.return_value = OrderedDict([
+            ('keystone/1', '10.0.0.1'), ('keystone/2', '10.0.0.2'),
+            ('keystone/3', '10.0.0.3')])
+        peer_units.return_value = ['keystone/1', 'keystone/2', 'keystone/3']
+        getgrnam.return_value.gr_gid = 1000
+
+        def fake_sync_to_peer(host, **kwargs):
+            if host == '10.0.0.2':
+                raise subprocess.CalledProcessError(1, 'unison')
+
+        sync_to_peer.side_effect = fake_sync_to_peer
+        self.assertEquals(utils.unison_sync(['/var/lib/keystone/juju_sync']),
+                          ['keystone/1', 'keystone/3'])
+        # keystone/2 was retried on its own
+        hosts = [c[0][0] for c in sync_to_peer.call_args_list]
+        self.assertEquals(hosts.count('10.0.0.1'), 1)
+        self.assertEquals(hosts.count('10.0.0.2'), 4)
+
+    @patch.object(utils, 'unit_private_ip')
+    def test_collect_authed_units(self, unit_private_ip):
+        unit_private_ip.return_value = '10.0.0.10'
+        self.relation_ids.return_value = ['cluster:0']
+        self.related_units.return_value = ['keystone/1', 'keystone/2',
+                                           'keystone/3']
+        settings = {
+            'keystone/1': {'private-address': '10.0.0.1',
+                           'ssh_authorized_hosts': '10.0.0.10:10.0.0.2'},
+            'keystone/2': {'private-address': '10.0.0.2'},
+            'keystone/3': {'private-address': '10.0.0.3',
+                           'ssh_authorized_hosts': '10.0.0.2'},
+        }
+
+        def fake_rel_get(attribute, rid=None, unit=None):
+            return settings[unit].get(attribute)
+
+        self.relation_get.side_effect = fake_rel_get
+        self.assertEquals(utils.collect_authed_units('cluster'),
+                          {'keystone/1': '10.0.0.1'})
+
+    @patch.object(utils, 'peer_units')
+    @patch.object(utils, 'unison_sync')
+    @patch.object(utils, 'stage_paths_for_sync')
+    @patch.object(utils, 'create_peer_actions')
+    @patch.object(utils, 'create_peer_service_actions')
+    @patch.object(utils.os.path, 'isdir')
+    @patch.object(utils, 'is_pki_enabled')
+    def test_synchronize_ca_partial(self, is_pki_enabled, isdir,
+                                    create_peer_service_actions,
+                                    create_peer_actions,
+                                    stage_paths_for_sync, unison_sync,
+                                    peer_units):
+        self.test_config.set('use-https', 'True')
+        is_pki_enabled.return_value = False
+        isdir.return_value = True
+        stage_paths_for_sync.return_value = {'files': {}, 'modes': {}}
+        unison_sync.return_value = ['keystone/1', 'keystone/3']
+        peer_units.return_value = ['keystone/1', 'keystone/2', 'keystone/3']
+        settings = utils.synchronize_ca()
+        self.assertEquals(json.loads(settings['ssl-synced-units']),
+                          ['keystone-1', 'keystone-3'])
+        self.log.assert_any_call(
+            'Peers not synced, will retry on next sync request: keystone/2',
+            level=utils.WARNING)
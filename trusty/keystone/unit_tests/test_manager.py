@@ -0,0 +1,127 @@
+import unittest
+
+from mock import patch, MagicMock
+
+import manager
+
+
+def resource(**info):
+    r = MagicMock()
+    r._info = info
+    r.id = info.get('id')
+    return r
+
+
+class TestKeystoneManager(unittest.TestCase):
+
+    def setUp(self):
+        patcher = patch.object(manager.client, 'Client')
+        self.Client = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.api = self.Client.return_value
+        self.api.tenants.list.return_value = [
+            resource(id='t1', name='admin'),
+            resource(id='t2', name='services')]
+        self.api.users.list.return_value = [resource(id='u1', name='admin')]
+        self.api.roles.list.return_value = [resource(id='r1', name='Admin')]
+        self.api.services.list.return_value = [
+            resource(id='s1', name='keystone', type='identity')]
+        self.api.endpoints.list.return_value = [
+            resource(id='e1', service_id='s1', region='RegionOne'),
+            resource(id='e2', service_id='s1', region='RegionTwo')]
+        self.manager = manager.KeystoneManager('http://localhost:35357/v2.0/',
+                                               'token')
+
+    def test_resolve_lists_once(self):
+        self.assertEquals(self.manager.resolve_tenant_id('admin'), 't1')
+        self.assertEquals(self.manager.resolve_tenant_id('services'), 't2')
+        self.assertEquals(self.manager.resolve_tenant_id('missing'), None)
+        self.assertEquals(self.api.tenants.list.call_count, 1)
+        self.assertEquals(self.manager.resolve_user_id('admin'), 'u1')
+        self.assertEquals(self.manager.resolve_role_id('Admin'), 'r1')
+        self.assertEquals(self.manager.resolve_service_id('keystone'), 's1')
+        self.assertEquals(
+            self.manager.resolve_service_id_by_type('identity'), 's1')
+        self.assertEquals(self.api.services.list.call_count, 1)
+
+    def test_create_updates_index(self):
+        self.api.roles.create.return_value = resource(id='r2', name='Member')
+        self.assertEquals(self.manager.resolve_role_id('Member'), None)
+        self.assertEquals(self.manager.create_role('Member'), 'r2')
+        self.assertEquals(self.manager.resolve_role_id('Member'), 'r2')
+        self.assertEquals(self.api.roles.list.call_count, 1)
+
+    def test_endpoints(self):
+        eps = self.manager.list_endpoints(service_id='s1', region='RegionOne')
+        self.assertEquals([ep['id'] for ep in eps], ['e1'])
+        self.manager.delete_endpoint('e1')
+        self.api.endpoints.delete.assert_called_with('e1')
+        self.api.endpoints.create.return_value = resource(
+            id='e3', service_id='s1', region='RegionOne')
+        self.manager.create_endpoint('RegionOne', 's1', 'pub', 'adm', 'int')
+        eps = self.manager.list_endpoints(service_id='s1', region='RegionOne')
+        self.assertEquals([ep['id'] for ep in eps], ['e3'])
+        self.assertEquals(self.api.endpoints.list.call_count, 1)
+
+    def test_user_roles(self):
+        self.api.roles.roles_for_user.return_value = [resource(id='r1')]
+        self.assertEquals(self.manager.roles_for_user('u1', 't1'), set(['r1']))
+        self.manager.add_user_role('u1', 'r2', 't1')
+        self.api.roles.add_user_role.assert_called_with(user='u1', role='r2',
+                                                        tenant='t1')
+        self.assertEquals(self.manager.roles_for_user('u1', 't1'),
+                          set(['r1', 'r2']))
+        self.assertEquals(self.api.roles.roles_for_user.call_count, 1)
+
+    def test_invalidate(self):
+        self.manager.resolve_tenant_id('admin')
+        self.manager.invalidate('tenants')
+        self.manager.resolve_tenant_id('admin')
+        self.assertEquals(self.api.tenants.list.call_count, 2)
+
+
+class TestKeystoneManager3(unittest.TestCase):
+
+    def setUp(self):
+        patcher = patch('keystoneclient.v3.client.Client')
+        self.Client = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.api = self.Client.return_value
+        self.api.endpoints.list.return_value = [
+            resource(id='e%d' % i, service_id='s1', region_id='RegionOne',
+                     interface=interface, url=interface)
+            for i, interface in enumerate(['public', 'admin', 'internal'])]
+        self.session = MagicMock()
+        self.manager = manager.KeystoneManager3(self.session)
+
+    def test_session(self):
+        self.Client.assert_called_with(session=self.session)
+
+    def test_endpoints_grouped(self):
+        eps = self.manager.list_endpoints(service_id='s1', region='RegionOne')
+        self.assertEquals(len(eps), 1)
+        self.assertEquals(eps[0]['publicurl'], 'public')
+        self.assertEquals(eps[0]['adminurl'], 'admin')
+        self.assertEquals(eps[0]['internalurl'], 'internal')
+        self.manager.delete_endpoint(eps[0]['id'])
+        self.assertEquals(self.api.endpoints.delete.call_count, 3)
+        self.assertEquals(
+            self.manager.list_endpoints(service_id='s1', region='RegionOne'),
+            [])
+
+    def test_create_endpoint(self):
+        self.api.endpoints.create.side_effect = [
+            resource(id='e3'), resource(id='e4'), resource(id='e5')]
+        self.manager.create_endpoint('RegionTwo', 's1', 'pub', 'adm', 'int')
+        self.api.endpoints.create.assert_any_call(
+            service='s1', url='adm', interface='admin', region='RegionTwo')
+        eps = self.manager.list_endpoints(service_id='s1', region='RegionTwo')
+        self.assertEquals(eps[0]['publicurl'], 'pub')
+        self.assertEquals(self.api.endpoints.list.call_count, 1)
+
+    def test_tenants_are_projects(self):
+        self.api.projects.list.return_value = [resource(id='p1',
+                                                        name='admin')]
+        self.assertEquals(self.manager.resolve_tenant_id('admin'), 'p1')
+        self.api.projects.list.assert_called_with(domain='default')
+        self.assertFalse(self.api.tenants.list.called)
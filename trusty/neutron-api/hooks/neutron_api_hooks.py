@@ -10,6 +10,9 @@ from charmhelpers.core.hookenv import (
     Hooks,
     UnregisteredHookError,
     config,
+    enable_log_buffering,
+    enable_relation_set_buffering,
+    enable_relation_snapshot,
     is_relation_made,
     local_unit,
     log,
@@ -565,6 +568,9 @@ def etcd_proxy_force_restart(relation_id=None):
 
 
 def main():
+    enable_log_buffering()
+    enable_relation_snapshot()
+    enable_relation_set_buffering()
     try:
         hooks.execute(sys.argv)
     except UnregisteredHookError as e:
@@ -8,6 +8,7 @@ import glob
 from base64 import b64encode
 from charmhelpers.contrib.openstack import context, templating
 from charmhelpers.contrib.openstack.neutron import (
+    iter_neutron_resources,
     neutron_plugin_attribute,
 )
 
@@ -454,7 +455,12 @@ def get_neutron_client():
 def router_feature_present(feature):
     ''' Check For dvr enabled routers '''
     neutron_client = get_neutron_client()
-    for router in neutron_client.list_routers()['routers']:
+    # Neutron filters on the feature and stops at the first match. Servers
+    # that cannot filter on it return every router, so check it here too.
+    routers = iter_neutron_resources(neutron_client.list_routers, 'routers',
+                                     fields=['id', feature],
+                                     **{feature: True})
+    for router in routers:
         if router.get(feature, False):
             return True
     return False
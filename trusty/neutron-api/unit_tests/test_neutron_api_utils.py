@@ -414,7 +414,7 @@ class TestNeutronAPIUtils(CharmTestCase):
             ]
         }
         dummy_client = MagicMock()
-        dummy_client.list_routers.return_value = routers
+        dummy_client.list_routers.return_value = iter([routers])
         get_neutron_client.return_value = dummy_client
         self.assertEquals(nutils.router_feature_present('ha'), False)
 
@@ -438,7 +438,31 @@ class TestNeutronAPIUtils(CharmTestCase):
         }
 
         dummy_client = MagicMock()
-        dummy_client.list_routers.return_value = routers
+        dummy_client.list_routers.return_value = iter([routers])
+        get_neutron_client.return_value = dummy_client
+        self.assertEquals(nutils.router_feature_present('ha'), True)
+
+    @patch.object(nutils, 'get_neutron_client')
+    def test_router_feature_present_server_side_filter(self,
+                                                      get_neutron_client):
+        dummy_client = MagicMock()
+        dummy_client.list_routers.return_value = iter([])
+        get_neutron_client.return_value = dummy_client
+        self.assertEquals(nutils.router_feature_present('distributed'), False)
+        dummy_client.list_routers.assert_called_with(
+            retrieve_all=False, fields=['id', 'distributed'],
+            distributed=True, limit=100)
+
+    @patch.object(nutils, 'get_neutron_client')
+    def test_router_feature_present_stops_at_first_match(self,
+                                                        get_neutron_client):
+        def pages():
+            yield {'routers': [{'id': 'r1', 'ha': False}]}
+            yield {'routers': [{'id': 'r2', 'ha': True}]}
+            raise AssertionError('fetched a page past the first match')
+
+        dummy_client = MagicMock()
+        dummy_client.list_routers.return_value = pages()
         get_neutron_client.return_value = dummy_client
         self.assertEquals(nutils.router_feature_present('ha'), True)
 
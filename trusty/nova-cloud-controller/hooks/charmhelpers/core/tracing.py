@@ -0,0 +1,235 @@
+# Copyright 2014-2015 Canonical Limited.
+#
+# This file is part of charm-helpers.
+#
+# charm-helpers is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# charm-helpers is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with charm-helpers.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Hook execution tracing.
+
+When tracing is enabled, :meth:`Hooks.execute
+<charmhelpers.core.hookenv.Hooks.execute>` records a span for every
+subprocess it runs (hook tools such as ``relation-get`` or ``juju-log``
+are told apart from other commands), every ``service()`` call and every
+``OSConfigRenderer.render``/``write``. The spans are written to a JSON
+file per hook under ``$CHARM_DIR/.hook-traces`` in the Chrome trace event
+format, which chrome://tracing, speedscope and flamegraph converters can
+load directly.
+
+Commands are traced by replacing ``subprocess.Popen``, so ``call``,
+``check_call`` and ``check_output`` are covered however they were
+imported. Two cases are not: code holding its own reference to ``Popen``
+from before tracing started (``from subprocess import Popen``), and
+processes that are only ever polled rather than waited for, since their
+span is recorded when they are waited for.
+
+Enable it by passing ``trace=True`` to :class:`Hooks
+<charmhelpers.core.hookenv.Hooks>` or by setting ``CHARM_HELPERS_TRACE``
+in the hook environment, and summarise recent runs with::
+
+    chlp trace-summary
+"""
+
+import glob
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+TRACE_DIR = '.hook-traces'
+TRACE_RETENTION = 50
+
+HOOK_TOOLS = frozenset([
+    'action-fail', 'action-get', 'action-set', 'close-port', 'config-get',
+    'is-leader', 'juju-log', 'juju-reboot', 'leader-get', 'leader-set',
+    'open-port', 'relation-get', 'relation-ids', 'relation-list',
+    'relation-set', 'status-get', 'status-set', 'storage-get',
+    'storage-list', 'unit-get',
+])
+
+
+def trace_dir():
+    """The directory traces are written to"""
+    return os.path.join(os.environ.get('CHARM_DIR') or os.getcwd(),
+                        TRACE_DIR)
+
+
+class Tracer(object):
+    """Records timed spans for a single hook run.
+
+    Spans nest: a span started while another is open in the same thread
+    is recorded as its child. Spans may be recorded from several threads.
+    """
+
+    def __init__(self, hook_name):
+        self.hook_name = hook_name
+        self.events = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._patched = []
+        self._start = time.time()
+
+    @property
+    def _stack(self):
+        """Categories of the spans open in the calling thread"""
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _record(self, name, category, start, args):
+        event = {
+            'name': name,
+            'cat': category,
+            'ph': 'X',
+            'ts': int((start - self._start) * 1e6),
+            'dur': int((time.time() - start) * 1e6),
+            'pid': os.getpid(),
+            'tid': threading.current_thread().ident,
+            'args': args,
+        }
+        with self._lock:
+            self.events.append(event)
+
+    @contextmanager
+    def span(self, name, category, **args):
+        """Record the time spent in the body of the with statement"""
+        start = time.time()
+        self._stack.append(category)
+        try:
+            yield
+        finally:
+            self._stack.pop()
+            self._record(name, category, start, args)
+
+    def _traced_popen(self, popen):
+        """A Popen that records a span for its process once waited for"""
+        tracer = self
+
+        class TracedPopen(popen):
+            def __init__(self, *args, **kwargs):
+                self._trace = None
+                cmd = args[0] if args else kwargs.get('args')
+                if cmd:
+                    if isinstance(cmd, (list, tuple)):
+                        argv = [str(c) for c in cmd]
+                    else:
+                        argv = str(cmd).split()
+                    name = os.path.basename(argv[0])
+                    category = ('hook-tool' if name in HOOK_TOOLS
+                                else 'subprocess')
+                    self._trace = (name, category, time.time(),
+                                   {'argv': argv})
+                super(TracedPopen, self).__init__(*args, **kwargs)
+
+            def wait(self, *args, **kwargs):
+                try:
+                    return super(TracedPopen, self).wait(*args, **kwargs)
+                finally:
+                    if self._trace is not None and self.returncode is not None:
+                        trace, self._trace = self._trace, None
+                        tracer._record(*trace)
+
+        TracedPopen.__name__ = popen.__name__
+        return TracedPopen
+
+    def _wrap_call(self, name, category, func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            span_args = {'args': [str(a) for a in args]}
+            with self.span(name, category, **span_args):
+                return func(*args, **kwargs)
+        return wrapper
+
+    def _patch(self, owner, attr, replacement):
+        self._patched.append((owner, attr, getattr(owner, attr)))
+        setattr(owner, attr, replacement)
+
+    def install(self):
+        """Start recording subprocesses, services and template renders"""
+        self._patch(subprocess, 'Popen', self._traced_popen(subprocess.Popen))
+        from charmhelpers.core import host
+        self._patch(host, 'service',
+                    self._wrap_call('service', 'service', host.service))
+        # Only charms that already use the renderer need it traced, and
+        # importing it here would pull in its dependencies.
+        templating = sys.modules.get(
+            'charmhelpers.contrib.openstack.templating')
+        if templating is not None:
+            renderer = templating.OSConfigRenderer
+            for attr in ('render', 'write'):
+                self._patch(renderer, attr, self._wrap_call(
+                    'OSConfigRenderer.{}'.format(attr), 'template',
+                    getattr(renderer, attr)))
+
+    def uninstall(self):
+        """Undo :meth:`install`"""
+        while self._patched:
+            owner, attr, original = self._patched.pop()
+            setattr(owner, attr, original)
+
+    def save(self, status='ok'):
+        """Write the trace to :func:`trace_dir` and prune old traces"""
+        path = trace_dir()
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        trace = {
+            'hook': self.hook_name,
+            'start': self._start,
+            'duration': time.time() - self._start,
+            'status': status,
+            'traceEvents': self.events,
+        }
+        filename = os.path.join(path, '{:.6f}-{}.json'.format(
+            self._start, self.hook_name))
+        with open(filename, 'w') as f:
+            json.dump(trace, f)
+        for old in recent_traces(path)[TRACE_RETENTION:]:
+            os.remove(old)
+        return filename
+
+
+def recent_traces(path=None, limit=None):
+    """Paths of the saved traces, newest first"""
+    traces = sorted(glob.glob(os.path.join(path or trace_dir(), '*.json')),
+                    reverse=True)
+    return traces[:limit] if limit else traces
+
+
+def summarize(path=None, limit=10, top=20):
+    """Aggregate the spans of the most recent traces
+
+    Returns a list of ``(category, name, count, total_seconds,
+    mean_seconds)`` rows ordered by total time. Whole hook runs are
+    reported first, under the ``hook`` category, followed by the top
+    spans.
+    """
+    totals = {}
+    for filename in recent_traces(path, limit):
+        with open(filename) as f:
+            trace = json.load(f)
+        for event in trace['traceEvents']:
+            key = (event['cat'], event['name'])
+            count, total = totals.get(key, (0, 0.0))
+            totals[key] = (count + 1, total + event['dur'] / 1e6)
+    summary = sorted(((cat, name, count, round(total, 3),
+                       round(total / count, 3))
+                      for (cat, name), (count, total) in totals.items()),
+                     key=lambda row: -row[3])
+    hooks = [row for row in summary if row[0] == 'hook']
+    spans = [row for row in summary if row[0] != 'hook']
+    return hooks + spans[:top]
@@ -147,6 +147,9 @@ associated to the hookname.
    [(1, u'x', 1, u'install', u'2015-01-21T16:49:30.038372'),
     (2, u'x', 42, u'config-changed', u'2015-01-21T16:49:30.038786')]
 
+Only the history of the most recent hooks is retained, see
+:attr:`Storage.history_retention`.
+
 """
 
 import collections
@@ -156,11 +159,27 @@ import itertools
 import json
 import os
 import pprint
+import shutil
 import sqlite3
 import sys
+import tempfile
+import time
 
 __author__ = 'Kapil Thangavelu <kapil.foss@gmail.com>'
 
+# Number of most recent hooks whose value history is kept
+HISTORY_RETENTION = 100
+
+# Maximum number of keys bound to a single statement; sqlite limits the
+# number of host parameters to 999.
+_SQL_BATCH = 500
+
+# Statements are reused verbatim so that sqlite3's statement cache only
+# prepares each of them once per connection.
+_UPSERT_KV = 'insert or replace into kv (key, data) values (?, ?)'
+_UPSERT_REVISION = ('insert or replace into kv_revisions (key, revision, data)'
+                    ' values (?, ?, ?)')
+
 
 class Storage(object):
     """Simple key value database for local unit state within charms.
@@ -169,7 +188,12 @@ class Storage(object):
 
     To support dicts, lists, integer, floats, and booleans values
     are automatically json encoded/decoded.
+
+    Each :meth:`hook_scope` drops the history of hooks older than the
+    last ``history_retention``; set it to None to keep everything.
     """
+    history_retention = HISTORY_RETENTION
+
     def __init__(self, path=None):
         self.db_path = path
         if path is None:
@@ -226,12 +250,33 @@ class Storage(object):
         """
         Set the values of multiple keys at once.
 
+        Current values are read in batches and only the keys whose value
+        changed are written, with one statement for all of them.
+
         :param dict mapping: Mapping of keys to values
         :param str prefix: Optional prefix to apply to all keys in `mapping`
             before setting
         """
-        for k, v in mapping.items():
-            self.set("%s%s" % (prefix, k), v)
+        rows = [("%s%s" % (prefix, k), json.dumps(v))
+                for k, v in mapping.items()]
+        existing = {}
+        for i in range(0, len(rows), _SQL_BATCH):
+            keys = [key for key, _ in rows[i:i + _SQL_BATCH]]
+            self.cursor.execute(
+                'select key, data from kv where key in (%s)' %
+                ','.join(['?'] * len(keys)), keys)
+            existing.update(self.cursor.fetchall())
+
+        # Skip mutations to the same value
+        changed = [(key, data) for key, data in rows
+                   if existing.get(key) != data]
+        if not changed:
+            return
+        self.cursor.executemany(_UPSERT_KV, changed)
+        if self.revision:
+            self.cursor.executemany(
+                _UPSERT_REVISION,
+                [(key, self.revision, data) for key, data in changed])
 
     def unset(self, key):
         """
@@ -284,38 +329,12 @@ class Storage(object):
             if exists[0] == serialized:
                 return value
 
-        if not exists:
-            self.cursor.execute(
-                'insert into kv (key, data) values (?, ?)',
-                (key, serialized))
-        else:
-            self.cursor.execute('''
-            update kv
-            set data = ?
-            where key = ?''', [serialized, key])
+        self.cursor.execute(_UPSERT_KV, (key, serialized))
 
         # Save
-        if not self.revision:
-            return value
-
-        self.cursor.execute(
-            'select 1 from kv_revisions where key=? and revision=?',
-            [key, self.revision])
-        exists = self.cursor.fetchone()
-
-        if not exists:
-            self.cursor.execute(
-                '''insert into kv_revisions (
-                revision, key, data) values (?, ?, ?)''',
-                (self.revision, key, serialized))
-        else:
-            self.cursor.execute(
-                '''
-                update kv_revisions
-                set data = ?
-                where key = ?
-                and   revision = ?''',
-                [serialized, key, self.revision])
+        if self.revision:
+            self.cursor.execute(_UPSERT_REVISION,
+                                (key, self.revision, serialized))
 
         return value
 
@@ -358,6 +377,7 @@ class Storage(object):
             (name or sys.argv[0],
              datetime.datetime.utcnow().isoformat()))
         self.revision = self.cursor.lastrowid
+        self.compact()
         try:
             yield self.revision
             self.revision = None
@@ -368,6 +388,25 @@ class Storage(object):
         else:
             self.flush()
 
+    def compact(self, keep=None):
+        """Drop the value history of all but the most recent hooks.
+
+        :param int keep: Number of hooks to keep the history of, defaults
+            to :attr:`history_retention`
+        """
+        if keep is None:
+            keep = self.history_retention
+        if keep is None:
+            return
+        self.cursor.execute('select max(version) from hooks')
+        latest = self.cursor.fetchone()[0]
+        if latest is None or latest <= keep:
+            return
+        cutoff = latest - keep
+        self.cursor.execute('delete from kv_revisions where revision <= ?',
+                            [cutoff])
+        self.cursor.execute('delete from hooks where version <= ?', [cutoff])
+
     def flush(self, save=True):
         if save:
             self.conn.commit()
@@ -377,6 +416,14 @@ class Storage(object):
             self.conn.rollback()
 
     def _init(self):
+        # With a write-ahead log, commits append to the log rather than
+        # rewriting the database and its rollback journal, and readers
+        # (such as actions running alongside a hook) are not blocked.
+        try:
+            self.cursor.execute('pragma journal_mode=wal')
+            self.cursor.execute('pragma synchronous=normal')
+        except sqlite3.OperationalError:
+            pass
         self.cursor.execute('''
             create table if not exists kv (
                key text,
@@ -390,6 +437,9 @@ class Storage(object):
                data text,
                primary key (key, revision)
                )''')
+        self.cursor.execute('''
+            create index if not exists kv_revisions_revision
+               on kv_revisions (revision)''')
         self.cursor.execute('''
             create table if not exists hooks (
                version integer primary key autoincrement,
@@ -511,6 +561,51 @@ class DeltaSet(Record):
 Delta = collections.namedtuple('Delta', ['previous', 'current'])
 
 
+def benchmark(keys=10000, hooks=5, changed=0.01):
+    """Measure the per-hook cost of storing ``keys`` keys.
+
+    Each run executes ``hooks`` consecutive :meth:`Storage.hook_scope`
+    blocks against a fresh database in a temporary directory. Returns a
+    list of ``(operation, seconds_per_hook)`` rows: writing every key with
+    :meth:`Storage.set`, writing every key with :meth:`Storage.update`,
+    and an :meth:`Storage.update` of all keys in which only a ``changed``
+    fraction of the values differ from the previous hook.
+    """
+    step = int(1 / changed) if changed else keys + 1
+
+    def set_all(db, hook):
+        for i in range(keys):
+            db.set('key.%d' % i, [i, hook])
+
+    def update_all(db, hook):
+        db.update(dict(('key.%d' % i, [i, hook]) for i in range(keys)))
+
+    def update_some(db, hook):
+        db.update(dict(('key.%d' % i, [i, hook if i % step == 0 else 0])
+                       for i in range(keys)))
+
+    def run(write):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            db = Storage(os.path.join(tmpdir, 'benchmark.db'))
+            start = time.time()
+            for hook in range(hooks):
+                with db.hook_scope('benchmark-%d' % hook):
+                    write(db, hook)
+            elapsed = time.time() - start
+            db.close()
+        finally:
+            shutil.rmtree(tmpdir)
+        return round(elapsed / hooks, 4)
+
+    return [
+        ('set, %d keys changed' % keys, run(set_all)),
+        ('update, %d keys changed' % keys, run(update_all)),
+        ('update, %d of %d keys changed' % (len(range(0, keys, step)), keys),
+         run(update_some)),
+    ]
+
+
 _KV = None
 
 
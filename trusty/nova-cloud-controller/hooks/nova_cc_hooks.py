@@ -16,6 +16,9 @@ from charmhelpers.core.hookenv import (
     UnregisteredHookError,
     config,
     charm_dir,
+    enable_log_buffering,
+    enable_relation_set_buffering,
+    enable_relation_snapshot,
     is_relation_made,
     log,
     local_unit,
@@ -887,6 +890,7 @@ def nova_vmware_relation_changed():
 def upgrade_charm():
     apt_install(filter_installed_packages(determine_packages()),
                 fatal=True)
+    CONFIGS.precompile()
     for r_id in relation_ids('amqp'):
         amqp_joined(relation_id=r_id)
     for r_id in relation_ids('identity-service'):
@@ -1078,6 +1082,9 @@ def nova_api_relation_joined(rid=None):
 
 
 def main():
+    enable_log_buffering()
+    enable_relation_snapshot()
+    enable_relation_set_buffering()
     try:
         hooks.execute(sys.argv)
     except UnregisteredHookError as e: